@@ -0,0 +1,636 @@
+import argparse
+import contextlib
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import scipy.stats as stats
+
+import hmm_utils
+import inference
+from inference import load_normal_tables
+
+
+def _freqs(df, N=10**4, betaParam=0.5):
+    # same frequency grid as inference.load_data
+    c = 1/(2*np.min([N,100000]))
+    return stats.beta.ppf(np.linspace(c,1-c,df),betaParam,betaParam)
+
+
+def _best_of(f, repeats):
+    best = np.inf
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def bench_trans(args):
+    '''
+    Cost of one epoch of the backward recursion (build transition + propagate alpha)
+    for the dense matrix-power engine vs. the matrix-free stepwise engine.
+    Timings are for an epoch where (N,s,dt) changed; otherwise power reuses its
+    dt-step matrix and pays a single mat-vec.
+    '''
+    z_bins,z_logcdf,z_logsf = load_normal_tables()
+    N, s, h = args.N, 0.01, 0.5
+
+    print('df\tdt\tpower(s)\tstepwise(s)\tspeedup')
+    for df in args.df:
+        freqs = _freqs(df, N)
+        alpha = np.log(np.ones(df)/df)
+        crossover = None
+        for dt in args.dt:
+            def power():
+                P = hmm_utils._nstep_log_trans_prob(N,s,freqs,z_bins,z_logcdf,z_logsf,dt,h)
+                hmm_utils._log_trans_backward_steps(alpha,P,1)
+
+            def stepwise():
+                P = hmm_utils._one_step_log_trans_prob(N,s,freqs,z_bins,z_logcdf,z_logsf,h)
+                hmm_utils._log_trans_backward_steps(alpha,P,dt)
+
+            # first call of each triggers compilation / cache load
+            power(); stepwise()
+            tp = _best_of(power, args.repeats)
+            ts = _best_of(stepwise, args.repeats)
+            if crossover is None and ts > tp:
+                crossover = dt
+            print('%d\t%d\t%.4f\t%.4f\t%.1fx'%(df,dt,tp,ts,tp/ts))
+        if crossover is None:
+            print('# df=%d: stepwise faster for all dt tested'%(df))
+        else:
+            print('# df=%d: power faster from dt=%d'%(df,crossover))
+
+
+def bench_build(args):
+    '''
+    Building the 1-generation transition matrix (_one_step_log_trans_prob), whose
+    rows interpolate all bin edges against the z table in one call.
+    '''
+    z_bins,z_logcdf,z_logsf = load_normal_tables()
+    print('df\tbuild(s)\tper row(us)')
+    for df in args.df:
+        freqs = _freqs(df, args.N)
+        build = lambda: hmm_utils._one_step_log_trans_prob(args.N,0.01,freqs,z_bins,z_logcdf,z_logsf,0.5)
+        build()
+        t = _best_of(build, args.repeats)
+        print('%d\t%.5f\t%.2f'%(df,t,1e6*t/df))
+
+
+def bench_ztable(args):
+    '''
+    Directly computed log Phi(z) (the default) vs. interpolation in a z table
+    (inference.py --zTables): error against scipy.special.log_ndtr, cost per
+    evaluation and per transition matrix, and the resulting change in logL.
+    The table is read from --zTables, or built on [-40,40] with spacing --zStep.
+    '''
+    from scipy.special import log_ndtr
+    if args.zTables != None:
+        t0 = time.perf_counter()
+        table = load_normal_tables(args.zTables)
+        print('# text table load: %.3f s'%(time.perf_counter()-t0))
+    else:
+        z = np.arange(-40.0,40.0+args.zStep/2,args.zStep)
+        table = (z,log_ndtr(z),log_ndtr(-z))
+    direct = load_normal_tables()
+
+    rng = np.random.default_rng(args.seed)
+    print('range\tdirect max|err|\ttable max|err|')
+    for lo,hi in [(-5,5),(-37,-5),(5,37)]:
+        z = rng.uniform(lo,hi,10**5)
+        ref = log_ndtr(z)
+        errs = [np.max(np.abs(hmm_utils._log_cdf_vec(z,*tab[:2]) - ref)/np.maximum(1,np.abs(ref))) for tab in (direct,table)]
+        print('[%d,%d]\t%.2e\t%.2e'%(lo,hi,errs[0],errs[1]))
+    print('# errors are relative where |log Phi| > 1')
+
+    z = rng.uniform(-10,10,10**6)
+    print('method\tper eval(ns)\tbuild df=%d (s)\t|dlogL|'%(args.df))
+    freqs = _freqs(args.df, args.N)
+    epochs = np.arange(0.0,args.tCutoff)
+    GLs,p0 = _simulate_ancient(np.array([0.0,args.tCutoff]),np.array([0.01]),args.N,0.5,100,0.01,rng)
+    glEmissions = hmm_utils.genotype_likelihood_emissions(epochs,freqs,GLs,np.zeros((0,3)))
+    def logl(tab):
+        betaMat = hmm_utils.backward_algorithm(0.01*np.ones(len(epochs)),np.zeros((2,0)),np.zeros((2,len(epochs)),dtype=np.int64),epochs,args.N*np.ones(len(epochs)),freqs,*tab,
+            glEmissions,np.array([]),1,p0,0.5,hmm_utils.TRANS_STEPWISE,1,np.zeros((0,0,0)),np.zeros(0,dtype=np.int64),0.0)
+        return np.logaddexp.reduce(betaMat[-2,:])
+    l0 = logl(direct)
+    for name,tab in [('direct',direct),('table',table)]:
+        hmm_utils._log_cdf_vec(z[:10],*tab[:2])
+        te = _best_of(lambda: hmm_utils._log_cdf_vec(z,*tab[:2]), args.repeats)
+        build = lambda: hmm_utils._one_step_log_trans_prob(args.N,0.01,freqs,*tab,0.5)
+        build()
+        tb = _best_of(build, args.repeats)
+        print('%s\t%.1f\t%.5f\t%.2e'%(name,1e9*te/len(z),tb,abs(logl(tab)-l0)))
+
+
+def bench_scaled(args):
+    '''
+    One backward_algorithm pass (= one likelihood evaluation) in log space vs.
+    scaled linear space.
+    '''
+    z_bins,z_logcdf,z_logsf = load_normal_tables()
+    epochs = np.arange(0.0,args.tCutoff,args.tSkip)
+    N = args.N * np.ones(len(epochs))
+    sel = 0.01 * np.ones(len(epochs))
+    times = np.zeros((2,0))
+    coalOffsets = np.zeros((2,len(epochs)),dtype=np.int64)
+    changePts = np.array([])
+    transMode = hmm_utils.TRANS_STEPWISE if args.transMode == 'stepwise' else hmm_utils.TRANS_POWER
+
+    print('df\tlog(s)\tscaled(s)\tspeedup\tmax|dlogL|')
+    for df in args.df:
+        freqs = _freqs(df, args.N)
+        glEmissions = np.zeros((len(epochs)-1,df))
+        def run(scaled):
+            return hmm_utils.backward_algorithm(sel,times,coalOffsets,epochs,N,freqs,z_bins,z_logcdf,z_logsf,
+                glEmissions,changePts,1,0.3,0.5,transMode,scaled,
+                np.zeros((0,0,0)),np.zeros(0,dtype=np.int64),0.0)
+        dlogl = np.abs(np.logaddexp.reduce(run(0)[-2,:]) - np.logaddexp.reduce(run(1)[-2,:]))
+        tl = _best_of(lambda: run(0), args.repeats)
+        ts = _best_of(lambda: run(1), args.repeats)
+        print('%d\t%.4f\t%.4f\t%.1fx\t%.2e'%(df,tl,ts,tl/ts,dlogl))
+
+
+def _simulate_ancient(timeBins, S, N, h, nSamps, err, rng):
+    # Wright-Fisher trajectory (forward in time, s piecewise over timeBins, kept if
+    # the allele is segregating today) and diploid GLs of nSamps ancient samples
+    tCutoff = int(timeBins[-1])
+    gens = np.arange(tCutoff,0,-1)
+    sel = np.concatenate((S,[0.0]))[np.digitize(gens,timeBins)-1]
+    while True:
+        traj = np.zeros(tCutoff+1)
+        traj[tCutoff] = p = 0.1
+        for t,s in zip(gens,sel):
+            p = p + 2*s*p*(1-p)*(p+h*(1-2*p))
+            p = rng.binomial(int(2*N),min(max(p,0.0),1.0))/(2*N)
+            traj[t-1] = p
+        if 0.05 < traj[0] < 0.95:
+            break
+    sampTimes = np.sort(rng.uniform(1,tCutoff-1,nSamps))
+    genos = rng.binomial(2,traj[sampTimes.astype(int)])
+    GLs = np.log(err/2) * np.ones((nSamps,4))
+    GLs[np.arange(nSamps),genos+1] = np.log(1-err)
+    GLs[:,0] = sampTimes
+    return GLs,traj[0]
+
+
+@contextlib.contextmanager
+def _counting_evals():
+    # counts likelihood evaluations (one per likelihood_grid candidate) and gradient
+    # evaluations through the module functions optimize_selection looks up
+    counts = {'evals':0,'grads':0}
+    def counted(f,key,n=lambda theta: 1):
+        def wrapper(theta,*args):
+            counts[key] += n(theta)
+            return f(theta,*args)
+        return wrapper
+    wrapped = {'likelihood_wrapper':counted(inference.likelihood_wrapper,'evals'),
+        'likelihood_grid':counted(inference.likelihood_grid,'evals',lambda thetas: len(np.atleast_2d(thetas))),
+        'likelihood_grad_wrapper':counted(inference.likelihood_grad_wrapper,'grads')}
+    originals = {name:getattr(inference,name) for name in wrapped}
+    try:
+        for name,f in wrapped.items():
+            setattr(inference,name,f)
+        yield counts
+    finally:
+        for name,f in originals.items():
+            setattr(inference,name,f)
+
+
+def bench_optim(args):
+    '''
+    Likelihood and gradient evaluations (and time) until convergence for
+    Nelder-Mead vs. L-BFGS-B with analytic gradients (--optimizer), on simulated
+    ancient samples. A gradient evaluation costs ~K+2 mat-vecs per generation
+    vs. 1 for a likelihood, so compare the times as well as the counts.
+    '''
+    rng = np.random.default_rng(args.seed)
+    z_bins,z_logcdf,z_logsf = load_normal_tables()
+    timeBins = np.array(args.timeBins,dtype=float)
+    S = np.array(args.s)
+    if len(S) != len(timeBins)-1:
+        raise ValueError('need one --s per time bin')
+    h = 0.5
+    GLs,p0 = _simulate_ancient(timeBins,S,args.N,h,args.nSamps,args.err,rng)
+
+    epochs = np.arange(0.0,timeBins[-1],args.tSkip)
+    N = args.N*np.ones(len(epochs))
+    freqs = _freqs(args.df,args.N)
+    glEmissions = hmm_utils.genotype_likelihood_emissions(epochs,freqs,GLs,np.zeros((0,3)))
+    transMode = hmm_utils.TRANS_STEPWISE if args.transMode == 'stepwise' else hmm_utils.TRANS_POWER
+    # ancient samples only (coals = None)
+    minargs = inference.ModelArgs(timeBins,N,freqs,z_bins,z_logcdf,z_logsf,glEmissions,epochs,1,p0,h,args.sMax,np.array([]),transMode)
+
+    print('# simulated s = %s, %d ancient samples, p0 = %.3f'%(' '.join('%.4f'%(s) for s in S),args.nSamps,p0))
+    print('optimizer	evals	grads	time(s)	logLR	MLE')
+    # compile outside the timed region
+    with contextlib.redirect_stdout(io.StringIO()):
+        inference.likelihood_wrapper(np.zeros(len(S)),*minargs)
+        inference.likelihood_grad_wrapper(np.zeros(len(S)),*minargs)
+        inference.likelihood_grid(np.zeros((2,len(S))),*minargs)
+    for optimizer in ['Nelder-Mead','L-BFGS-B']:
+        t0 = time.perf_counter()
+        with _counting_evals() as counts, contextlib.redirect_stdout(io.StringIO()):
+            res,logL0 = inference.optimize_selection(minargs,optimizer)
+        t = time.perf_counter() - t0
+        print('%s\t%d\t%d\t%.2f\t%.4f\t%s'%(optimizer,counts['evals'],counts['grads'],t,-res.fun+logL0,' '.join('%.5f'%(s) for s in res.x)))
+
+
+def bench_warmstart(args):
+    '''
+    Per-locus optimizer cost of --batch over the loci of one .timeb file, with
+    every fit started at s = 0 vs. --warmStart (started at the MLE of the
+    previous locus).
+    '''
+    argv = ['--times',args.times,'--df',str(args.df),'--tCutoff',str(args.tCutoff),'--optimizer',args.optimizer]
+    if args.timeBins is not None:
+        argv += ['--timeBins',args.timeBins]
+    iargs = inference.parse_args(argv)
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = inference.ClueModel.from_args(iargs)
+        loci = [(bp,)+inference.locus_times(der,anc,iargs) for bp,der,anc in inference.iter_clues(args.times+'.timeb',iargs)]
+        # compile outside the timed region
+        model.fit(args.optimizer)
+
+    fits = {}
+    for warm in (False,True):
+        x0 = prevLogLR = None
+        fits[warm] = []
+        for bp,times,n,m in loci:
+            model.set_times(times,n/(n+m))
+            t0 = time.perf_counter()
+            with _counting_evals() as counts, contextlib.redirect_stdout(io.StringIO()):
+                S,logLR = model.fit(args.optimizer,x0,prevLogLR)
+            fits[warm].append((bp,counts['evals'],time.perf_counter()-t0,logLR))
+            if warm:
+                x0,prevLogLR = S,logLR
+
+    print('bp\tcold evals\tcold(s)\tcold logLR\twarm evals\twarm(s)\twarm logLR')
+    for (bp,ce,ct,cl),(_,we,wt,wl) in zip(fits[False],fits[True]):
+        print('%d\t%d\t%.2f\t%.4f\t%d\t%.2f\t%.4f'%(bp,ce,ct,cl,we,wt,wl))
+    n = len(loci)
+    print('mean\t%.1f\t%.2f\t\t%.1f\t%.2f'%(sum(f[1] for f in fits[False])/n,sum(f[2] for f in fits[False])/n,
+        sum(f[1] for f in fits[True])/n,sum(f[2] for f in fits[True])/n))
+
+
+def bench_band(args):
+    '''
+    Banded vs. dense 1-generation transitions (--transMode banded vs stepwise):
+    bandwidth, cost of dt generations of the backward recursion, and the error
+    in logL of a full backward pass (simulated ancient samples) per --bandTol.
+    '''
+    rng = np.random.default_rng(args.seed)
+    z_bins,z_logcdf,z_logsf = load_normal_tables()
+    N, s, h, dt = args.N, 0.01, 0.5, args.dt
+    GLs,p0 = _simulate_ancient(np.array([0.0,args.tCutoff]),np.array([s]),N,h,100,0.01,rng)
+    epochs = np.arange(0.0,args.tCutoff)
+    Ns = N*np.ones(len(epochs))
+    sel = s*np.ones(len(epochs))
+    times = np.zeros((2,0))
+    coalOffsets = np.zeros((2,len(epochs)),dtype=np.int64)
+
+    print('df\ttol\tbandwidth\tdense(s)\tbanded(s)\tspeedup\t|dlogL|')
+    for df in args.df:
+        freqs = _freqs(df, N)
+        alpha = np.log(np.ones(df)/df)
+        glEmissions = hmm_utils.genotype_likelihood_emissions(epochs,freqs,GLs,np.zeros((0,3)))
+        def logl(transMode,tol):
+            betaMat = hmm_utils.backward_algorithm(sel,times,coalOffsets,epochs,Ns,freqs,z_bins,z_logcdf,z_logsf,
+                glEmissions,np.array([]),1,p0,h,transMode,0,np.zeros((0,0,0)),np.zeros(0,dtype=np.int64),tol)
+            return np.logaddexp.reduce(betaMat[-2,:])
+        l0 = logl(hmm_utils.TRANS_STEPWISE,0.0)
+
+        def dense():
+            P = hmm_utils._one_step_log_trans_prob(N,s,freqs,z_bins,z_logcdf,z_logsf,h)
+            hmm_utils._log_trans_backward_steps(alpha,P,dt)
+        dense()
+        td = _best_of(dense, args.repeats)
+        for tol in args.tol:
+            def banded():
+                lo,band = hmm_utils._one_step_log_trans_band(N,s,freqs,z_bins,z_logcdf,z_logsf,h,tol)
+                hmm_utils._log_band_backward_steps(alpha,lo,band,dt)
+            banded()
+            tb = _best_of(banded, args.repeats)
+            W = hmm_utils._one_step_log_trans_band(N,s,freqs,z_bins,z_logcdf,z_logsf,h,tol)[1].shape[1]
+            dlogl = abs(logl(hmm_utils.TRANS_BANDED,tol) - l0)
+            print('%d\t%g\t%d\t%.4f\t%.4f\t%.1fx\t%.2e'%(df,tol,W,td,tb,td/tb,dlogl))
+
+
+def bench_startup(args):
+    '''
+    Wall time of a fresh interpreter importing inference.py (what every
+    inference.py run, e.g. from case*.py, pays before reading its input), with the
+    AOT kernels from build_kernels.py, with numba's JIT and a warm cache
+    (CLUES_JIT=1), and optionally (--cold) with an empty numba cache.
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    def wall(code, **env):
+        e = dict(os.environ, **env)
+        return _best_of(lambda: subprocess.run([sys.executable,'-c',code],cwd=here,env=e,check=True), args.repeats)
+
+    aot = subprocess.run([sys.executable,'-c','import hmm_utils; print(hmm_utils._aot is not None)'],
+        cwd=here,capture_output=True,text=True,check=True).stdout.strip() == 'True'
+    print('mode\tstartup(s)')
+    print('python\t%.3f'%(wall('pass')))
+    if aot:
+        print('aot\t%.3f'%(wall('import inference')))
+    else:
+        print('aot\t(not built or stale; run build_kernels.py)')
+    print('jit\t%.3f'%(wall('import inference',CLUES_JIT='1')))
+    if args.cold:
+        with tempfile.TemporaryDirectory() as cacheDir:
+            t0 = time.perf_counter()
+            subprocess.run([sys.executable,'-c','import inference'],cwd=here,check=True,
+                env=dict(os.environ,CLUES_JIT='1',NUMBA_CACHE_DIR=cacheDir))
+            print('jit-cold\t%.3f'%(time.perf_counter()-t0))
+
+
+def bench_server(args):
+    '''
+    A sweep of R inference runs on simulated ancient samples, each as a fresh
+    inference.py process (as case*.py do) vs. as requests to one clues_server.py.
+    '''
+    from clues_server import InferenceClient
+    rng = np.random.default_rng(args.seed)
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        for r in range(args.runs):
+            GLs,p0 = _simulate_ancient(np.array([0.0,args.tCutoff]),np.array([args.s]),args.N,0.5,args.nSamps,0.01,rng)
+            files.append((os.path.join(tmp,'anc%d.txt'%(r)),p0))
+            np.savetxt(files[-1][0],GLs,delimiter=' ')
+        opts = {'df':args.df,'N':args.N}
+
+        t0 = time.perf_counter()
+        cli = []
+        for f,p0 in files:
+            cmd = [sys.executable,'inference.py','--ancientSamps',f,'--popFreq',str(p0)]
+            for k,v in opts.items():
+                cmd += ['--'+k,str(v)]
+            stdout = subprocess.run(cmd,cwd=here,capture_output=True,text=True,check=True).stdout
+            cli.append(float(stdout.split('logLR: ')[1].split()[0]))
+        tCli = time.perf_counter()-t0
+
+        t0 = time.perf_counter()
+        with InferenceClient() as clues:
+            served = [clues.infer(ancientSamps=f,popFreq=p0,posterior='none',**opts)['logLR'] for f,p0 in files]
+        tServer = time.perf_counter()-t0
+
+    print('runs\tinference.py(s)\tserver(s)\tspeedup\tmax|dlogLR|')
+    print('%d\t%.2f\t%.2f\t%.1fx\t%.1e'%(args.runs,tCli,tServer,tCli/tServer,np.max(np.abs(np.array(cli)-np.array(served)))))
+
+
+def _legacy_traj(p0, s, tOn, tOff, N):
+    # step.py's simulate_traj before traj_sim: one np.random.normal call per generation
+    delta = 1/(4*N)
+    a = 1e-8*N*2
+    bwd = [p0]
+    while bwd[-1] != 1 and bwd[-1] != 0:
+        curr = bwd[-1]
+        bwd.append(min(max(np.random.normal(-a*curr*(1-curr)/np.tanh(a*curr)*delta + curr, np.sqrt(delta) * np.sqrt(curr*(1-curr))),0),1))
+    fwd = [p0]
+    for t in range(tOn,0,-1):
+        a = s*N*2 if t > tOff else 0.0
+        curr = fwd[-1]
+        fwd.append(min(max(np.random.normal(a*curr*(1-curr)*delta + curr, np.sqrt(delta) * np.sqrt(curr*(1-curr))),0),1))
+    return fwd[::-1] + bwd[1:]
+
+
+def bench_trajsim(args):
+    '''
+    Trajectories per second of the per-generation Python loop of step.py vs.
+    traj_sim.simulate_traj (all replicates at once), with summary statistics
+    of both samples: present-day frequency and total length (generations).
+    '''
+    import traj_sim
+    np.random.seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+    traj_sim.simulate_traj(args.p0,args.s,args.ton,args.toff,args.N,2,rng)
+
+    t0 = time.perf_counter()
+    legacy = [_legacy_traj(args.p0,args.s,args.ton,args.toff,args.N) for r in range(args.legacyReps)]
+    tLegacy = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    traj,offsets = traj_sim.simulate_traj(args.p0,args.s,args.ton,args.toff,args.N,args.reps,rng)
+    tBatch = time.perf_counter() - t0
+
+    print('method\treplicates\ttraj/s\tmean p(present)\tmean length')
+    print('step.py\t%d\t%.1f\t%.4f\t%.0f'%(args.legacyReps,args.legacyReps/tLegacy,np.mean([x[0] for x in legacy]),np.mean([len(x) for x in legacy])))
+    print('traj_sim\t%d\t%.1f\t%.4f\t%.0f'%(args.reps,args.reps/tBatch,np.mean(traj[offsets[:-1]]),np.mean(np.diff(offsets))))
+
+    # trajectories meeting a condition on the present-day frequency (MAF >= --eps,
+    # and within --tol of --pNow if given): kept from the unconditioned batch above,
+    # vs. simulate_traj_conditioned
+    now = traj[offsets[:-1]]
+    ok = np.minimum(now,1-now) >= args.eps
+    if args.pNow is not None:
+        ok &= np.abs(now-args.pNow) <= args.tol
+    t0 = time.perf_counter()
+    cond,condOffsets,accept = traj_sim.simulate_traj_conditioned(args.p0,args.s,args.ton,args.toff,args.N,args.reps,rng,args.eps,args.pNow,args.tol)
+    tCond = time.perf_counter() - t0
+    print()
+    print('method\tusable\tusable traj/s\tmean p(present)\tacceptance')
+    print('traj_sim+discard\t%d\t%.1f\t%.4f\t%.4f'%(np.sum(ok),np.sum(ok)/tBatch,np.mean(now[ok]) if np.any(ok) else np.nan,np.mean(ok)))
+    print('conditioned\t%d\t%.1f\t%.4f\t%.4f'%(args.reps,args.reps/tCond,np.mean(cond[condOffsets[:-1]]),accept))
+
+
+def _legacy_gls(gens, nsamp, traj):
+    # step2.py's simulate_gls_from_traj before vectorization: one sample at a time
+    ancGLs = np.zeros((nsamp,4))
+    epochs = np.linspace(0,gens,gens)
+    times = np.sort(np.random.uniform(0,gens,size=nsamp))
+    genos = []
+    for i,t in enumerate(times):
+        ancGLs[i,0] = t
+        if t >= gens - 1:
+            ancGLs[i,1:] = [0,-np.inf,-np.inf]
+            genos.append(0)
+            continue
+        geno = np.random.binomial(2,traj[np.digitize(t,epochs)+1])
+        genos.append(geno)
+        ancGLs[i,1:] = -np.inf
+        ancGLs[i,1+geno] = 0.0
+    return ancGLs,genos
+
+
+def bench_glsim(args):
+    '''
+    Ancient samples per second of the per-sample loop of step2.py vs. the
+    vectorized simulate_gls_from_traj, for one trajectory and for --reps
+    replicate trajectories at once (perfect calls, and reads at --depth with
+    --err), with the mean derived allele count of each.
+    '''
+    import step2
+    import traj_sim
+    np.random.seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+    traj,offsets = traj_sim.simulate_traj_conditioned(args.p0,args.s,args.gens,0,args.N,args.reps,rng)[:2]
+    first = traj_sim.replicate(traj,offsets,0)
+
+    t0 = time.perf_counter()
+    anc,genos = _legacy_gls(args.gens,args.nSamps,first)
+    tLegacy = time.perf_counter() - t0
+    print('method	trajectories	samples	samples/s	mean genotype')
+    print('step2.py loop	1	%d	%.0f	%.4f'%(args.nSamps,args.nSamps/tLegacy,np.mean(genos)))
+
+    runs = [('vectorized',1,{}),('vectorized',args.reps,{}),
+        ('depth %g err %g'%(args.depth,args.err),args.reps,{'depth':args.depth,'err':args.err})]
+    for name,R,kwargs in runs:
+        t0 = time.perf_counter()
+        if R == 1:
+            anc,genos = step2.simulate_gls_from_traj(args.gens,args.nSamps,first,rng=rng,**kwargs)
+        else:
+            anc,genos = step2.simulate_gls_from_traj(args.gens,args.nSamps,traj,rng=rng,offsets=offsets,**kwargs)
+        t = time.perf_counter() - t0
+        print('%s\t%d\t%d\t%.0f\t%.4f'%(name,R,R*args.nSamps,R*args.nSamps/t,np.mean(genos)))
+
+
+def bench_glload(args):
+    '''
+    Load times of --ancientSamps GLs written by step2.py as text, .npy and .npz,
+    and of the .npy file memory-mapped (--mmapGLs), with the largest difference
+    from the simulated values.
+    '''
+    import step2
+    rng = np.random.default_rng(args.seed)
+    traj = np.linspace(0.5,0.1,args.gens+2)
+    gls = step2.simulate_gls_from_traj(args.gens,args.nSamps,traj,rng=rng,depth=args.depth,err=args.err)[0]
+    print('format\tsize(MB)\tload(s)\tmax|dGL|')
+    with tempfile.TemporaryDirectory() as tmp:
+        for ext,mmap in [('txt',False),('npy',False),('npz',False),('npy',True)]:
+            path = os.path.join(tmp,'gls.'+ext)
+            if not os.path.exists(path):
+                step2.write_gls(path,gls)
+            t = _best_of(lambda: inference.load_gls(path,4,mmap),args.repeats)
+            loaded = inference.load_gls(path,4,mmap)
+            print('%s\t%.1f\t%.4f\t%.1e'%(ext+(' mmap' if mmap else ''),os.path.getsize(path)/2**20,t,np.max(np.abs(loaded-gls))))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Microbenchmarks for the CLUES HMM kernels.')
+    sub = parser.add_subparsers(dest='bench',required=True)
+
+    p = sub.add_parser('trans',help='transition engines (--transMode power vs stepwise)')
+    p.add_argument('--df',type=int,nargs='+',default=[50,150,450])
+    p.add_argument('--dt',type=int,nargs='+',default=[1,5,20,100,500,2000])
+    p.add_argument('-N','--N',type=float,default=10**4)
+    p.add_argument('--repeats',type=int,default=3)
+    p.set_defaults(func=bench_trans)
+
+    p = sub.add_parser('build',help='transition matrix construction')
+    p.add_argument('--df',type=int,nargs='+',default=[50,150,450,1000])
+    p.add_argument('-N','--N',type=float,default=10**4)
+    p.add_argument('--repeats',type=int,default=3)
+    p.set_defaults(func=bench_build)
+
+    p = sub.add_parser('ztable',help='computed log Phi(z) vs the interpolated z tables (--zTables)')
+    p.add_argument('--zTables',type=str,default=None,help='directory with the legacy text tables')
+    p.add_argument('--zStep',type=float,default=0.005)
+    p.add_argument('--df',type=int,default=150)
+    p.add_argument('--tCutoff',type=float,default=500)
+    p.add_argument('-N','--N',type=float,default=10**4)
+    p.add_argument('--seed',type=int,default=1)
+    p.add_argument('--repeats',type=int,default=3)
+    p.set_defaults(func=bench_ztable)
+
+    p = sub.add_parser('scaled',help='log-space vs scaled linear-space forward/backward (--scaled)')
+    p.add_argument('--df',type=int,nargs='+',default=[50,150,450])
+    p.add_argument('--tCutoff',type=float,default=1000)
+    p.add_argument('--tSkip',type=int,default=1)
+    p.add_argument('--transMode',type=str,default='power',choices=['power','stepwise'])
+    p.add_argument('-N','--N',type=float,default=10**4)
+    p.add_argument('--repeats',type=int,default=3)
+    p.set_defaults(func=bench_scaled)
+
+    p = sub.add_parser('band',help='banded vs dense 1-generation transitions (--transMode banded, --bandTol)')
+    p.add_argument('--df',type=int,nargs='+',default=[150,450,1000])
+    p.add_argument('--tol',type=float,nargs='+',default=[1e-6,1e-9,1e-12,1e-15])
+    p.add_argument('--dt',type=int,default=100)
+    p.add_argument('--tCutoff',type=float,default=500)
+    p.add_argument('-N','--N',type=float,default=10**4)
+    p.add_argument('--seed',type=int,default=1)
+    p.add_argument('--repeats',type=int,default=3)
+    p.set_defaults(func=bench_band)
+
+    p = sub.add_parser('startup',help='interpreter startup with AOT kernels (build_kernels.py) vs. numba JIT')
+    p.add_argument('--cold',action='store_true',help='also time a run with an empty numba cache (slow)')
+    p.add_argument('--repeats',type=int,default=3)
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser('server',help='fresh inference.py processes vs. requests to clues_server.py')
+    p.add_argument('--runs',type=int,default=10)
+    p.add_argument('--nSamps',type=int,default=50)
+    p.add_argument('--tCutoff',type=float,default=300)
+    p.add_argument('-s','--s',type=float,default=0.01)
+    p.add_argument('--df',type=int,default=100)
+    p.add_argument('-N','--N',type=float,default=10**4)
+    p.add_argument('--seed',type=int,default=1)
+    p.set_defaults(func=bench_server)
+
+    p = sub.add_parser('trajsim',help='per-generation loop of step.py vs. traj_sim batch trajectories')
+    p.add_argument('--reps',type=int,default=2000)
+    p.add_argument('--legacyReps',type=int,default=50)
+    p.add_argument('-p0','--p0',type=float,default=0.1)
+    p.add_argument('-s','--s',type=float,default=0.01)
+    p.add_argument('--ton',type=int,default=500)
+    p.add_argument('--toff',type=int,default=0)
+    p.add_argument('-N','--N',type=float,default=10**4)
+    p.add_argument('--seed',type=int,default=1)
+    p.add_argument('--eps',type=float,default=0.001,help='conditioning: minimum present-day MAF')
+    p.add_argument('--pNow',type=float,default=None,help='conditioning: target present-day frequency')
+    p.add_argument('--tol',type=float,default=0.01)
+    p.set_defaults(func=bench_trajsim)
+
+    p = sub.add_parser('glsim',help='per-sample loop of step2.py vs. vectorized ancient-sample GL simulation')
+    p.add_argument('--nSamps',type=int,default=10**5)
+    p.add_argument('--reps',type=int,default=20)
+    p.add_argument('--gens',type=int,default=500)
+    p.add_argument('-p0','--p0',type=float,default=0.3)
+    p.add_argument('-s','--s',type=float,default=0.01)
+    p.add_argument('--depth',type=float,default=2.0)
+    p.add_argument('--err',type=float,default=0.01)
+    p.add_argument('-N','--N',type=float,default=10**4)
+    p.add_argument('--seed',type=int,default=1)
+    p.set_defaults(func=bench_glsim)
+
+    p = sub.add_parser('glload',help='text vs. binary .npy/.npz ancient-sample GL input')
+    p.add_argument('--nSamps',type=int,default=10**5)
+    p.add_argument('--gens',type=int,default=500)
+    p.add_argument('--depth',type=float,default=2.0)
+    p.add_argument('--err',type=float,default=0.01)
+    p.add_argument('--seed',type=int,default=1)
+    p.add_argument('--repeats',type=int,default=3)
+    p.set_defaults(func=bench_glload)
+
+    p = sub.add_parser('optim',help='Nelder-Mead vs. gradient-based L-BFGS-B (--optimizer)')
+    p.add_argument('--timeBins',type=float,nargs='+',default=[0,100,200])
+    p.add_argument('--s',type=float,nargs='+',default=[0.01,0.005])
+    p.add_argument('--nSamps',type=int,default=100)
+    p.add_argument('--err',type=float,default=0.01)
+    p.add_argument('--df',type=int,default=150)
+    p.add_argument('--tSkip',type=int,default=1)
+    p.add_argument('--transMode',type=str,default='power',choices=['power','stepwise'])
+    p.add_argument('--sMax',type=float,default=1.0)
+    p.add_argument('-N','--N',type=float,default=10**4)
+    p.add_argument('--seed',type=int,default=1)
+    p.set_defaults(func=bench_optim)
+
+    p = sub.add_parser('warmstart',help='per-locus --batch fits started at s = 0 vs. --warmStart')
+    p.add_argument('--times',type=str,required=True,help='prefix of a multi-locus .timeb file')
+    p.add_argument('--timeBins',type=str,default=None)
+    p.add_argument('--df',type=int,default=30)
+    p.add_argument('--tCutoff',type=float,default=300)
+    p.add_argument('--optimizer',type=str,default='Nelder-Mead',choices=['Nelder-Mead','L-BFGS-B'])
+    p.set_defaults(func=bench_warmstart)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.func(args)
@@ -0,0 +1,134 @@
+import contextlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from hmm_utils import TRANS_BANDED, TRANS_STEPWISE
+from trans_cache import TransCache
+
+# per-process transition cache, reused by all replicates a worker runs
+_transCache = None
+
+
+def simulate_model_traj(p0Probs,sel,epochs,N,freqs,changePts,h,transMode,transCache,rng):
+    '''
+    Frequency path of the HMM's own backward-in-time chain: a frequency bin drawn
+    from p0Probs at the present, then moves drawn from the rows of the fitted
+    transition matrices (from TransCache.transitions; dt 1-generation steps in
+    stepwise/banded mode, one dt-generation step in power mode). Changepoint
+    epochs redraw the bin uniformly, as the HMM does. sel and N are per epoch, as
+    passed to backward_algorithm.
+
+    Returns the frequency at every epoch boundary (len(epochs)).
+    '''
+    T = len(epochs)-1
+    if transMode == TRANS_BANDED:
+        # same chain as stepwise, from dense matrices
+        transMode = TRANS_STEPWISE
+    transMats,transIdx = transCache.transitions(sel,epochs,N,freqs,h,transMode)
+    cumTrans = np.cumsum(np.exp(transMats),axis=2)
+    lf = len(freqs)
+    states = np.zeros(T+1,dtype=int)
+    states[0] = i = rng.choice(lf,p=p0Probs)
+    for tb in range(T):
+        if np.sum(tb==changePts) != 0:
+            i = rng.integers(lf)
+        else:
+            cum = cumTrans[transIdx[tb]]
+            nsteps = int(epochs[tb+1]-epochs[tb]) if transMode == TRANS_STEPWISE else 1
+            for step in range(nsteps):
+                i = min(np.searchsorted(cum[i],rng.random()*cum[i,-1]),lf-1)
+        states[tb+1] = i
+    return freqs[states]
+
+
+def simulate_gls(GLs,epochs,traj,rng):
+    '''
+    Genotype likelihoods for samples taken at the same times (and with the same
+    ploidy) as the rows of GLs. Each sample keeps its own GL profile, with its
+    most likely genotype swapped to the simulated one, so exact (0/-inf) input
+    GLs give exact simulated GLs as in step2.py.
+    '''
+    ploidy = GLs.shape[1]-2
+    rows = np.arange(len(GLs))
+    # a sample at time t in (epochs[tb],epochs[tb+1]] is emitted at the end of epoch tb
+    idx = np.minimum(np.searchsorted(epochs,GLs[:,0]),len(traj)-1)
+    genos = rng.binomial(ploidy,traj[idx])
+    called = np.argmax(GLs[:,1:],axis=1)
+    simGLs = GLs.copy()
+    simGLs[rows,genos+1] = GLs[rows,called+1]
+    simGLs[rows,called+1] = GLs[rows,genos+1]
+    return simGLs
+
+
+def _init_worker(z_bins,z_logcdf,z_logsf,maxBytes):
+    global _transCache
+    if maxBytes > 0:
+        _transCache = TransCache(z_bins,z_logcdf,z_logsf,maxBytes=maxBytes)
+
+
+def _replicate(task):
+    # one parametric bootstrap replicate: simulate at the MLE, then re-infer
+    import inference
+    seed,sel,p0Probs,ancientGLs,ancientHapGLs,modelArgs,optimizer = task
+    minargs = inference.ModelArgs(**modelArgs)
+    rng = np.random.default_rng(seed)
+
+    epochs,freqs = minargs.epochs,minargs.freqs
+    transCache = _transCache if _transCache is not None else TransCache(minargs.z_bins,minargs.z_logcdf,minargs.z_logsf,maxBytes=0)
+    traj = simulate_model_traj(p0Probs,sel,epochs,minargs.N,freqs,minargs.changePts,minargs.h,minargs.transMode,transCache,rng)
+    glEmissions = inference.genotype_likelihood_emissions(epochs,freqs,simulate_gls(ancientGLs,epochs,traj,rng),simulate_gls(ancientHapGLs,epochs,traj,rng))
+
+    # ancient samples only: no coalescence times
+    repArgs = minargs._replace(glEmissions=glEmissions,transCache=_transCache)
+    with open(os.devnull,'w') as devnull, contextlib.redirect_stdout(devnull):
+        res,logL0 = inference.optimize_selection(repArgs,optimizer)
+    return res.x,-res.fun+logL0
+
+
+def bootstrap(B,procs,seed,S,post,ancientGLs,ancientHapGLs,minargs,optimizer='Nelder-Mead',maxCacheBytes=2**30,outFile=None):
+    '''
+    Parametric bootstrap of the selection MLE S: B replicate datasets of ancient
+    samples are simulated under the fitted model (see simulate_model_traj) and
+    re-inferred in a pool of procs processes.
+
+    Replicate i is seeded with the i-th child of np.random.SeedSequence(seed), so
+    results do not depend on procs. Replicate MLEs are streamed to outFile (tsv)
+    as they finish, in replicate order. Returns the B x len(S) array of MLEs.
+    '''
+    timeBins,epochs,sMax = minargs.timeBins,minargs.epochs,minargs.sMax
+    sel = np.concatenate((S,[0.0]))[np.digitize(epochs,timeBins,right=False)-1]
+    # present-day frequency bin of replicates (includes the --popFreq prior, if any)
+    p0Probs = np.exp(post[:,0])/np.sum(np.exp(post[:,0]))
+    seeds = np.random.SeedSequence(seed).spawn(B)
+    # the transition cache and thread pool stay in this process; sent as a dict, as
+    # ModelArgs lives in __main__ when inference.py is run as a script
+    taskArgs = minargs._replace(transCache=None,pool=None,coals=None)._asdict()
+    tasks = ((seeds[i],sel,p0Probs,ancientGLs,ancientHapGLs,taskArgs,optimizer) for i in range(B))
+
+    mles = np.zeros((B,len(S)))
+    f = open(outFile,'w') if outFile != None else None
+    if f is not None:
+        f.write('\t'.join(['replicate','logLR']+['s_%d-%d'%(t,u) for t,u in zip(timeBins[:-1],timeBins[1:])])+'\n')
+    with ProcessPoolExecutor(max_workers=procs,initializer=_init_worker,initargs=(minargs.z_bins,minargs.z_logcdf,minargs.z_logsf,maxCacheBytes)) as pool:
+        for i,(x,logLR) in enumerate(pool.map(_replicate,tasks)):
+            mles[i,:] = x
+            if f is not None:
+                f.write('\t'.join([str(i),'%.4f'%(logLR)]+['%.5f'%(s) for s in x])+'\n')
+                f.flush()
+    if f is not None:
+        f.close()
+    pinned = np.sum(np.any(np.abs(mles) >= sMax-1e-3,axis=1))
+    if pinned > 0:
+        print('Warning: %d of %d replicate MLEs are at the --sMax bound; the intervals are unreliable'%(pinned,B))
+    return mles
+
+
+def print_ci_table(S,mles,timeBins,level=0.95):
+    # percentile interval, and the basic (bias-corrected) interval 2*MLE - percentiles
+    lo,hi = 100*(1-level)/2,100*(1+level)/2
+    print('epoch\tMLE\tSE\tbias\tpct_%g%%\tpct_%g%%\tbasic_%g%%\tbasic_%g%%'%(lo,hi,lo,hi))
+    for k,(t,u) in enumerate(zip(timeBins[:-1],timeBins[1:])):
+        qlo,qhi = np.percentile(mles[:,k],[lo,hi])
+        print('%d-%d\t%.5f\t%.5f\t%.5f\t%.5f\t%.5f\t%.5f\t%.5f'%(t,u,S[k],np.std(mles[:,k],ddof=1),np.mean(mles[:,k])-S[k],qlo,qhi,2*S[k]-qhi,2*S[k]-qlo))
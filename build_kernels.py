@@ -0,0 +1,82 @@
+'''
+Compiles the HMM kernels ahead of time, so inference.py starts without numba
+compiling or loading its cache for every kernel.
+
+    python3 build_kernels.py            # build _hmm_kernels (AOT) next to hmm_utils.py
+    python3 build_kernels.py --jitOnly  # only warm the numba cache (JIT fallback)
+
+hmm_utils uses _hmm_kernels when it was built from the current hmm_utils.py
+(rebuild after editing it, or after changing Python/numpy versions) and falls
+back to numba's JIT otherwise, or when CLUES_JIT=1 is set.
+
+The AOT build needs numba.pycc, which numba has deprecated (builds are tested
+with numba 0.68). Without it the build stops with an error and inference.py
+keeps using the JIT.
+'''
+import argparse
+import os
+import sys
+import time
+
+# compile the JIT kernels with their signatures: these are what gets exported
+os.environ['CLUES_JIT'] = '1'
+
+t0 = time.perf_counter()
+import hmm_utils
+print('JIT kernels compiled/loaded: %.1f s'%(time.perf_counter()-t0))
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--jitOnly',action='store_true',
+		help='only populate the numba cache (compiled on import above)')
+	parser.add_argument('--outDir',type=str,default=os.path.dirname(os.path.abspath(hmm_utils.__file__)),
+		help='directory for the extension module; must be on sys.path when running inference.py')
+	parser.add_argument('--targetCpu',type=str,default='host',
+		help="LLVM CPU name; 'host' is fastest but the module may not run on older CPUs ('generic' is portable)")
+	return parser.parse_args()
+
+# frozen into the module as a constant, so hmm_utils can detect a stale build
+_SOURCE_CRC = hmm_utils.source_crc()
+
+def source_crc():
+	return _SOURCE_CRC
+
+def load_pycc():
+	# numba.pycc, and the compiler flags that build() patches to release the GIL
+	import numba
+	try:
+		from numba.pycc import CC
+		import numba.pycc.compiler as pyccCompiler
+	except ImportError as e:
+		print('Error: numba %s has no numba.pycc (%s); use a numba release that still ships it (e.g. 0.68), or stay on the JIT'%(numba.__version__,e))
+		sys.exit(1)
+	if not hasattr(getattr(pyccCompiler,'Flags',object)(),'release_gil'):
+		print('Error: numba.pycc.compiler.Flags of numba %s has no release_gil option, so the kernels cannot be built to release the GIL; use numba 0.68, or stay on the JIT'%(numba.__version__))
+		sys.exit(1)
+	return CC,pyccCompiler
+
+def build(outDir,targetCpu):
+	CC,pyccCompiler = load_pycc()
+	class Flags(pyccCompiler.Flags):
+		def __init__(self,*args,**kwargs):
+			super().__init__(*args,**kwargs)
+			# as nogil=True on the JIT kernels, so inference.py --threads runs them concurrently
+			self.release_gil = True
+	pyccCompiler.Flags = Flags
+	cc = CC('_hmm_kernels')
+	cc.output_dir = outDir
+	cc.target_cpu = targetCpu
+	cc.verbose = False
+	for name in hmm_utils.AOT_KERNELS:
+		kernel = getattr(hmm_utils,name)
+		cc.export(name,kernel.nopython_signatures[0])(kernel.py_func)
+	cc.export('source_crc','int64()')(source_crc)
+	cc.compile()
+
+if __name__ == '__main__':
+	args = parse_args()
+	if not args.jitOnly:
+		# the numba cache is warm by now, so a failed build still leaves a fast JIT start
+		t0 = time.perf_counter()
+		build(args.outDir,args.targetCpu)
+		print('Built _hmm_kernels in %s: %.1f s'%(args.outDir,time.perf_counter()-t0))
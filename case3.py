@@ -27,6 +27,11 @@ from pathlib import Path
 
 import numpy as np
 
+import inference
+import step
+import step2
+from trans_cache import TransCache
+
 EXTERNAL_DEPENDENCIES = ["git", "gcc", "Rscript"]
 VERBOSE = 0
 
@@ -116,6 +121,59 @@ def run_step2(p_initial, s, n, ton, toff, ancient_sample_generation_gap, number_
     execute_command(command)
 
 
+# In-process versions of the Python stages: arrays stay in memory between them and the
+# kernels, z tables and transition cache are loaded once for all runs. Only mssel,
+# Rscript and Relate need files and subprocesses.
+def simulate_step(p_initial, s, n, output_file_path, ton, toff, rng):
+    # as step.py; mssel reads the trajectory from output_file_path
+    traj = step.simulate_traj(p_initial, s, ton, toff, n, rng)
+    step.save_mssel_input(n, output_file_path, traj)
+    return traj
+
+
+def simulate_ancient_samples(p_initial, s, n, ton, toff, ancient_sample_generation_gap, number_of_ancient_samples, rng):
+    # as step2.py, returning the GL matrix instead of writing it
+    traj = step2.simulate_traj(p_initial, s, ton, toff, n, rng)
+    ancient_gls, genos = step2.simulate_gls_from_traj(int(ancient_sample_generation_gap), number_of_ancient_samples, traj, rng=rng)
+    return ancient_gls
+
+
+def clues_path(path):
+    # relative to the cloned clues repo, where run_inference runs inference.py
+    return path if os.path.isabs(path) else os.path.join("clues", path)
+
+
+def infer(coalescence_times, ancient_gls, inference_output_filename, time_bins, pop_freq, trans_cache=None, z_tables=None):
+    # as inference.py with --ancientSamps taken from ancient_gls; returns (logLR, epoch, selection) of the first time bin.
+    # This runs this repo's inference.py, not the cloned one that run_inference runs: unless z_tables
+    # (--zTables, as the cloned inference.py reads them) is given, log Phi(z) is computed rather than
+    # interpolated, so logLR and the MLE can differ slightly between the two paths.
+    argv = ["--popFreq", str(pop_freq), "--out", inference_output_filename]
+    if coalescence_times is not None:
+        argv += ["--times", coalescence_times]
+    if time_bins is not None:
+        argv += ["--timeBins", clues_path(time_bins)]
+    if z_tables is not None:
+        argv += ["--zTables", clues_path(z_tables)]
+    inference_args = inference.parse_args(argv)
+    model = inference.ClueModel.from_args(inference_args, trans_cache, ancientGLs=ancient_gls)
+    S, logLR = model.fit(inference_args.optimizer)
+    inference.out(inference_args, model.epochs, model.freqs, model.posterior(S))
+    model.close()
+    print_if_debug_mode_active(f"logLR: {logLR:.4f}, MLE: {S}", 2)
+    return logLR, "%d-%d" % (model.timeBins[0], model.timeBins[1]), S[0]
+
+
+def write_inference_result_to_csv(writer, run, result):
+    loglr, epoch, selection = result
+    writer.writerow({
+        "run #": run,
+        "logLR": "%.4f" % loglr,
+        "epoch": epoch,
+        "selection": "%.5f" % selection
+    })
+
+
 def run_mssel(
     nchroms,
     nreps,
@@ -243,8 +301,11 @@ def plot(mssel_traj_file_path, input_file_path, output_file_path, effective_popu
     )
 
 
-def fill_defaults(args):
-    args.nder = np.random.binomial(args.nchroms, np.loadtxt(os.path.join(args.output_directory, "mssel.traj"), dtype=float, skiprows=3)[0][1])
+def fill_defaults(args, traj=None, rng=None):
+    # traj: the step trajectory in memory, instead of reading back the .traj file; rng: the run's generator (--seed)
+    p_now = traj[0] if traj is not None else np.loadtxt(os.path.join(args.output_directory, "mssel.traj"), dtype=float, skiprows=3)[0][1]
+    rng = np.random.default_rng() if rng is None else rng
+    args.nder = rng.binomial(args.nchroms, p_now)
     args.nanc = args.nchroms - args.nder
     args.pop_freq = args.nder / args.nchroms
 
@@ -334,11 +395,17 @@ def main():
 
     argparser.add_argument("--inference-script-output-filename", type=str, required=True)
     argparser.add_argument("--inference-script-coalescence-times-filename", type=str, required=True)
-    argparser.add_argument("--inference-script-time-bins-file-path", type=str, required=True)
+    argparser.add_argument("--inference-script-time-bins-file-path", type=str, required=True, help="Relative paths are inside the cloned clues repo (e.g. example/timeBins.txt).")
     argparser.add_argument("--step2-script-ancient-samples-generation-gap", type=str, required=True)
     argparser.add_argument("--step2-script-number-of-ancient-samples", type=int, required=True)
     argparser.add_argument("--verbose", "-v", action="count", default=0)
     argparser.add_argument("--pop-freq", type=float)
+    argparser.add_argument("--subprocess-stages", action="store_true", help="Run step.py, step2.py and inference.py (of the cloned clues repo) as separate processes, exchanging files, instead of in-process.")
+    argparser.add_argument("--seed", type=int, default=None, help="Random seed of the in-process stages and of the derived allele count passed to mssel.")
+    argparser.add_argument(
+        "--inference-z-tables", type=str, default=None,
+        help="In-process inference only: directory of z_bins/z_logcdf/z_logsf.txt tables to interpolate log Phi(z) from (inference.py --zTables; relative paths are inside the cloned clues repo, e.g. utils), as the cloned inference.py run by --subprocess-stages does. By default log Phi(z) is computed, so results can differ slightly from --subprocess-stages."
+    )
 
     args = argparser.parse_args()
 
@@ -358,6 +425,11 @@ def main():
     writer = csv.DictWriter(f, fieldnames=["run #", "logLR", "epoch", "selection"])
     writer.writeheader()
 
+    # shared by the in-process stages of all runs
+    rng = np.random.default_rng(args.seed)
+    z_tables = None if args.inference_z_tables is None else clues_path(args.inference_z_tables)
+    trans_cache = None if args.subprocess_stages else TransCache(*inference.load_normal_tables(z_tables))
+
     original_output_directory = str(args.output_directory)
     for n_run in range(1, args.runs + 1):
         args.output_directory = os.path.join(original_output_directory, f"run_{n_run}")
@@ -374,15 +446,27 @@ def main():
         step2_script_ancient_samples_file_path = None
 
         # Actual Computation
-        run_step(
-            p_initial=args.initial_allele_freq,
-            s=args.selection_coefficient,
-            n=args.effective_population_size,
-            output_file_path=step_script_output_file_path,
-            ton=args.ton,
-            toff=args.toff
-        )
-        fill_defaults(args)
+        if args.subprocess_stages:
+            run_step(
+                p_initial=args.initial_allele_freq,
+                s=args.selection_coefficient,
+                n=args.effective_population_size,
+                output_file_path=step_script_output_file_path,
+                ton=args.ton,
+                toff=args.toff
+            )
+            fill_defaults(args, rng=rng)
+        else:
+            traj = simulate_step(
+                p_initial=args.initial_allele_freq,
+                s=args.selection_coefficient,
+                n=args.effective_population_size,
+                output_file_path=step_script_output_file_path,
+                ton=args.ton,
+                toff=args.toff,
+                rng=rng
+            )
+            fill_defaults(args, traj, rng)
 
         run_mssel(
             nchroms=args.nchroms,
@@ -412,17 +496,29 @@ def main():
             output_file_path=relate_output_filename,
         )
 
-        step2_script_ancient_samples_file_path = os.path.join(args.output_directory, "ancientSamples.txt")
-        run_step2(
-            p_initial=args.initial_allele_freq,
-            s=args.selection_coefficient,
-            n=args.effective_population_size,
-            ton=args.ton,
-            toff=args.toff,
-            ancient_sample_generation_gap=args.step2_script_ancient_samples_generation_gap,
-            number_of_ancient_samples=args.step2_script_number_of_ancient_samples,
-            output_file_path=step2_script_ancient_samples_file_path
-        )
+        if args.subprocess_stages:
+            step2_script_ancient_samples_file_path = os.path.join(args.output_directory, "ancientSamples.txt")
+            run_step2(
+                p_initial=args.initial_allele_freq,
+                s=args.selection_coefficient,
+                n=args.effective_population_size,
+                ton=args.ton,
+                toff=args.toff,
+                ancient_sample_generation_gap=args.step2_script_ancient_samples_generation_gap,
+                number_of_ancient_samples=args.step2_script_number_of_ancient_samples,
+                output_file_path=step2_script_ancient_samples_file_path
+            )
+        else:
+            ancient_gls = simulate_ancient_samples(
+                p_initial=args.initial_allele_freq,
+                s=args.selection_coefficient,
+                n=args.effective_population_size,
+                ton=args.ton,
+                toff=args.toff,
+                ancient_sample_generation_gap=args.step2_script_ancient_samples_generation_gap,
+                number_of_ancient_samples=args.step2_script_number_of_ancient_samples,
+                rng=rng
+            )
 
         if args.inference_script_coalescence_times_filename is not None:
             args.inference_script_coalescence_times_filename = os.path.join(args.output_directory, args.inference_script_coalescence_times_filename)
@@ -439,14 +535,26 @@ def main():
                 last_bp=args.sample_branch_length_last_bp
             )
 
-        inference_script_output = run_inference(
-            coalescence_times=args.inference_script_coalescence_times_filename,
-            ancient_samples_file_path=step2_script_ancient_samples_file_path,
-            inference_output_filename=inference_script_output_filename,
-            time_bins=args.inference_script_time_bins_file_path,
-            pop_freq=args.pop_freq
-        )
-        parse_inference_script_output_and_write_to_csv(writer, n_run, inference_script_output)
+        if args.subprocess_stages:
+            inference_script_output = run_inference(
+                coalescence_times=args.inference_script_coalescence_times_filename,
+                ancient_samples_file_path=step2_script_ancient_samples_file_path,
+                inference_output_filename=inference_script_output_filename,
+                time_bins=args.inference_script_time_bins_file_path,
+                pop_freq=args.pop_freq
+            )
+            parse_inference_script_output_and_write_to_csv(writer, n_run, inference_script_output)
+        else:
+            result = infer(
+                coalescence_times=args.inference_script_coalescence_times_filename,
+                ancient_gls=ancient_gls,
+                inference_output_filename=inference_script_output_filename,
+                time_bins=args.inference_script_time_bins_file_path,
+                pop_freq=args.pop_freq,
+                trans_cache=trans_cache,
+                z_tables=args.inference_z_tables
+            )
+            write_inference_result_to_csv(writer, n_run, result)
 
         plot(
             mssel_traj_file_path=step_script_output_file_path,
@@ -0,0 +1,240 @@
+'''
+Long-lived inference.py: reads one JSON request per line and writes one JSON
+response per line, so sweeps pay interpreter start-up, kernel loading and
+transition matrix construction once instead of once per run.
+
+    python3 clues_server.py [--socket PATH] [--threads J] [--transCacheMB MB]
+
+Requests hold inference.py options under their long names (without dashes):
+
+    {"id": 1, "times": "example/example", "timeBins": "example/timeBins.txt", "popFreq": 0.2}
+    {"id": 2, "ancientSamps": "anc.txt", "df": 30, "posterior": "full", "out": "run2"}
+
+and are answered with
+
+    {"id": 1, "logLR": ..., "timeBins": [...], "mle": [...], "epochs": [...], "freqs": [...], "meanFreq": [...]}
+
+meanFreq is the posterior mean frequency in each epoch; "posterior": "full" also
+returns the posterior probabilities (freqs x epochs) and "none" neither. With
+--sGrid the response has "sGrid" and "surface"; with --out the usual .npy files
+are written as well. Failed requests are answered with {"id": ..., "error": ...}.
+{"cmd": "stats"} reports the transition caches, {"cmd": "shutdown"} stops the server.
+
+--threads and --transCacheMB are server options: requests share one thread pool
+and one transition cache (per --zTables). --batch and --bootstrap are not served.
+
+Without --socket the server talks over stdin/stdout (InferenceClient below starts
+one as a subprocess); with --socket it listens on a Unix socket and serves one
+connection at a time.
+'''
+import argparse
+import contextlib
+import io
+import json
+import os
+import socketserver
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import inference
+from trans_cache import TransCache
+
+
+class InferenceServer:
+    def __init__(self,threads=1,transCacheMB=1024):
+        self.maxCacheBytes = int(transCacheMB*2**20)
+        self.pool = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        # one cache per z tables, as the cached matrices depend on them
+        self.transCaches = {}
+        self.running = True
+
+    def _trans_cache(self,zTables):
+        if self.maxCacheBytes <= 0:
+            return None
+        if zTables not in self.transCaches:
+            self.transCaches[zTables] = TransCache(*inference.load_normal_tables(zTables),maxBytes=self.maxCacheBytes)
+        return self.transCaches[zTables]
+
+    def parse_request(self,request):
+        argv = []
+        for key,value in request.items():
+            if key in ('id','cmd','posterior'):
+                continue
+            if key in ('batch','bootstrap','timesList'):
+                raise ValueError('--%s is not supported by the server'%(key))
+            if value is None or value is False:
+                continue
+            argv.append('--'+key)
+            if value is True:
+                continue
+            argv += [str(v) for v in value] if isinstance(value,list) else [str(value)]
+        err = io.StringIO()
+        try:
+            with contextlib.redirect_stderr(err):
+                args = inference.parse_args(argv)
+        except SystemExit:
+            raise ValueError(err.getvalue().strip().split('\n')[-1])
+        if args.times == None and args.ancientSamps == None and args.ancientHaps == None:
+            raise ValueError('need times and/or ancientSamps and/or ancientHaps')
+        # server-wide: the model gets the server's pool and cache instead
+        args.threads = 1
+        args.transCacheMB = 0
+        return args
+
+    def infer(self,request):
+        args = self.parse_request(request)
+        posterior = request.get('posterior','mean')
+        if posterior not in ('none','mean','full'):
+            raise ValueError('posterior must be none, mean or full')
+        model = inference.ClueModel.from_args(args,self._trans_cache(args.zTables),self.pool)
+        epochs,freqs = model.epochs,model.freqs
+
+        S,logLR = model.fit(args.optimizer)
+        response = {'logLR':float(logLR),'timeBins':model.timeBins.tolist(),'mle':S.tolist()}
+        post = None
+        if posterior != 'none' or args.out != None:
+            post = model.posterior(S)
+        if posterior != 'none':
+            probs = np.exp(post)
+            response['epochs'] = epochs[:probs.shape[1]].tolist()
+            response['freqs'] = freqs.tolist()
+            response['meanFreq'] = np.dot(freqs,probs).tolist()
+            if posterior == 'full':
+                response['posterior'] = probs.tolist()
+        surface = None
+        if args.sGrid != None:
+            surface = model.surface(np.linspace(args.sGrid[0],args.sGrid[1],int(args.sGrid[2])))
+            response['sGrid'] = surface[0].tolist()
+            response['surface'] = surface[1].tolist()
+        if args.out != None:
+            inference.out(args,epochs,freqs,post,surface)
+        return response
+
+    def stats(self):
+        return {'transCaches':{str(k):c.stats() for k,c in self.transCaches.items()}}
+
+    def handle(self,line):
+        # one request line -> one response line
+        try:
+            request = json.loads(line)
+            if not isinstance(request,dict):
+                raise ValueError('request must be a JSON object')
+        except ValueError as e:
+            return json.dumps({'error':'bad request: %s'%(e)})
+        response = {'id':request.get('id')}
+        cmd = request.get('cmd','infer')
+        # inference.py reports progress on stdout, which may be the response stream
+        log = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(log):
+                if cmd == 'infer':
+                    response.update(self.infer(request))
+                elif cmd == 'stats':
+                    response.update(self.stats())
+                elif cmd == 'shutdown':
+                    self.running = False
+                else:
+                    raise ValueError('unknown cmd %s'%(cmd))
+        except SystemExit:
+            # inference.py prints a message and exits on unreadable input
+            lines = log.getvalue().strip().split('\n')
+            response['error'] = lines[-1] if lines[-1] != '' else 'failed to load input'
+        except Exception as e:
+            response['error'] = '%s: %s'%(type(e).__name__,e)
+        return json.dumps(response)
+
+    def serve(self,infile,outfile):
+        for line in infile:
+            if line.strip() == '':
+                continue
+            outfile.write(self.handle(line)+'\n')
+            outfile.flush()
+            if not self.running:
+                break
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+def serve_socket(server,path):
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                line = line.decode()
+                if line.strip() == '':
+                    continue
+                self.wfile.write((server.handle(line)+'\n').encode())
+                self.wfile.flush()
+                if not server.running:
+                    break
+
+    if os.path.exists(path):
+        os.remove(path)
+    with socketserver.UnixStreamServer(path,Handler) as sock:
+        while server.running:
+            sock.handle_request()
+    os.remove(path)
+
+
+class InferenceClient:
+    '''
+    Starts clues_server.py as a subprocess and sends it requests, e.g.
+
+        with InferenceClient() as clues:
+            res = clues.infer(times='example/example',popFreq=0.2)
+    '''
+
+    def __init__(self,threads=1,transCacheMB=1024,python=sys.executable):
+        server = os.path.join(os.path.dirname(os.path.abspath(__file__)),'clues_server.py')
+        self.proc = subprocess.Popen([python,server,'--threads',str(threads),'--transCacheMB',str(transCacheMB)],
+            stdin=subprocess.PIPE,stdout=subprocess.PIPE,text=True)
+        self.nextId = 0
+
+    def request(self,**request):
+        self.nextId += 1
+        request.setdefault('id',self.nextId)
+        self.proc.stdin.write(json.dumps(request)+'\n')
+        self.proc.stdin.flush()
+        response = json.loads(self.proc.stdout.readline())
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    def infer(self,**options):
+        return self.request(**options)
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.stdin.write(json.dumps({'cmd':'shutdown'})+'\n')
+            self.proc.stdin.close()
+            self.proc.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket',type=str,default=None,help='listen on this Unix socket instead of stdin/stdout')
+    parser.add_argument('-j','--threads',type=int,default=1,help='threads for the importance sampling loop over Relate samples')
+    parser.add_argument('--transCacheMB',type=float,default=1024,help='memory ceiling (MB) of each transition matrix cache kept across requests; 0 disables it')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    server = InferenceServer(args.threads,args.transCacheMB)
+    try:
+        if args.socket != None:
+            serve_socket(server,args.socket)
+        else:
+            server.serve(sys.stdin,sys.stdout)
+    finally:
+        server.close()
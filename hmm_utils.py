@@ -1,5 +1,47 @@
+import functools
+import inspect
+import math
+import os
+import zlib
+
+import numba
 import numpy as np
-from numba import njit 
+
+# kernels called from Python; build_kernels.py compiles these ahead of time into
+# the _hmm_kernels extension module
+AOT_KERNELS = ('proposal_density','forward_algorithm','backward_algorithm','backward_gradient',
+    'backward_likelihoods','genotype_likelihood_emissions','coal_buckets',
+    '_one_step_log_trans_prob','_nstep_log_trans_prob')
+
+def source_crc():
+    with open(__file__,'rb') as fp:
+        return zlib.crc32(fp.read())
+
+def _load_aot():
+    # the AOT module is used unless CLUES_JIT is set, or it was built from another hmm_utils.py
+    if os.environ.get('CLUES_JIT','') not in ('','0'):
+        return None
+    try:
+        import _hmm_kernels
+        if _hmm_kernels.source_crc() != source_crc():
+            return None
+    except (ImportError,OSError):
+        return None
+    return _hmm_kernels
+
+_aot = _load_aot()
+
+def njit(sig,**kwargs):
+    # with the AOT module loaded, the remaining kernels compile on first use
+    # instead of all of them being compiled (or loaded from cache) at import
+    if _aot is not None:
+        return numba.njit(**kwargs)
+    return numba.njit(sig,**kwargs)
+
+# transition engines for forward_algorithm/backward_algorithm
+TRANS_POWER = 0
+TRANS_STEPWISE = 1
+TRANS_BANDED = 2
 
 @njit('float64(float64[:])',cache=True)
 def _logsumexp(a):
@@ -31,6 +73,60 @@ def _log_phi(z):
 	logphi = -0.5 * np.log(2.0* np.pi) - 0.5 * z * z
 	return logphi
 
+@njit('float64(float64)',cache=True)
+def _log_ndtr(z):
+	# log Phi(z), to ~1e-15 relative in both tails
+	if z < -30.0:
+		# asymptotic series (erfc underflows past z ~ -38)
+		z2 = z*z
+		return -0.5*z2 - np.log(-z) - 0.5*np.log(2.0*np.pi) + np.log(1.0 - 1.0/z2 + 3.0/z2**2 - 15.0/z2**3 + 105.0/z2**4)
+	if z < 0.0:
+		return np.log(0.5*math.erfc(-z/np.sqrt(2.0)))
+	return np.log1p(-0.5*math.erfc(z/np.sqrt(2.0)))
+
+# The normal log-CDF/log-SF are computed directly when the z tables are empty
+# (the default, see inference.load_normal_tables), and interpolated otherwise.
+
+@njit('float64(float64,float64[:],float64[:])',cache=True)
+def _log_cdf(z,z_bins,z_logcdf):
+	if len(z_bins) == 0:
+		return _log_ndtr(z)
+	return np.interp(z,z_bins,z_logcdf)
+
+@njit('float64(float64,float64[:],float64[:])',cache=True)
+def _log_sf(z,z_bins,z_logsf):
+	if len(z_bins) == 0:
+		return _log_ndtr(-z)
+	return np.interp(z,z_bins,z_logsf)
+
+@njit('float64[:](float64[:],float64[:],float64[:])',cache=True)
+def _log_cdf_vec(z,z_bins,z_logcdf):
+	if len(z_bins) > 0:
+		return np.interp(z,z_bins,z_logcdf)
+	out = np.zeros(len(z))
+	for k in range(len(z)):
+		out[k] = _log_ndtr(z[k])
+	return out
+
+@njit('float64(float64,float64[:],float64[:])',cache=True)
+def _log_cdf_inv(logp,z_bins,z_logcdf):
+	# z with log Phi(z) = logp (-inf for logp = -inf)
+	if len(z_bins) > 0:
+		return np.interp(logp,z_logcdf,z_bins)
+	if logp == np.NINF:
+		return np.NINF
+	lo = -1.0
+	while _log_ndtr(lo) > logp:
+		lo *= 2
+	hi = lo/2 if lo < -1.0 else 40.0
+	for k in range(100):
+		mid = 0.5*(lo+hi)
+		if _log_ndtr(mid) > logp:
+			hi = mid
+		else:
+			lo = mid
+	return lo
+
 
 @njit('float64[:,:](float64[:,:],float64[:,:])',cache=True)
 def _log_prob_mat_mul(A,B):
@@ -81,19 +177,53 @@ def _log_matrix_power(X,n):
 
     return Y
 
-@njit('float64[:](int64,float64,float64,float64[:],float64[:],float64[:],float64[:],int64,float64)',cache=True)
-def _log_trans_prob(i,N,s,FREQS,z_bins,z_logcdf,z_logsf,dt,h):
-	# 1-generation transition prob based on Normal distn
-
-	p = FREQS[i]
+@njit('float64[:](float64[:])',cache=True)
+def _bin_edges(FREQS):
+	# edges of the middle bins of a transition row: bin j (0 < j < lf-1) covers
+	# (edges[j-1],edges[j]]; bins 0 and lf-1 take the tails below/above
 	lf = len(FREQS)
+	edges = np.zeros(lf-1)
+	edges[0] = FREQS[0]
+	for j in range(1,lf-2):
+		edges[j] = (FREQS[j]+FREQS[j+1])/2
+	edges[lf-2] = FREQS[lf-1]
+	return edges
+
+@njit('float64[:](float64[:])',cache=True)
+def _log_bin_diffs(L):
+	# log(Phi(hi) - Phi(lo)) for consecutive edges, from L = log Phi(edges), as
+	# _logsumexpb([lo,hi],[-1,1]) elementwise
+	m = np.maximum(L[:-1],L[1:])
+	return np.log(-np.exp(L[:-1]-m) + np.exp(L[1:]-m)) + m
+
+@njit('float64[:](float64,float64,float64[:],int64,int64,float64[:],float64[:],float64[:])',cache=True)
+def _log_bin_masses(mu,sigma,edges,lo,W,z_bins,z_logcdf,z_logsf):
+	# log mass of bins lo..lo+W-1 of a transition row under Normal(mu,sigma);
+	# edges from _bin_edges, the first and last bins take the tails
+	lf = len(edges)+1
+	out = np.zeros(W)
+	a = max(lo,1)
+	b = min(lo+W,lf-1)
+	if b > a:
+		# middle bin j covers (edges[j-1],edges[j]]
+		out[a-lo:b-lo] = _log_bin_diffs(_log_cdf_vec((edges[a-1:b]-mu)/sigma,z_bins,z_logcdf))
+	if lo == 0:
+		out[0] = _log_cdf((edges[0]-mu)/sigma,z_bins,z_logcdf)
+	if lo+W == lf:
+		out[W-1] = _log_sf((edges[lf-2]-mu)/sigma,z_bins,z_logsf)
+	return out
+
+@njit('float64[:](float64,float64,float64,float64[:],float64[:],float64[:],float64[:],int64,float64)',cache=True)
+def _log_trans_row(p,N,s,edges,z_bins,z_logcdf,z_logsf,dt,h):
+	# 1-generation transition prob based on Normal distn, from frequency p;
+	# edges from _bin_edges, interpolated against the z table in one call
+	lf = len(edges)+1
 	logP = np.NINF * np.ones(lf)
 
 	if p <= 0.0:
 		logP[0] = 0
 	elif p >= 1.0:
 		logP[lf-1] = 0
-		return logP
 	else:
 
 		if s != 0:
@@ -103,34 +233,7 @@ def _log_trans_prob(i,N,s,FREQS,z_bins,z_logcdf,z_logsf,dt,h):
 			mu = p
 
 		sigma = np.sqrt(p*(1.0-p)/(4.0*N)*dt)
-
-
-		pi0 = np.interp(np.array([(FREQS[0]-mu)/sigma]),z_bins,z_logcdf)[0]
-		pi1 = np.interp(np.array([(FREQS[lf-1]-mu)/sigma]),z_bins,z_logsf)[0]
-
-		x = np.array([0.0,pi0,pi1])
-		b = np.array([1.0,-1.0,-1.0])
-		middleNorm = _logsumexpb(x,b)
-
-		middleP = np.zeros(lf-2)
-		for j in range(1,lf-1):
-			if j == 1:
-				mlo = FREQS[0]
-			else:
-				mlo = np.mean(np.array([FREQS[j],FREQS[j-1]]))
-			if j == lf-2:
-				mhi = FREQS[j+1]
-			else:
-				mhi = np.mean(np.array([FREQS[j],FREQS[j+1]]))
-
-			l1 = np.interp(np.array([(mlo-mu)/sigma]),z_bins,z_logcdf)[0]
-			l2 = np.interp(np.array([(mhi-mu)/sigma]),z_bins,z_logcdf)[0]
-			middleP[j-1] = _logsumexpb(np.array([l1,l2]),np.array([-1.0,1.0]))
-
-
-		logP[0] = pi0
-		logP[1:lf-1] = middleP
-		logP[lf-1] = pi1
+		logP = _log_bin_masses(mu,sigma,edges,0,lf,z_bins,z_logcdf,z_logsf)
 
 	return logP
 
@@ -138,31 +241,270 @@ def _log_trans_prob(i,N,s,FREQS,z_bins,z_logcdf,z_logsf,dt,h):
 def _nstep_log_trans_prob(N,s,FREQS,z_bins,z_logcdf,z_logsf,dt,h):
 	lf = len(FREQS)
 	p1 = np.zeros((lf,lf))
+	edges = _bin_edges(FREQS)
 
 	# load rows into p1
 	for i in range(lf):
-		row = _log_trans_prob(i,N,s,FREQS,z_bins,z_logcdf,z_logsf,1,h)
+		row = _log_trans_row(FREQS[i],N,s,edges,z_bins,z_logcdf,z_logsf,1,h)
 		p1[i,:] = row
 
 	# exponentiate matrix
 	pn = _log_matrix_power(p1,int(dt))
 	return pn
 
-@njit('float64(float64[:],float64)')
-def _hap_genotype_likelihood_emission(ancGLs,p):
-    logGenoFreqs = np.array([np.log(1-p),np.log(p)])
-    emission = _logsumexp(logGenoFreqs + ancGLs)
-    if np.isnan(emission):
-        emission = -np.inf
-    return emission
-
-@njit('float64(float64[:],float64)')
-def _genotype_likelihood_emission(ancGLs,p):
-	logGenoFreqs = np.array([2*np.log(1-p),np.log(2) + np.log(p) + np.log(1-p),2*np.log(p)])
-	emission = _logsumexp(logGenoFreqs + ancGLs)
-	if np.isnan(emission):
-		emission = -np.inf
-	return emission
+@njit('float64[:,:](float64,float64,float64[:],float64[:],float64[:],float64[:],float64)',cache=True)
+def _one_step_log_trans_prob(N,s,FREQS,z_bins,z_logcdf,z_logsf,h):
+	# row-normalized 1-generation matrix; the dt-step matrix is never formed,
+	# instead this is applied dt times to alpha (see _log_trans_*_steps)
+	lf = len(FREQS)
+	p1 = np.zeros((lf,lf))
+	edges = _bin_edges(FREQS)
+	for i in range(lf):
+		row = _log_trans_row(FREQS[i],N,s,edges,z_bins,z_logcdf,z_logsf,1,h)
+		p1[i,:] = row - _logsumexp(row)
+	return p1
+
+@njit('Tuple((float64,float64))(float64,float64[:],float64[:])',cache=True)
+def _interp_ds(x,xp,fp):
+	# np.interp(x,xp,fp) and its derivative w.r.t. x (0 outside the table)
+	if x <= xp[0]:
+		return fp[0],0.0
+	if x >= xp[-1]:
+		return fp[-1],0.0
+	i = np.searchsorted(xp,x,side='right')-1
+	slope = (fp[i+1]-fp[i])/(xp[i+1]-xp[i])
+	return fp[i] + slope*(x-xp[i]),slope
+
+@njit('Tuple((float64,float64))(float64,float64[:],float64[:])',cache=True)
+def _log_cdf_ds(z,z_bins,z_logcdf):
+	# _log_cdf and its derivative w.r.t. z
+	if len(z_bins) == 0:
+		l = _log_ndtr(z)
+		return l,np.exp(_log_phi(z)-l)
+	return _interp_ds(z,z_bins,z_logcdf)
+
+@njit('Tuple((float64,float64))(float64,float64[:],float64[:])',cache=True)
+def _log_sf_ds(z,z_bins,z_logsf):
+	# _log_sf and its derivative w.r.t. z
+	if len(z_bins) == 0:
+		l = _log_ndtr(-z)
+		return l,-np.exp(_log_phi(z)-l)
+	return _interp_ds(z,z_bins,z_logsf)
+
+@njit('Tuple((float64[:],float64[:]))(float64[:],float64[:],float64[:])',cache=True)
+def _log_cdf_ds_vec(z,z_bins,z_logcdf):
+	# _log_cdf_vec and its derivative w.r.t. z
+	L = np.zeros(len(z))
+	dL = np.zeros(len(z))
+	for k in range(len(z)):
+		L[k],dL[k] = _log_cdf_ds(z[k],z_bins,z_logcdf)
+	return L,dL
+
+@njit('Tuple((float64[:],float64[:]))(float64,float64,float64,float64[:],float64[:],float64[:],float64[:],float64)',cache=True)
+def _log_trans_row_ds(p,N,s,edges,z_bins,z_logcdf,z_logsf,h):
+	# _log_trans_row (dt=1) and the derivative of each log entry w.r.t. s
+	lf = len(edges)+1
+	logP = np.NINF * np.ones(lf)
+	dlogP = np.zeros(lf)
+
+	if p <= 0.0:
+		logP[0] = 0
+		return logP,dlogP
+	elif p >= 1.0:
+		logP[lf-1] = 0
+		return logP,dlogP
+
+	mu = p - 2*s*p*(1.0-p)*(p+h*(1-2*p))
+	sigma = np.sqrt(p*(1.0-p)/(4.0*N))
+	# d/ds of z = (x-mu)/sigma, the same for every bin edge x
+	dz = 2*p*(1.0-p)*(p+h*(1-2*p))/sigma
+
+	L,dL = _log_cdf_ds_vec((edges-mu)/sigma,z_bins,z_logcdf)
+	logP[0] = L[0]
+	dlogP[0] = dL[0]*dz
+	logP[1:lf-1] = _log_bin_diffs(L)
+	# d log(e^hi - e^lo) = (e^hi dhi - e^lo dlo)/(e^hi - e^lo)
+	r = np.exp(L[:-1]-L[1:])
+	dlogP[1:lf-1] = np.where(logP[1:lf-1] > np.NINF,(dL[1:] - r*dL[:-1])*dz/(1.0 - r),0.0)
+	logP[lf-1],dlogP[lf-1] = _log_sf_ds((edges[lf-2]-mu)/sigma,z_bins,z_logsf)
+	dlogP[lf-1] *= dz
+
+	return logP,dlogP
+
+@njit('Tuple((float64[:,:],float64[:,:]))(float64,float64,float64[:],float64[:],float64[:],float64[:],float64)',cache=True)
+def _one_step_log_trans_prob_ds(N,s,FREQS,z_bins,z_logcdf,z_logsf,h):
+	# _one_step_log_trans_prob and the derivative of its (log) entries w.r.t. s
+	lf = len(FREQS)
+	p1 = np.zeros((lf,lf))
+	dp1 = np.zeros((lf,lf))
+	edges = _bin_edges(FREQS)
+	for i in range(lf):
+		row,drow = _log_trans_row_ds(FREQS[i],N,s,edges,z_bins,z_logcdf,z_logsf,h)
+		norm = _logsumexp(row)
+		p1[i,:] = row - norm
+		# derivative of the normalizer is the expectation of drow under the row
+		dp1[i,:] = drow - np.sum(np.exp(p1[i,:])*drow)
+	return p1,dp1
+
+@njit('Tuple((int64[:],float64[:,:]))(float64,float64,float64[:],float64[:],float64[:],float64[:],float64,float64)',cache=True)
+def _one_step_log_trans_band(N,s,FREQS,z_bins,z_logcdf,z_logsf,h,tol):
+	'''
+	Banded _one_step_log_trans_prob: row i holds P[i,lo[i]:lo[i]+W]. Only bins
+	overlapping mu +/- z*sigma are kept, where Phi(-z) = tol, so each row drops
+	at most 2*tol of mass before it is renormalized. Costs O(df*W), not O(df^2).
+	'''
+	lf = len(FREQS)
+	binEdges = _bin_edges(FREQS)
+	# bin j covers (edges[j],edges[j+1]], with the tails out to +/-inf
+	edges = np.zeros(lf+1)
+	edges[0] = -np.inf
+	edges[1:lf] = binEdges
+	edges[lf] = np.inf
+	zTol = -_log_cdf_inv(np.log(tol),z_bins,z_logcdf)
+
+	lo = np.zeros(lf,dtype=np.int64)
+	hi = np.zeros(lf,dtype=np.int64)
+	mus = np.zeros(lf)
+	sigmas = np.ones(lf)
+	for i in range(lf):
+		p = FREQS[i]
+		if p <= 0.0:
+			lo[i] = hi[i] = 0
+		elif p >= 1.0:
+			lo[i] = hi[i] = lf-1
+		else:
+			mus[i] = p - 2*s*p*(1.0-p)*(p+h*(1-2*p))
+			sigmas[i] = np.sqrt(p*(1.0-p)/(4.0*N))
+			lo[i] = max(np.searchsorted(edges,mus[i]-zTol*sigmas[i])-1,0)
+			hi[i] = min(np.searchsorted(edges,mus[i]+zTol*sigmas[i])-1,lf-1)
+	W = np.max(hi-lo)+1
+
+	band = np.NINF*np.ones((lf,W))
+	for i in range(lf):
+		# shift the window so that it fits; extra bins are computed exactly
+		lo[i] = min(lo[i],lf-W)
+		p = FREQS[i]
+		if p <= 0.0 or p >= 1.0:
+			band[i,(lf-1 if p >= 1.0 else 0)-lo[i]] = 0.0
+			continue
+		band[i,:] = _log_bin_masses(mus[i],sigmas[i],binEdges,lo[i],W,z_bins,z_logcdf,z_logsf)
+		band[i,:] -= _logsumexp(band[i,:])
+	return lo,band
+
+@njit('float64[:](float64[:],int64[:],float64[:,:],int64)',cache=True)
+def _log_band_backward_steps(alpha,lo,band,n):
+	# _log_trans_backward_steps for a banded matrix (see _one_step_log_trans_band)
+	lf = len(alpha)
+	W = band.shape[1]
+	out = np.copy(alpha)
+	for k in range(n):
+		m = np.NINF*np.ones(lf)
+		for i in range(lf):
+			for w in range(W):
+				m[lo[i]+w] = max(m[lo[i]+w],out[i]+band[i,w])
+		acc = np.zeros(lf)
+		for i in range(lf):
+			for w in range(W):
+				j = lo[i]+w
+				if m[j] > np.NINF:
+					acc[j] += np.exp(out[i]+band[i,w]-m[j])
+		for j in range(lf):
+			out[j] = np.log(acc[j]) + m[j] if m[j] > np.NINF else np.NINF
+	return out
+
+@njit('float64[:](float64[:],int64[:],float64[:,:],int64)',cache=True)
+def _log_band_forward_steps(alpha,lo,band,n):
+	# _log_trans_forward_steps for a banded matrix (see _one_step_log_trans_band)
+	lf = len(alpha)
+	out = np.copy(alpha)
+	tmp = np.zeros(lf)
+	for k in range(n):
+		for i in range(lf):
+			tmp[i] = _logsumexp(out[lo[i]:lo[i]+band.shape[1]] + band[i,:])
+			if np.isnan(tmp[i]):
+				tmp[i] = -np.inf
+		out[:] = tmp
+	return out
+
+@njit('float64[:](float64[:],float64[:,:],int64)',cache=True)
+def _log_trans_backward_steps(alpha,P,n):
+    # alpha <- alpha * exp(P), n times, in log space
+    lf = len(alpha)
+    PT = np.ascontiguousarray(P.T)
+    out = np.copy(alpha)
+    tmp = np.zeros(lf)
+    for k in range(n):
+        for i in range(lf):
+            tmp[i] = _logsumexp(out + PT[i,:])
+            if np.isnan(tmp[i]):
+                tmp[i] = -np.inf
+        out[:] = tmp
+    return out
+
+@njit('float64[:](float64[:],float64[:,:],int64)',cache=True)
+def _log_trans_forward_steps(alpha,P,n):
+    # alpha <- exp(P) * alpha, n times, in log space
+    lf = len(alpha)
+    out = np.copy(alpha)
+    tmp = np.zeros(lf)
+    for k in range(n):
+        for i in range(lf):
+            tmp[i] = _logsumexp(P[i,:] + out)
+            if np.isnan(tmp[i]):
+                tmp[i] = -np.inf
+        out[:] = tmp
+    return out
+
+@njit('float64[:,:](float64[:,:],float64[:,:])',cache=True)
+def _log_emission_rows(GLs,genoFreqs):
+    # log(sum_g exp(GLs[r,g]) * genoFreqs[g,j]) for all samples r, freq bins j
+    rowMax = np.zeros(GLs.shape[0])
+    for r in range(GLs.shape[0]):
+        rowMax[r] = np.max(GLs[r,:])
+    E = np.log(np.dot(np.exp(GLs - rowMax.reshape((-1,1))),np.ascontiguousarray(genoFreqs)))
+    E += rowMax.reshape((-1,1))
+    for r in range(E.shape[0]):
+        for j in range(E.shape[1]):
+            if np.isnan(E[r,j]):
+                E[r,j] = -np.inf
+    return E
+
+@njit('void(float64[:,:],float64[:],float64[:,:],float64[:,:])',cache=True)
+def _add_epoch_emissions(glEmissions,epochs,GLs,genoFreqs):
+    if GLs.shape[0] == 0:
+        return
+    E = _log_emission_rows(np.ascontiguousarray(GLs[:,1:]),genoFreqs)
+    # epoch tb holds times in (epochs[tb],epochs[tb+1]]
+    idx = np.searchsorted(epochs,GLs[:,0]) - 1
+    for r in range(GLs.shape[0]):
+        if idx[r] >= 0 and idx[r] < glEmissions.shape[0]:
+            glEmissions[idx[r],:] += E[r,:]
+
+@njit('float64[:,:](float64[:],float64[:],float64[:,:],float64[:,:])',cache=True)
+def genotype_likelihood_emissions(epochs,freqs,ancientGLs,ancientHapGLs):
+    '''
+    Log emission probs of all ancient samples, summed per epoch: row tb holds the
+    samples with epochs[tb] < time <= epochs[tb+1]. Does not depend on selection,
+    so compute once per dataset and pass to forward/backward_algorithm.
+
+    ancientGLs: rows (time, GL(0), GL(1), GL(2)) of diploid samples
+    ancientHapGLs: rows (time, GL(0), GL(1)) of haploid samples
+    '''
+    T = len(epochs)-1
+    lf = len(freqs)
+    glEmissions = np.zeros((T,lf))
+
+    genoFreqs = np.zeros((3,lf))
+    genoFreqs[0,:] = (1-freqs)**2
+    genoFreqs[1,:] = 2*freqs*(1-freqs)
+    genoFreqs[2,:] = freqs**2
+    hapFreqs = np.zeros((2,lf))
+    hapFreqs[0,:] = 1-freqs
+    hapFreqs[1,:] = freqs
+
+    _add_epoch_emissions(glEmissions,epochs,ancientGLs,genoFreqs)
+    _add_epoch_emissions(glEmissions,epochs,ancientHapGLs,hapFreqs)
+    return glEmissions
 
 @njit('float64(float64[:],int64,float64[:],float64,float64,float64,int64)',cache=True)
 def _log_coal_density(times,n,epoch,xi,Ni,N0,anc=0):
@@ -190,11 +532,121 @@ def _log_coal_density(times,n,epoch,xi,Ni,N0,anc=0):
     logp += logPk
     return logp
 
-@njit('float64[:,:](float64[:],float64[:,:],float64[:],float64[:],float64[:],float64[:],float64[:],float64[:],float64[:,:],float64[:,:],float64[:],int64,float64)',cache=True)
-def forward_algorithm(sel,times,epochs,N,freqs,z_bins,z_logcdf,z_logsf,ancientGLs,ancientHapGLs,changePts,noCoals=1,h=0.5):
+@njit('Tuple((float64[:],float64))(float64[:],float64[:,::1],int64,float64[:])',cache=True)
+def _scaled_forward_step(linAlpha,expTrans,n,emissions):
+    # linear-space forward step; returns rescaled alpha (sums to 1) and log of the scale
+    emMax = np.max(emissions)
+    v = linAlpha * np.exp(emissions - emMax)
+    for k in range(n):
+        v = np.dot(expTrans,v)
+    c = np.sum(v)
+    if not c > 0:
+        return np.zeros(len(v)), -np.inf
+    return v/c, np.log(c) + emMax
+
+@njit('Tuple((float64[:],float64))(float64[:],float64[:,::1],int64,float64[:])',cache=True)
+def _scaled_backward_step(linAlpha,expTrans,n,emissions):
+    # linear-space backward step; returns rescaled alpha (sums to 1) and log of the scale
+    emMax = np.max(emissions)
+    v = np.copy(linAlpha)
+    for k in range(n):
+        v = np.dot(v,expTrans)
+    v *= np.exp(emissions - emMax)
+    c = np.sum(v)
+    if not c > 0:
+        return np.zeros(len(v)), -np.inf
+    return v/c, np.log(c) + emMax
+
+@njit('Tuple((float64[:],float64))(float64[:],int64[:],float64[:,::1],int64,float64[:])',cache=True)
+def _scaled_band_forward_step(linAlpha,lo,expBand,n,emissions):
+    # _scaled_forward_step for a banded matrix
+    emMax = np.max(emissions)
+    v = linAlpha * np.exp(emissions - emMax)
+    W = expBand.shape[1]
+    for k in range(n):
+        u = np.zeros(len(v))
+        for i in range(len(v)):
+            u[i] = np.dot(expBand[i,:],v[lo[i]:lo[i]+W])
+        v = u
+    c = np.sum(v)
+    if not c > 0:
+        return np.zeros(len(v)), -np.inf
+    return v/c, np.log(c) + emMax
+
+@njit('Tuple((float64[:],float64))(float64[:],int64[:],float64[:,::1],int64,float64[:])',cache=True)
+def _scaled_band_backward_step(linAlpha,lo,expBand,n,emissions):
+    # _scaled_backward_step for a banded matrix
+    emMax = np.max(emissions)
+    v = np.copy(linAlpha)
+    W = expBand.shape[1]
+    for k in range(n):
+        u = np.zeros(len(v))
+        for i in range(len(v)):
+            u[lo[i]:lo[i]+W] += v[i]*expBand[i,:]
+        v = u
+    v *= np.exp(emissions - emMax)
+    c = np.sum(v)
+    if not c > 0:
+        return np.zeros(len(v)), -np.inf
+    return v/c, np.log(c) + emMax
+
+@njit('Tuple((int64,float64))(float64[:],int64,float64[:])',cache=True)
+def _coal_epoch_stats(times,n,epoch):
+    # number of coalescences in the epoch and sum_k k(k-1)/4 * (time spent with
+    # k lineages); _log_coal_density is -m*log(xi) - W/(xi*Ni) in terms of these
+    W = 0.0
+    prevt = epoch[0]
+    for i in range(len(times)):
+        k = n-i
+        W += k*(k-1)/4*(times[i]-prevt)
+        prevt = times[i]
+    k = n-len(times)
+    W += k*(k-1)/4*(epoch[1]-prevt)
+    return len(times),W
+
+@njit('float64[:](int64,float64,int64,float64[:],float64)',cache=True)
+def _log_coal_densities(m,W,n,xi,Ni):
+    # _log_coal_density for all frequency bins xi at once
+    if n == 1:
+        # this flag indicates to ignore coalescence
+        return np.zeros(len(xi))
+    return -m*np.log(xi) - W/(xi*Ni)
+
+@njit('Tuple((float64[:,:],int64[:,:]))(float64[:,:],float64[:])',cache=True)
+def coal_buckets(times,epochs):
+    '''
+    Sorts each row of times (der, anc; -1 = padding) and finds the offsets of the
+    epochs in it: the coalescences in epoch tb, (epochs[tb],epochs[tb+1]], are
+    sortedTimes[r,offsets[r,tb]:offsets[r,tb+1]].
+    '''
+    sortedTimes = np.zeros(times.shape)
+    offsets = np.zeros((times.shape[0],len(epochs)),dtype=np.int64)
+    for r in range(times.shape[0]):
+        sortedTimes[r,:] = np.sort(times[r,:])
+        offsets[r,:] = np.searchsorted(sortedTimes[r,:],epochs,side='right')
+    return sortedTimes,offsets
+
+@njit('float64[:,:](float64[:],float64[:,:],int64[:,:],float64[:],float64[:],float64[:],float64[:],float64[:],float64[:],float64[:,:],float64[:],int64,float64,int64,int64,float64[:,:,::1],int64[:],float64)',cache=True,nogil=True)
+def forward_algorithm(sel,times,coalOffsets,epochs,N,freqs,z_bins,z_logcdf,z_logsf,glEmissionMat,changePts,noCoals,h,transMode,scaled,transMats,transIdx,bandTol):
 
     '''
     Moves forward in time from past to present
+
+    times, coalOffsets: sorted coalescence times and their epoch offsets (see coal_buckets)
+    glEmissionMat: ancient sample emissions per epoch (see genotype_likelihood_emissions)
+    transMode: TRANS_POWER (dt-step matrix by repeated squaring),
+               TRANS_STEPWISE (1-step matrix applied dt times to alpha) or
+               TRANS_BANDED (as stepwise, with the 1-step matrix truncated to
+               bins holding more than bandTol of each row's mass; see
+               _one_step_log_trans_band)
+    scaled: if nonzero, propagate alpha in linear space (BLAS mat-vec against
+            exp(trans)) with a per-epoch log normalizer instead of logsumexp;
+            the returned (log) alphaMat is the same, except that entries more
+            than ~700 log-units below the epoch's maximum underflow to -inf
+    transMats, transIdx: precomputed transition matrices for transMode and
+            the row of transMats to use at each epoch (see trans_cache.py);
+            if transIdx is empty, matrices are built here as needed
+            (TRANS_BANDED always builds its own)
     '''
 
     lf = len(freqs)
@@ -233,6 +685,12 @@ def forward_algorithm(sel,times,epochs,N,freqs,z_bins,z_logcdf,z_logsf,ancientGL
     N0 = N[0]
 
     cpTrans = np.ones((lf,lf))*1/lf
+    bandLo = np.zeros(lf,dtype=np.int64)
+    band = np.zeros((lf,1))
+    expBand = np.zeros((lf,1))
+    expTrans = np.exp(cpTrans)
+    linAlpha = np.exp(alpha)
+    logNorm = 0.0
     for tb in range(T-1,0,-1):
         #print('F',tb,alpha[::24])
         dt = -epochs[tb]+epochs[tb+1]
@@ -245,52 +703,65 @@ def forward_algorithm(sel,times,epochs,N,freqs,z_bins,z_logcdf,z_logsf,ancientGL
         if np.sum(tb==changePts) != 0:
             #changePts
             currTrans = cpTrans
+            if scaled:
+                expTrans = np.exp(currTrans)
 
         elif prevNt != Nt or prevst != st or prevdt != dt or np.sum(tb+1==changePts) != 0:
             #change in selection/popsize, recalc trans prob
-            currTrans = _nstep_log_trans_prob(Nt,st,freqs,z_bins,z_logcdf,z_logsf,dt,h)
-
-        #grab ancient GL rows
-        ancientGLrows = ancientGLs[np.logical_and(ancientGLs[:,0] <= cumGens, ancientGLs[:,0] > cumGens - dt)]
-        ancientHapGLrows = ancientHapGLs[np.logical_and(ancientHapGLs[:,0] <= cumGens, ancientHapGLs[:,0] > cumGens - dt)]
-
-        # calculate ancient GL emission probs
-        glEmissions = np.zeros(lf)
-
-        for j in range(lf):
-            for iac in range(ancientGLrows.shape[0]):
-                glEmissions[j] += _genotype_likelihood_emission(ancientGLrows[iac,1:],freqs[j])
-            for iac in range(ancientHapGLrows.shape[0]):
-                glEmissions[j] += _hap_genotype_likelihood_emission(ancientHapGLrows[iac,1:],freqs[j])
+            if transMode == TRANS_BANDED:
+                bandLo,band = _one_step_log_trans_band(Nt,st,freqs,z_bins,z_logcdf,z_logsf,h,bandTol)
+                if scaled:
+                    expBand = np.exp(band)
+            else:
+                if len(transIdx) > 0:
+                    currTrans = transMats[transIdx[tb]]
+                elif transMode == TRANS_STEPWISE:
+                    currTrans = _one_step_log_trans_prob(Nt,st,freqs,z_bins,z_logcdf,z_logsf,h)
+                else:
+                    currTrans = _nstep_log_trans_prob(Nt,st,freqs,z_bins,z_logcdf,z_logsf,dt,h)
+                if scaled:
+                    expTrans = np.exp(currTrans)
+
+        # ancient GL emission probs
+        glEmissions = glEmissionMat[tb,:]
 
         # calculate coal emission probs
 
         if noCoals:
             coalEmissions = np.zeros(lf)
         else:
-            derCoals = np.copy(times[0,:])
-            derCoals = derCoals[derCoals <= cumGens]
-            derCoals = derCoals[derCoals > cumGens-dt]
+            derCoals = times[0,coalOffsets[0,tb]:coalOffsets[0,tb+1]]
             numDerCoals = len(derCoals)
-            ancCoals = np.copy(times[1,:])
-            ancCoals = ancCoals[ancCoals <= cumGens]
-            ancCoals = ancCoals[ancCoals > cumGens-dt]
+            ancCoals = times[1,coalOffsets[1,tb]:coalOffsets[1,tb+1]]
             numAncCoals = len(ancCoals)
             nDerRemaining += len(derCoals)
             nAncRemaining += len(ancCoals)
             #print(epoch,derCoals,nDerRemaining,nAncRemaining)
             #if prevNt != Nt or prevst != st or prevdt != dt or numDerCoals != 0 or prevNumAncCoals != 0 or numAncCoals != 0 or prevNumAncCoals != 0:
                 #print(cumGens)
-            for j in range(lf):
-                    coalEmissions[j] = _log_coal_density(derCoals,nDerRemaining,epoch,freqs[j],Nt,N0,anc=0)
-                    coalEmissions[j] += _log_coal_density(ancCoals,nAncRemaining,epoch,freqs[j],Nt,N0,anc=1)
-
-
-        #print(tb,ancientGLrows)
-        for i in range(lf):
-            alpha[i] = _logsumexp(prevAlpha + currTrans[i,:] + glEmissions + coalEmissions)
-            if np.isnan(alpha[i]):
-                alpha[i] = -np.inf
+            mDer,WDer = _coal_epoch_stats(derCoals,nDerRemaining,epoch)
+            mAnc,WAnc = _coal_epoch_stats(ancCoals,nAncRemaining,epoch)
+            coalEmissions = _log_coal_densities(mDer,WDer,nDerRemaining,freqs,Nt)
+            coalEmissions += _log_coal_densities(mAnc,WAnc,nAncRemaining,1.0-freqs,Nt)
+
+
+        if scaled:
+            if transMode == TRANS_BANDED and np.sum(tb==changePts) == 0:
+                linAlpha,logc = _scaled_band_forward_step(linAlpha,bandLo,expBand,int(dt),glEmissions + coalEmissions)
+            else:
+                nsteps = int(dt) if transMode == TRANS_STEPWISE and np.sum(tb==changePts) == 0 else 1
+                linAlpha,logc = _scaled_forward_step(linAlpha,expTrans,nsteps,glEmissions + coalEmissions)
+            logNorm += logc
+            alpha = np.log(linAlpha) + logNorm
+        elif transMode == TRANS_BANDED and np.sum(tb==changePts) == 0:
+            alpha = _log_band_forward_steps(prevAlpha + glEmissions + coalEmissions,bandLo,band,int(dt))
+        elif transMode == TRANS_STEPWISE and np.sum(tb==changePts) == 0:
+            alpha = _log_trans_forward_steps(prevAlpha + glEmissions + coalEmissions,currTrans,int(dt))
+        else:
+            for i in range(lf):
+                alpha[i] = _logsumexp(prevAlpha + currTrans[i,:] + glEmissions + coalEmissions)
+                if np.isnan(alpha[i]):
+                    alpha[i] = -np.inf
 
         prevNt = Nt
         prevdt = dt
@@ -301,11 +772,13 @@ def forward_algorithm(sel,times,epochs,N,freqs,z_bins,z_logcdf,z_logsf,ancientGL
         alphaMat[tb,:] = alpha
     return alphaMat
 
-@njit('float64[:,:](float64[:],float64[:,:],float64[:],float64[:],float64[:],float64[:],float64[:],float64[:],float64[:,:],float64[:,:],float64[:],int64,float64,float64)',cache=True)
-def backward_algorithm(sel,times,epochs,N,freqs,z_bins,z_logcdf,z_logsf,ancientGLs,ancientHapGLs,changePts,noCoals=1,currFreq=-1,h=0.5):
+@njit('float64[:,:](float64[:],float64[:,:],int64[:,:],float64[:],float64[:],float64[:],float64[:],float64[:],float64[:],float64[:,:],float64[:],int64,float64,float64,int64,int64,float64[:,:,::1],int64[:],float64)',cache=True,nogil=True)
+def backward_algorithm(sel,times,coalOffsets,epochs,N,freqs,z_bins,z_logcdf,z_logsf,glEmissionMat,changePts,noCoals,currFreq,h,transMode,scaled,transMats,transIdx,bandTol):
 
     '''
     Moves backward in time from present to past
+
+    times, coalOffsets, glEmissionMat, transMode, scaled, transMats, transIdx, bandTol: see forward_algorithm
     '''
 
     lf = len(freqs)
@@ -336,6 +809,12 @@ def backward_algorithm(sel,times,epochs,N,freqs,z_bins,z_logcdf,z_logsf,ancientG
     N0 = N[0]
     coalEmissions = np.zeros(lf)
     cpTrans = np.ones((lf,lf))*1/lf
+    bandLo = np.zeros(lf,dtype=np.int64)
+    band = np.zeros((lf,1))
+    expBand = np.zeros((lf,1))
+    expTrans = np.exp(cpTrans)
+    logNorm = np.max(alpha)
+    linAlpha = np.exp(alpha - logNorm)
 
     for tb in range(0,T):
         #print('B',tb,alpha[::24])
@@ -347,24 +826,27 @@ def backward_algorithm(sel,times,epochs,N,freqs,z_bins,z_logcdf,z_logsf,ancientG
 
         if np.sum(tb==changePts) != 0:
             currTrans = cpTrans
+            if scaled:
+                expTrans = np.exp(currTrans)
 
         elif prevNt != Nt or prevst != st or prevdt != dt or np.sum(tb-1==changePts) != 0:
             #print(Nt,st,dt)
-            currTrans = _nstep_log_trans_prob(Nt,st,freqs,z_bins,z_logcdf,z_logsf,dt,h)
-
-        #grab ancient GL rows
-        ancientGLrows = ancientGLs[ancientGLs[:,0] > cumGens]
-        ancientGLrows = ancientGLrows[ancientGLrows[:,0] <= cumGens + dt]
-
-        ancientHapGLrows = ancientHapGLs[ancientHapGLs[:,0] > cumGens]
-        ancientHapGLrows = ancientHapGLrows[ancientHapGLrows[:,0] <= cumGens + dt]
-
-        glEmissions = np.zeros(lf)
-        for j in range(lf):
-            for iac in range(ancientGLrows.shape[0]):
-                glEmissions[j] += _genotype_likelihood_emission(ancientGLrows[iac,1:],freqs[j])
-            for iac in range(ancientHapGLrows.shape[0]):
-                glEmissions[j] += _hap_genotype_likelihood_emission(ancientHapGLrows[iac,1:],freqs[j])
+            if transMode == TRANS_BANDED:
+                bandLo,band = _one_step_log_trans_band(Nt,st,freqs,z_bins,z_logcdf,z_logsf,h,bandTol)
+                if scaled:
+                    expBand = np.exp(band)
+            else:
+                if len(transIdx) > 0:
+                    currTrans = transMats[transIdx[tb]]
+                elif transMode == TRANS_STEPWISE:
+                    currTrans = _one_step_log_trans_prob(Nt,st,freqs,z_bins,z_logcdf,z_logsf,h)
+                else:
+                    currTrans = _nstep_log_trans_prob(Nt,st,freqs,z_bins,z_logcdf,z_logsf,dt,h)
+                if scaled:
+                    expTrans = np.exp(currTrans)
+
+        # ancient GL emission probs
+        glEmissions = glEmissionMat[tb,:]
 
         #grab coal times during epoch
         # calculate coal emission probs
@@ -373,29 +855,38 @@ def backward_algorithm(sel,times,epochs,N,freqs,z_bins,z_logcdf,z_logsf,ancientG
             numAncCoals = -1
             numDerCoals = -1
         else:
-            derCoals = np.copy(times[0,:])
-            derCoals = derCoals[derCoals > cumGens]
-            derCoals = derCoals[derCoals <= cumGens+dt]
+            derCoals = times[0,coalOffsets[0,tb]:coalOffsets[0,tb+1]]
             numDerCoals = len(derCoals)
-            ancCoals = np.copy(times[1,:])
-            ancCoals = ancCoals[ancCoals > cumGens]
-            ancCoals = ancCoals[ancCoals <= cumGens+dt]
+            ancCoals = times[1,coalOffsets[1,tb]:coalOffsets[1,tb+1]]
             numAncCoals = len(ancCoals)
             #print(epoch,derCoals,nDerRemaining,nAncRemaining)
             #if prevNt != Nt or prevst != st or prevdt != dt or numDerCoals != 0 or prevNumAncCoals != 0 or numAncCoals != 0 or prevNumAncCoals != 0:
-            for j in range(lf):
-                    coalEmissions[j] = _log_coal_density(derCoals,nDerRemaining,epoch,freqs[j],Nt,N0,anc=0)
-                    coalEmissions[j] += _log_coal_density(ancCoals,nAncRemaining,epoch,freqs[j],Nt,N0,anc=1)
+            mDer,WDer = _coal_epoch_stats(derCoals,nDerRemaining,epoch)
+            mAnc,WAnc = _coal_epoch_stats(ancCoals,nAncRemaining,epoch)
+            coalEmissions = _log_coal_densities(mDer,WDer,nDerRemaining,freqs,Nt)
+            coalEmissions += _log_coal_densities(mAnc,WAnc,nAncRemaining,1.0-freqs,Nt)
             nDerRemaining -= len(derCoals)
             nAncRemaining -= len(ancCoals)
 
 
 
-        #print(tb,ancientGLrows)
-        for i in range(lf):
-            alpha[i] = _logsumexp(prevAlpha + currTrans[:,i] ) + glEmissions[i] + coalEmissions[i]
-            if np.isnan(alpha[i]):
-                alpha[i] = -np.inf
+        if scaled:
+            if transMode == TRANS_BANDED and np.sum(tb==changePts) == 0:
+                linAlpha,logc = _scaled_band_backward_step(linAlpha,bandLo,expBand,int(dt),glEmissions + coalEmissions)
+            else:
+                nsteps = int(dt) if transMode == TRANS_STEPWISE and np.sum(tb==changePts) == 0 else 1
+                linAlpha,logc = _scaled_backward_step(linAlpha,expTrans,nsteps,glEmissions + coalEmissions)
+            logNorm += logc
+            alpha = np.log(linAlpha) + logNorm
+        elif transMode == TRANS_BANDED and np.sum(tb==changePts) == 0:
+            alpha = _log_band_backward_steps(prevAlpha,bandLo,band,int(dt)) + glEmissions + coalEmissions
+        elif transMode == TRANS_STEPWISE and np.sum(tb==changePts) == 0:
+            alpha = _log_trans_backward_steps(prevAlpha,currTrans,int(dt)) + glEmissions + coalEmissions
+        else:
+            for i in range(lf):
+                alpha[i] = _logsumexp(prevAlpha + currTrans[:,i] ) + glEmissions[i] + coalEmissions[i]
+                if np.isnan(alpha[i]):
+                    alpha[i] = -np.inf
 
         prevNt = Nt
         prevdt = dt
@@ -407,7 +898,189 @@ def backward_algorithm(sel,times,epochs,N,freqs,z_bins,z_logcdf,z_logsf,ancientG
         alphaMat[tb,:] = alpha
     return alphaMat
 
-@njit('float64(float64[:,:],float64[:],float64[:])',cache=True)
+@njit('Tuple((float64,float64[:]))(float64[:],int64[:],int64,float64[:,:],int64[:,:],float64[:],float64[:],float64[:],float64[:],float64[:],float64[:],float64[:,:],float64[:],int64,float64,float64)',cache=True,nogil=True)
+def backward_gradient(sel,selIdx,K,times,coalOffsets,epochs,N,freqs,z_bins,z_logcdf,z_logsf,glEmissionMat,changePts,noCoals,currFreq,h):
+
+    '''
+    Log-likelihood of backward_algorithm (logsumexp of its last row) and its
+    gradient w.r.t. K selection coefficients, in a single backward pass.
+
+    sel[tb] = S[selIdx[tb]], or is held fixed where selIdx[tb] == -1. The
+    sensitivities d(alpha)/dS_k are carried along with alpha in scaled linear
+    space through the 1-generation transition, i.e. this differentiates the
+    --transMode stepwise likelihood (the same as power for --tSkip 1, and within
+    ~1e-6 of it otherwise). Costs about K+2 mat-vecs per generation.
+    '''
+
+    lf = len(freqs)
+    alpha = np.zeros(lf)
+    if currFreq != -1:
+        nsamp = 1000
+        for i in range(lf):
+            k = int(currFreq*nsamp)
+            alpha[i] = -np.sum(np.log(np.arange(2,k+1)))-np.sum(np.log(np.arange(2,nsamp-k+1)))+np.sum(np.log(np.arange(2,nsamp+1)))
+            alpha[i] += k*np.log(freqs[i]) + (nsamp-k)*np.log(1-freqs[i])
+
+    T = len(epochs)-1
+    prevNt = -1
+    prevst = -1
+    cumGens = 0
+
+    nDerRemaining = np.sum(times[0,:]>=0)+1
+    nAncRemaining = np.sum(times[1,:]>=0)+1
+    coalEmissions = np.zeros(lf)
+    expCp = np.exp(np.ones((lf,lf))*1/lf)
+    expTrans = expCp
+    dExpTrans = np.zeros((lf,lf))
+
+    logNorm = np.max(alpha)
+    linAlpha = np.exp(alpha - logNorm)
+    dAlpha = np.zeros((K,lf))
+
+    for tb in range(0,T):
+        dt = epochs[tb+1]-epochs[tb]
+        Nt = N[tb]
+        st = sel[tb]
+        k = selIdx[tb]
+        epoch = np.array([cumGens,cumGens+dt])
+
+        if np.sum(tb==changePts) != 0:
+            linAlpha = np.dot(linAlpha,expCp)
+            dAlpha = np.dot(dAlpha,expCp)
+            prevNt = -1
+        else:
+            if prevNt != Nt or prevst != st:
+                P,dP = _one_step_log_trans_prob_ds(Nt,st,freqs,z_bins,z_logcdf,z_logsf,h)
+                expTrans = np.exp(P)
+                dExpTrans = expTrans*dP
+                prevNt = Nt
+                prevst = st
+            for step in range(int(dt)):
+                dStep = np.dot(linAlpha,dExpTrans)
+                dAlpha = np.dot(dAlpha,expTrans)
+                if k >= 0:
+                    dAlpha[k,:] += dStep
+                linAlpha = np.dot(linAlpha,expTrans)
+
+        if noCoals:
+            coalEmissions = np.zeros(lf)
+        else:
+            derCoals = times[0,coalOffsets[0,tb]:coalOffsets[0,tb+1]]
+            ancCoals = times[1,coalOffsets[1,tb]:coalOffsets[1,tb+1]]
+            mDer,WDer = _coal_epoch_stats(derCoals,nDerRemaining,epoch)
+            mAnc,WAnc = _coal_epoch_stats(ancCoals,nAncRemaining,epoch)
+            coalEmissions = _log_coal_densities(mDer,WDer,nDerRemaining,freqs,Nt)
+            coalEmissions += _log_coal_densities(mAnc,WAnc,nAncRemaining,1.0-freqs,Nt)
+            nDerRemaining -= len(derCoals)
+            nAncRemaining -= len(ancCoals)
+
+        emissions = glEmissionMat[tb,:] + coalEmissions
+        emMax = np.max(emissions)
+        if emMax == np.NINF:
+            return np.NINF,np.zeros(K)
+        w = np.exp(emissions - emMax)
+        linAlpha = linAlpha*w
+        dAlpha = dAlpha*w
+        c = np.sum(linAlpha)
+        if not c > 0:
+            return np.NINF,np.zeros(K)
+        linAlpha = linAlpha/c
+        dAlpha = dAlpha/c
+        logNorm += np.log(c) + emMax
+
+        cumGens += dt
+
+    # d log(sum alpha) = sum(dAlpha)/sum(alpha), and alpha is normalized
+    return logNorm,np.sum(dAlpha,axis=1)
+
+@njit('float64[:](int64[:,:],float64[:,:,::1],float64[:,:],int64[:,:],float64[:],float64[:],float64[:],float64[:,:],float64[:],int64,float64,int64)',cache=True,nogil=True)
+def backward_likelihoods(transIdx,expTransMats,times,coalOffsets,epochs,N,freqs,glEmissionMat,changePts,noCoals,currFreq,transMode):
+
+    '''
+    Log-likelihoods (logsumexp of the last row of backward_algorithm) of C
+    selection candidates in one batched pass. Runs in scaled linear space
+    with alpha stored as a C x df matrix.
+
+    transIdx[c,tb]: row of expTransMats (exponentiated transition matrices, see
+    TransCache.transitions_grid) that candidate c uses in epoch tb. In each epoch,
+    candidates sharing a matrix are propagated with one mat-mat. Emissions do
+    not depend on selection, so they are computed once for all candidates.
+    '''
+
+    C = transIdx.shape[0]
+    lf = len(freqs)
+    alpha = np.zeros(lf)
+    if currFreq != -1:
+        nsamp = 1000
+        for i in range(lf):
+            k = int(currFreq*nsamp)
+            alpha[i] = -np.sum(np.log(np.arange(2,k+1)))-np.sum(np.log(np.arange(2,nsamp-k+1)))+np.sum(np.log(np.arange(2,nsamp+1)))
+            alpha[i] += k*np.log(freqs[i]) + (nsamp-k)*np.log(1-freqs[i])
+
+    T = len(epochs)-1
+    cumGens = 0
+    nDerRemaining = np.sum(times[0,:]>=0)+1
+    nAncRemaining = np.sum(times[1,:]>=0)+1
+    coalEmissions = np.zeros(lf)
+    expCp = np.exp(np.ones((lf,lf))*1/lf)
+
+    logNorm = np.max(alpha)*np.ones(C)
+    linAlpha = np.zeros((C,lf))
+    for c in range(C):
+        linAlpha[c,:] = np.exp(alpha - logNorm[c])
+
+    for tb in range(0,T):
+        dt = epochs[tb+1]-epochs[tb]
+        Nt = N[tb]
+        epoch = np.array([cumGens,cumGens+dt])
+
+        if np.sum(tb==changePts) != 0:
+            linAlpha = np.dot(linAlpha,expCp)
+        else:
+            nsteps = int(dt) if transMode == TRANS_STEPWISE else 1
+            mats = np.unique(transIdx[:,tb])
+            if len(mats) == 1:
+                for step in range(nsteps):
+                    linAlpha = np.dot(linAlpha,expTransMats[mats[0]])
+            else:
+                for k in mats:
+                    rows = np.nonzero(transIdx[:,tb]==k)[0]
+                    sub = linAlpha[rows,:]
+                    for step in range(nsteps):
+                        sub = np.dot(sub,expTransMats[k])
+                    linAlpha[rows,:] = sub
+
+        if noCoals:
+            coalEmissions = np.zeros(lf)
+        else:
+            derCoals = times[0,coalOffsets[0,tb]:coalOffsets[0,tb+1]]
+            ancCoals = times[1,coalOffsets[1,tb]:coalOffsets[1,tb+1]]
+            mDer,WDer = _coal_epoch_stats(derCoals,nDerRemaining,epoch)
+            mAnc,WAnc = _coal_epoch_stats(ancCoals,nAncRemaining,epoch)
+            coalEmissions = _log_coal_densities(mDer,WDer,nDerRemaining,freqs,Nt)
+            coalEmissions += _log_coal_densities(mAnc,WAnc,nAncRemaining,1.0-freqs,Nt)
+            nDerRemaining -= len(derCoals)
+            nAncRemaining -= len(ancCoals)
+
+        emissions = glEmissionMat[tb,:] + coalEmissions
+        emMax = np.max(emissions)
+        if emMax == np.NINF:
+            return np.NINF*np.ones(C)
+        w = np.exp(emissions - emMax)
+        for c in range(C):
+            linAlpha[c,:] *= w
+            s = np.sum(linAlpha[c,:])
+            if s > 0:
+                linAlpha[c,:] /= s
+                logNorm[c] += np.log(s) + emMax
+            else:
+                logNorm[c] = np.NINF
+
+        cumGens += dt
+
+    return logNorm
+
+@njit('float64(float64[:,:],float64[:],float64[:])',cache=True,nogil=True)
 def proposal_density(times,epochs,N):
     '''
     Moves backward in time from present to past
@@ -416,7 +1089,8 @@ def proposal_density(times,epochs,N):
     logl = 0.
     cumGens = 0
     T = len(epochs)-1
-    combinedTimes = np.sort(np.concatenate((times[0,:],times[1,:])))
+    combinedTimes,offsets = coal_buckets(np.concatenate((times[0,:],times[1,:])).reshape((1,-1)),epochs)
+    combinedTimes = combinedTimes[0,:]
     n = np.sum(combinedTimes>=0)+2
     nRemaining = n
     N0 = N[0]
@@ -428,9 +1102,7 @@ def proposal_density(times,epochs,N):
         #grab coal times during epoch
         # calculate coal emission probs
 
-        Coals = np.copy(combinedTimes)
-        Coals = Coals[Coals > cumGens]
-        Coals = Coals[Coals <= cumGens+dt]
+        Coals = combinedTimes[offsets[0,tb]:offsets[0,tb+1]]
         numCoals = len(Coals)
 
         logl += _log_coal_density(Coals,nRemaining,epoch,1.0,Nt,N0,anc=0)
@@ -438,3 +1110,18 @@ def proposal_density(times,epochs,N):
 
         cumGens += dt
     return logl
+
+def _aot_kernel(kernel,pyFunc):
+    # AOT functions only take positional arguments
+    sig = inspect.signature(pyFunc)
+    @functools.wraps(pyFunc)
+    def wrapper(*args,**kwargs):
+        if kwargs:
+            args = sig.bind(*args,**kwargs).args
+        return kernel(*args)
+    return wrapper
+
+# (only exported kernels call exported kernels, so nothing compiled later needs the dispatchers)
+if _aot is not None:
+    for _name in AOT_KERNELS:
+        globals()[_name] = _aot_kernel(getattr(_aot,_name),globals()[_name].py_func)
@@ -1,66 +1,90 @@
 import numpy as np
 from hmm_utils import forward_algorithm
 from hmm_utils import backward_algorithm
+from hmm_utils import backward_gradient
+from hmm_utils import backward_likelihoods
 from hmm_utils import proposal_density
+from hmm_utils import genotype_likelihood_emissions
+from hmm_utils import coal_buckets
+from hmm_utils import TRANS_POWER, TRANS_STEPWISE, TRANS_BANDED
+from trans_cache import TransCache
+from timeb_utils import TimebReader
+from bootstrap import bootstrap, print_ci_table
 from scipy.special import logsumexp
-import scipy.stats as stats
+from scipy.special import betaincinv
 from scipy.optimize import minimize
 import argparse
-import gzip
+import collections
+import functools
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# arguments of the likelihood wrappers after theta (ClueModel.minargs); a tuple, so
+# *minargs still unpacks into likelihood_wrapper & co.
+ModelArgs = collections.namedtuple('ModelArgs',['timeBins','N','freqs','z_bins','z_logcdf','z_logsf','glEmissions','epochs',
+	'noCoals','currFreq','h','sMax','changePts','transMode','scaled','transCache','pool','bandTol','coals'],
+	defaults=(TRANS_POWER,0,None,None,0.0,None))
 
 def parse_clues(filename,args):
-    with gzip.open(filename, 'rb') as fp:
-        try:
-            #parse file
-            data = fp.read()
-        except OSError:
-            with open(filename, 'rb') as fp:
-                try:
-                    #parse file
-                    data = fp.read()
-                except OSError:
-                    print('Error: Unable to open ' + filename)
-                    exit(1)
-
-        #get #mutations and #sampled trees per mutation
-        filepos = 0
-        num_muts, num_sampled_trees_per_mut = np.frombuffer(data[slice(filepos, filepos+8, 1)], dtype = np.int32)
-        #print(num_muts, num_sampled_trees_per_mut)
-
-        filepos += 8
-        #iterate over mutations
-        for m in range(0,num_muts):
-            bp = np.frombuffer(data[slice(filepos, filepos+4, 1)], dtype = np.int32)
-            filepos += 4
-            anc, der = np.frombuffer(data[slice(filepos, filepos+2, 1)], dtype = 'c')
-            filepos += 2
-            daf, n = np.frombuffer(data[slice(filepos, filepos+8, 1)], dtype = np.int32)
-            filepos += 8
-            #print("BP: %d, anc: %s, der %s, DAF: %d, n: %d" % (bp, str(anc), str(der), daf, n))
-
-
-            if daf >= n-1:
-            	anctimes = np.empty((num_sampled_trees_per_mut,0))
-            else:
-                num_anctimes = 4*(n-daf-1)*num_sampled_trees_per_mut
-                anctimes     = np.reshape(np.frombuffer(data[slice(filepos, filepos+num_anctimes, 1)], dtype = np.float32), (num_sampled_trees_per_mut, n-daf-1))
-                filepos     += num_anctimes
-
-            if daf <= 1:
-            	dertimes = np.empty((num_sampled_trees_per_mut,0))
-            else:
-                num_dertimes = 4*(daf-1)*num_sampled_trees_per_mut
-                dertimes     = np.reshape(np.frombuffer(data[slice(filepos, filepos+num_dertimes, 1)], dtype = np.float32), (num_sampled_trees_per_mut, daf-1))
-                filepos     += num_dertimes
-
-            if (args.A1 is not None) and (args.A1 != der.decode('ascii')):
-                tmp = np.copy(dertimes)
-                dertimes = np.copy(anctimes)
-                anctimes = tmp
-
+    # times of the last mutation in the file; with --batch, of the first one, which
+    # only sets up the model (batch_inference then goes through every mutation)
+    positions = clue_positions(args)
+    if args.batch == None and positions is not None and len(positions) > 1:
+        print('Error: --bp/--bpList select %d mutations; use --batch to analyze more than one'%(len(positions)))
+        sys.exit(1)
+    dertimes = anctimes = None
+    for bp,der,anc in iter_clues(filename,args):
+        dertimes,anctimes = der,anc
+        if args.batch != None:
+            break
+    if dertimes is None:
+        print('Error: no mutations to analyze in ' + filename)
+        sys.exit(1)
     return dertimes,anctimes
 
-def parse_args():
+def iter_clues(filename,args):
+    # yields (bp, dertimes, anctimes) for every mutation in a .timeb file
+    try:
+        reader = TimebReader(filename)
+    except OSError:
+        print('Error: Unable to open ' + filename)
+        sys.exit(1)
+
+    positions = clue_positions(args)
+    if positions is None:
+        records = reader
+    else:
+        records = []
+        for bp in positions:
+            try:
+                records.append(reader.get(bp))
+            except KeyError:
+                if args.batch == None:
+                    print('Error: bp %d not found in %s'%(bp,filename))
+                    sys.exit(1)
+                print('Warning: no mutation at bp %d in %s'%(bp,filename))
+
+    for bp,anc,der,anctimes,dertimes in records:
+        #print("BP: %d, anc: %s, der %s" % (bp, str(anc), str(der)))
+        if (args.A1 is not None) and (args.A1 != der.decode('ascii')):
+            tmp = dertimes
+            dertimes = anctimes
+            anctimes = tmp
+
+        yield bp,dertimes,anctimes
+
+def clue_positions(args):
+    # positions selected with --bp/--bpList, or None for every mutation
+    if args.bp == None and args.bpList == None:
+        return None
+    positions = [] if args.bp == None else list(args.bp)
+    if args.bpList != None:
+        positions += [int(bp) for bp in np.genfromtxt(args.bpList,dtype=np.int64,ndmin=1)]
+    return positions
+
+def parse_args(argv=None):
+	# argv: option list to parse instead of sys.argv (see clues_server.py)
 	parser = argparse.ArgumentParser()
 	parser.add_argument('--times',type=str,
 		help='Should refer to files <times>.{{der,anc}}.npy (exclude prefix .{{der,anc}}.npy)',
@@ -69,8 +93,16 @@ def parse_args():
 	parser.add_argument('-q','--quiet',action='store_true')
 	parser.add_argument('-o','--output',dest='outFile',type=str,default=None)
 
+	parser.add_argument('--batch',type=str,default=None,
+		help='Infer selection for every mutation in the --times/--timesList .timeb files and write a table (bp, logLR, MLE per epoch) to this path')
+	parser.add_argument('--timesList',type=str,default=None,help='File listing additional --times prefixes (one per line) for --batch')
+	parser.add_argument('--bp',type=int,nargs='+',default=None,
+		help='Position(s) of the mutation(s) to analyze in the .timeb file (default: last mutation, or all with --batch); more than one needs --batch. Uses a sidecar <file>.idx.npz index, written on first use.')
+	parser.add_argument('--bpList',type=str,default=None,help='File listing positions (one per line), as for --bp')
+
 	parser.add_argument('--ancientSamps',type=str,default=None)
 	parser.add_argument('--ancientHaps',type=str,default=None)
+	parser.add_argument('--mmapGLs',action='store_true',help='memory-map .npy --ancientSamps/--ancientHaps files instead of reading them into memory')
 	parser.add_argument('--out',type=str,default=None)
 
 	parser.add_argument('-N','--N',type=float,default=10**4)
@@ -90,19 +122,43 @@ def parse_args():
 	parser.add_argument('--tSkip',type=int,default=1)
 	parser.add_argument('--df',type=int,default=150)
 	parser.add_argument('--betaParam',type=float,default=0.5)
-	return parser.parse_args()
-
-
-def load_normal_tables():
-    # read in global Phi(z) lookups
-    z_bins = np.genfromtxt('utils/z_bins.txt')
-    z_logcdf = np.genfromtxt('utils/z_logcdf.txt')
-    z_logsf = np.genfromtxt('utils/z_logsf.txt')
+	parser.add_argument('--zTables',type=str,default=None,
+		help='directory with the z_bins/z_logcdf/z_logsf.txt tables of earlier versions, to interpolate log Phi(z) from instead of computing it')
+	parser.add_argument('--transMode',type=str,default='power',choices=['power','stepwise','banded'],
+		help='power: dt-step transition matrix by repeated squaring; stepwise: apply the 1-step matrix dt times (cheaper for small --tSkip / large --df); banded: stepwise with the 1-step matrix truncated to a band (see --bandTol); --sGrid surfaces are always computed with dense matrices, i.e. stepwise')
+	parser.add_argument('--bandTol',type=float,default=1e-12,help='--transMode banded drops transitions to bins with less than this probability (each row loses at most 2*bandTol of mass)')
+	parser.add_argument('--scaled',action='store_true',help='run forward/backward in scaled linear space (BLAS mat-vecs) instead of log space')
+	parser.add_argument('-j','--threads',type=int,default=1,help='threads for the importance sampling loop over Relate samples')
+	parser.add_argument('--sGrid',type=float,nargs=3,default=None,metavar=('START','STOP','NUM'),
+		help='also evaluate the logLR on np.linspace(START,STOP,NUM) in each time bin (all combinations); saved to <out>.surface.npy and <out>.sGrid.npy. Batched over all points, with dense transition matrices: with --transMode banded the surface is computed stepwise')
+	parser.add_argument('--bootstrap',type=int,default=0,metavar='B',
+		help='parametric bootstrap: simulate B ancient-sample datasets at the MLE and re-infer them; prints a CI table (ancient samples only)')
+	parser.add_argument('--bootstrapProcs',type=int,default=1,help='worker processes for --bootstrap')
+	parser.add_argument('--seed',type=int,default=0,help='seed of the --bootstrap replicates')
+	parser.add_argument('--warmStart',action='store_true',help='with --batch, start the optimizer at each locus from the MLE at the previous locus (same .timeb file); the usual start at s = 0 is only tried as well when the warm fit is below the neutral fit or under half the previous logLR')
+	parser.add_argument('--optimizer',type=str,default='Nelder-Mead',choices=['Nelder-Mead','L-BFGS-B'],
+		help='L-BFGS-B uses the analytic gradient of the likelihood, bounded by --sMax; the gradient is always of the stepwise likelihood (whatever --transMode), and the reported logLR is re-evaluated under --transMode. Falls back to Nelder-Mead where the surface is flat at the start (small --df)')
+	parser.add_argument('--transCacheMB',type=float,default=1024,help='memory ceiling (MB) of the transition matrix cache shared across likelihood evaluations; 0 disables it')
+	return parser.parse_args(argv)
+
+
+@functools.lru_cache(maxsize=None)
+def load_normal_tables(zTables=None):
+    # empty tables: the kernels compute log Phi(z) directly (hmm_utils._log_ndtr);
+    # otherwise read the legacy Phi(z) lookups from the zTables directory (once per process)
+    if zTables == None:
+        return np.zeros(0),np.zeros(0),np.zeros(0)
+    z_bins = np.genfromtxt(os.path.join(zTables,'z_bins.txt'))
+    z_logcdf = np.genfromtxt(os.path.join(zTables,'z_logcdf.txt'))
+    z_logsf = np.genfromtxt(os.path.join(zTables,'z_logsf.txt'))
     return z_bins,z_logcdf,z_logsf
 
 def load_times(args):
 	locusDerTimes,locusAncTimes = parse_clues(args.times+'.timeb',args)
 	print(locusDerTimes[0,:])
+	return locus_times(locusDerTimes,locusAncTimes,args)
+
+def locus_times(locusDerTimes,locusAncTimes,args):
 	if locusDerTimes.ndim == 0 or locusAncTimes.ndim == 0:
 		raise ValueError
 	#if np.prod(locusDerTimes.shape) == 0 or np.prod(locusAncTimes.shape) == 0:
@@ -137,7 +193,34 @@ def load_times(args):
 	locusTimes = np.array([row0,row1])
 	return locusTimes, n, m
 
-def load_data(args):
+def load_gls(filename,ncol,mmap=False):
+	'''
+	Genotype likelihoods (rows: time, GLs) from a text file, or from a binary
+	.npy file or .npz archive (array 'gls', or its only array). Binary files keep
+	the GLs at full precision and skip text parsing; with mmap, .npy files are
+	memory-mapped (copy-on-write, as the kernels take writable arrays).
+	'''
+	ext = os.path.splitext(filename)[1]
+	if ext not in ('.npy','.npz'):
+		return np.genfromtxt(filename,delimiter=' ')
+	try:
+		if ext == '.npy':
+			gls = np.load(filename,mmap_mode='c' if mmap else None)
+		else:
+			with np.load(filename) as f:
+				gls = f['gls'] if 'gls' in f.files or len(f.files) != 1 else f[f.files[0]]
+	except (OSError,KeyError,ValueError) as e:
+		print('Error: Unable to read %s (%s)'%(filename,e))
+		sys.exit(1)
+	if gls.ndim != 2 or gls.shape[1] != ncol:
+		print('Error: %s must hold a (samples x %d) array, not %s'%(filename,ncol,gls.shape))
+		sys.exit(1)
+	if gls.dtype != np.float64:
+		gls = gls.astype(np.float64)
+	return gls
+
+def load_data(args,ancientGLs=None,ancientHapGLs=None):
+	# ancientGLs/ancientHapGLs: arrays already in memory, used instead of --ancientSamps/--ancientHaps
 		# load coalescence times
 	noCoals = (args.times == None)
 	if not noCoals:
@@ -155,14 +238,18 @@ def load_data(args):
 		currFreq = x0
 
 	# load ancient samples/genotype likelihoods
-	if args.ancientSamps != None:
-		ancientGLs = np.genfromtxt(args.ancientSamps,delimiter=' ')
+	if ancientGLs is not None:
+		ancientGLs = np.asarray(ancientGLs,dtype=float)
+	elif args.ancientSamps != None:
+		ancientGLs = load_gls(args.ancientSamps,4,args.mmapGLs)
 	else:
 		ancientGLs = np.zeros((0,4))
 
 	# load ancient haploid genotype likelihoods
-	if args.ancientHaps != None:
-		ancientHapGLs = np.genfromtxt(args.ancientHaps,delimiter=' ')
+	if ancientHapGLs is not None:
+		ancientHapGLs = np.asarray(ancientHapGLs,dtype=float)
+	elif args.ancientHaps != None:
+		ancientHapGLs = load_gls(args.ancientHaps,3,args.mmapGLs)
 	else:
 		ancientHapGLs = np.zeros((0,3))
 
@@ -185,14 +272,15 @@ def load_data(args):
 		Ne = args.N * np.ones(int(tCutoff))
 
 	# load z tables
-	z_bins,z_logcdf,z_logsf = load_normal_tables()
+	z_bins,z_logcdf,z_logsf = load_normal_tables(args.zTables)
 
 	# set up freq bins
 	a=args.betaParam
 	b=a
 	c = 1/(2*np.min([Ne[0],100000]))
 	df = args.df
-	freqs = stats.beta.ppf(np.linspace(c,1-c,df),a,b)
+	# Beta(a,b) quantiles (as stats.beta.ppf, without importing scipy.stats at startup)
+	freqs = betaincinv(a,b,np.linspace(c,1-c,df))
 	# load time bins (for defining selection epochs)
 	if args.timeBins != None:
 		timeBins = np.genfromtxt(args.timeBins)
@@ -207,47 +295,269 @@ def load_data(args):
 
 	return timeBins,times,epochs,Ne,freqs,z_bins,z_logcdf,z_logsf,ancientGLs,ancientHapGLs,noCoals,currFreq,args.dom,changePts
 
-def likelihood_wrapper(theta,timeBins,N,freqs,z_bins,z_logcdf,z_logsf,ancGLs,ancHapGLs,gens,noCoals,currFreq,h,sMax,changePts):
+def bucket_coals(times,epochs,N):
+	# sort and bucket each importance sample's coalescence times by epoch, and
+	# evaluate its proposal density (which does not depend on selection), once
+	M = times.shape[2]
+	sortedTimes = np.zeros(times.shape)
+	coalOffsets = np.zeros((2,len(epochs),M),dtype=np.int64)
+	logl0s = np.zeros(M)
+	for i in range(M):
+		sortedTimes[:,:,i],coalOffsets[:,:,i] = coal_buckets(np.ascontiguousarray(times[:,:,i]),epochs)
+		logl0s[i] = proposal_density(sortedTimes[:,:,i],epochs,N)
+	return sortedTimes,coalOffsets,logl0s
+
+def coal_samples(coals,epochs):
+    # (times, coalOffsets, logl0s) from bucket_coals, or no Relate samples
+    if coals is None:
+        return bucket_coals(np.zeros((2,0,0)),epochs,None)
+    return coals
+
+def cached_transitions(transCache,sel,epochs,N,freqs,h,transMode):
+    if transCache is None or transMode == TRANS_BANDED:
+        # kernels build their own matrices
+        return np.zeros((0,0,0)),np.zeros(0,dtype=np.int64)
+    return transCache.transitions(sel,epochs,N,freqs,h,transMode)
+
+def parallel_map(pool,f,args):
+    # ordered map over importance samples; kernels release the GIL
+    if pool is None:
+        return map(f,args)
+    return pool.map(f,args)
+
+def likelihood_wrapper(theta,timeBins,N,freqs,z_bins,z_logcdf,z_logsf,glEmissions,epochs,noCoals,currFreq,h,sMax,changePts,transMode=TRANS_POWER,scaled=0,transCache=None,pool=None,bandTol=0.0,coals=None):
     S = theta
-    print(S)
     Sprime = np.concatenate((S,[0.0]))
     if np.any(np.abs(Sprime) > sMax):
         return np.inf
 
     sel = Sprime[np.digitize(epochs,timeBins,right=False)-1]
+    transMats,transIdx = cached_transitions(transCache,sel,epochs,N,freqs,h,transMode)
 
+    times,coalOffsets,logl0s = coal_samples(coals,epochs)
     tShape = times.shape
     if tShape[2] == 0:
     	t = np.zeros((2,0))
+    	tOffsets = np.zeros((2,len(epochs)),dtype=np.int64)
     	importanceSampling = False
     elif tShape[2] == 1:
     	t = times[:,:,0]
+    	tOffsets = coalOffsets[:,:,0]
     	importanceSampling = False
     else:
     	importanceSampling = True
 
     if importanceSampling:
     	M = tShape[2]
-    	loglrs = np.zeros(M)
-    	for i in range(M):
-    		betaMat = backward_algorithm(sel,times[:,:,i],epochs,N,freqs,z_bins,z_logcdf,z_logsf,ancGLs,ancHapGLs,changePts,noCoals=noCoals,currFreq=currFreq,h=h)
+    	def sample_loglr(i):
+    		betaMat = backward_algorithm(sel,times[:,:,i],coalOffsets[:,:,i],epochs,N,freqs,z_bins,z_logcdf,z_logsf,glEmissions,changePts,noCoals=noCoals,currFreq=currFreq,h=h,transMode=transMode,scaled=scaled,transMats=transMats,transIdx=transIdx,bandTol=bandTol)
     		logl = logsumexp(betaMat[-2,:])
-    		logl0 = proposal_density(times[:,:,i],epochs,N)
-    		loglrs[i] = logl-logl0
+    		logl0 = logl0s[i]
+    		return logl-logl0
+    	loglrs = np.array(list(parallel_map(pool,sample_loglr,range(M))))
     	logl = -1 * (-np.log(M) + logsumexp(loglrs))
     else:
-    	betaMat = backward_algorithm(sel,t,epochs,N,freqs,z_bins,z_logcdf,z_logsf,ancGLs,ancHapGLs,changePts,noCoals=noCoals,currFreq=currFreq,h=h)
+    	betaMat = backward_algorithm(sel,t,tOffsets,epochs,N,freqs,z_bins,z_logcdf,z_logsf,glEmissions,changePts,noCoals=noCoals,currFreq=currFreq,h=h,transMode=transMode,scaled=scaled,transMats=transMats,transIdx=transIdx,bandTol=bandTol)
     	logl = -logsumexp(betaMat[-2,:])
     #print(logl,S)
     return logl
 
-def out(args,epochs,freqs,post):
+def likelihood_grad_wrapper(theta,timeBins,N,freqs,z_bins,z_logcdf,z_logsf,glEmissions,epochs,noCoals,currFreq,h,sMax,changePts,transMode=TRANS_POWER,scaled=0,transCache=None,pool=None,bandTol=0.0,coals=None):
+    # likelihood_wrapper and its gradient, for gradient-based optimizers
+    # (transitions are always built stepwise, so transMode/scaled/transCache are unused)
+    S = theta
+    K = len(S)
+    Sprime = np.concatenate((S,[0.0]))
+    selIdx = np.digitize(epochs,timeBins,right=False)-1
+    sel = Sprime[selIdx]
+    # epochs past the last time bin have s = 0
+    selIdx = np.where(selIdx < K,selIdx,-1).astype(np.int64)
+
+    times,coalOffsets,logl0s = coal_samples(coals,epochs)
+    tShape = times.shape
+    if tShape[2] == 0:
+    	t = np.zeros((2,0))
+    	tOffsets = np.zeros((2,len(epochs)),dtype=np.int64)
+    	importanceSampling = False
+    elif tShape[2] == 1:
+    	t = times[:,:,0]
+    	tOffsets = coalOffsets[:,:,0]
+    	importanceSampling = False
+    else:
+    	importanceSampling = True
+
+    if importanceSampling:
+    	M = tShape[2]
+    	def sample_loglr(i):
+    		logl,grad = backward_gradient(sel,selIdx,K,times[:,:,i],coalOffsets[:,:,i],epochs,N,freqs,z_bins,z_logcdf,z_logsf,glEmissions,changePts,noCoals,currFreq,h)
+    		return logl-logl0s[i],grad
+    	loglrs,grads = zip(*parallel_map(pool,sample_loglr,range(M)))
+    	loglrs = np.array(loglrs)
+    	# gradient of the IS average: samples weighted by their likelihood ratio
+    	w = np.exp(loglrs - logsumexp(loglrs))
+    	logl = -1 * (-np.log(M) + logsumexp(loglrs))
+    	grad = -np.dot(w,np.array(grads))
+    else:
+    	logl,grad = backward_gradient(sel,selIdx,K,t,tOffsets,epochs,N,freqs,z_bins,z_logcdf,z_logsf,glEmissions,changePts,noCoals,currFreq,h)
+    	logl = -logl
+    	grad = -grad
+    return logl,grad
+
+def likelihood_grid(thetas,timeBins,N,freqs,z_bins,z_logcdf,z_logsf,glEmissions,epochs,noCoals,currFreq,h,sMax,changePts,transMode=TRANS_POWER,scaled=0,transCache=None,pool=None,bandTol=0.0,coals=None):
+    # likelihood_wrapper for every row of thetas (C x #time bins), batched over candidates
+    # (always in scaled linear space, see backward_likelihoods)
+    thetas = np.atleast_2d(thetas)
+    if transMode == TRANS_BANDED:
+        # the batched engine only has dense matrices: banded is evaluated as stepwise
+        # (the band only drops entries below bandTol)
+        transMode = TRANS_STEPWISE
+    C = thetas.shape[0]
+    Sprime = np.concatenate((thetas,np.zeros((C,1))),axis=1)
+    inRange = np.all(np.abs(Sprime) <= sMax,axis=1)
+    sels = Sprime[inRange][:,np.digitize(epochs,timeBins,right=False)-1]
+    if transCache is None:
+        # uncached builder
+        transCache = TransCache(z_bins,z_logcdf,z_logsf,maxBytes=0)
+    transMats,transIdx = transCache.transitions_grid(sels,epochs,N,freqs,h,transMode)
+    expTransMats = np.ascontiguousarray(np.exp(transMats))
+
+    times,coalOffsets,logl0s = coal_samples(coals,epochs)
+    tShape = times.shape
+    if tShape[2] == 0:
+    	t = np.zeros((2,0))
+    	tOffsets = np.zeros((2,len(epochs)),dtype=np.int64)
+    	importanceSampling = False
+    elif tShape[2] == 1:
+    	t = times[:,:,0]
+    	tOffsets = coalOffsets[:,:,0]
+    	importanceSampling = False
+    else:
+    	importanceSampling = True
+
+    logl = np.inf * np.ones(C)
+    if importanceSampling:
+    	M = tShape[2]
+    	def sample_loglr(i):
+    		return backward_likelihoods(transIdx,expTransMats,times[:,:,i],coalOffsets[:,:,i],epochs,N,freqs,glEmissions,changePts,noCoals,currFreq,transMode) - logl0s[i]
+    	loglrs = np.array(list(parallel_map(pool,sample_loglr,range(M))))
+    	logl[inRange] = -1 * (-np.log(M) + logsumexp(loglrs,axis=0))
+    else:
+    	logl[inRange] = -backward_likelihoods(transIdx,expTransMats,t,tOffsets,epochs,N,freqs,glEmissions,changePts,noCoals,currFreq,transMode)
+    return logl
+
+def likelihood_surface(sGrid,minargs,logL0):
+	# logLR (vs. s = 0) on sGrid (e.g. --sGrid START STOP NUM) in every selection time bin
+	timeBins = minargs.timeBins
+	K = len(timeBins)-1
+	thetas = np.array(np.meshgrid(*[sGrid]*K,indexing='ij')).reshape((K,-1)).T
+	surface = -likelihood_grid(thetas,*minargs) + logL0
+	return sGrid,surface.reshape((len(sGrid),)*K)
+
+def optimize_selection(minargs,optimizer='Nelder-Mead',x0=None,prevLogLR=None):
+	# x0: warm start (e.g. the MLE at the previous locus, with logLR prevLogLR). The cold
+	# start (s = 0) is only run if the warm fit looks stuck in a poor local optimum: below
+	# the neutral fit, or under half of prevLogLR
+	timeBins = minargs.timeBins
+	logL0 = likelihood_wrapper(0.0 * np.ones(len(timeBins)-1),*minargs)
+
+	print('Optimizing likelihood surface using %s...'%(optimizer))
+	M = coal_samples(minargs.coals,minargs.epochs)[0].shape[2]
+	if M > 1:
+		print('\t(Importance sampling with M = %d Relate samples)'%(M))
+		print()
+	warm = None
+	if x0 is not None:
+		warm = _minimize_from(minargs,optimizer,x0)
+		logLR = -warm.fun+logL0
+		if logLR >= 0 and (prevLogLR is None or logLR >= prevLogLR/2):
+			return warm,logL0
+	res = _minimize_from(minargs,optimizer)
+	if warm is not None and warm.fun < res.fun:
+		res = warm
+	return res,logL0
+
+def _minimize_from(minargs,optimizer,x0=None):
+	# one optimizer run; with x0 the simplex is centred on it
+	timeBins = minargs.timeBins
+	T = len(timeBins)
+	S0 = 0.0 * np.ones(T-1)
+	opts = {'xatol':1e-4}
+
+	if T == 2:
+		Simplex = np.reshape(np.array([-0.05,0.05]),(2,1))
+	elif T > 2:
+		Simplex = np.zeros((T,T-1))
+		for i in range(Simplex.shape[1]):
+			Simplex[i,:] = -0.01
+			Simplex[i,i] = 0.01
+		Simplex[-1,:] = 0.01
+	else:
+		raise ValueError
+
+	if x0 is not None:
+		Simplex = Simplex + x0
+	#bounds = tuple([(-0.05,0.05) for i in range(T-1)])
+	opts['initial_simplex']=Simplex
+
+	#for tup in product(*[[-1,1] for i in range(3)]):
+	if optimizer == 'L-BFGS-B':
+		sMax = minargs.sMax
+		res = minimize(likelihood_grad_wrapper,
+		         np.clip(S0 if x0 is None else x0,-sMax,sMax),
+		         args=minargs,
+		         jac=True,
+		         bounds=[(-sMax,sMax)]*(T-1),
+		         options={'ftol':1e-12,'gtol':1e-6},
+		         method='L-BFGS-B')
+		if res.nit > 0:
+			# the gradient is of the stepwise likelihood; report the fit under transMode
+			res.fun = likelihood_wrapper(res.x,*minargs)
+			return res
+		# coarse frequency grids make the surface flat (zero gradient) around the start,
+		# where L-BFGS-B cannot move; fall back to Nelder-Mead
+	res = minimize(likelihood_wrapper,
+	         S0,
+	         args=minargs,
+	         options=opts,
+	         #bounds=bounds,
+	        method='Nelder-Mead')
+	return res
+
+def batch_inference(args,model):
+	timeBins = model.timeBins
+	prefixes = [args.times]
+	if args.timesList != None:
+		prefixes += list(np.genfromtxt(args.timesList,dtype=str,ndmin=1))
+
+	with open(args.batch,'w') as f:
+		f.write('\t'.join(['times','bp','logLR']+['s_%d-%d'%(t,u) for t,u in zip(timeBins[:-1],timeBins[1:])])+'\n')
+		for prefix in prefixes:
+			# warm starts only carry over between neighbouring loci of one file
+			x0 = prevLogLR = None
+			for bp,locusDerTimes,locusAncTimes in iter_clues(prefix+'.timeb',args):
+				times,n,m = locus_times(locusDerTimes,locusAncTimes,args)
+				if args.popFreq == None:
+					currFreq = n/(n+m)
+				else:
+					currFreq = args.popFreq
+				model.set_times(times,currFreq)
+				S,logLR = model.fit(args.optimizer,x0,prevLogLR)
+				if args.warmStart:
+					x0,prevLogLR = S,logLR
+				f.write('\t'.join([prefix,str(bp),'%.4f'%(logLR)]+['%.5f'%(s) for s in S])+'\n')
+				f.flush()
+
+def out(args,epochs,freqs,post,surface=None):
 	np.save(args.out+'.epochs',epochs)
 	np.save(args.out+'.freqs',freqs)
 	np.save(args.out+'.post',post)
+	if surface is not None:
+		sGrid,logls = surface
+		np.save(args.out+'.sGrid',sGrid)
+		np.save(args.out+'.surface',logls)
 	return
 
-def traj_wrapper(theta,timeBins,N,freqs,z_bins,z_logcdf,z_logsf,ancGLs,ancHapGLs,gens,noCoals,currFreq,h,sMax,changePts):
+def traj_wrapper(theta,timeBins,N,freqs,z_bins,z_logcdf,z_logsf,glEmissions,epochs,noCoals,currFreq,h,sMax,changePts,transMode=TRANS_POWER,scaled=0,transCache=None,pool=None,bandTol=0.0,coals=None):
     S = theta
     Sprime = np.concatenate((S,[0.0]))
     if np.any(np.abs(Sprime) > sMax):
@@ -255,14 +565,18 @@ def traj_wrapper(theta,timeBins,N,freqs,z_bins,z_logcdf,z_logsf,ancGLs,ancHapGLs
         return np.inf
 
     sel = Sprime[np.digitize(epochs,timeBins,right=False)-1]
+    transMats,transIdx = cached_transitions(transCache,sel,epochs,N,freqs,h,transMode)
     T = len(epochs)
     F = len(freqs)
+    times,coalOffsets,logl0s = coal_samples(coals,epochs)
     tShape = times.shape
     if tShape[2] == 0:
     	t = np.zeros((2,0))
+    	tOffsets = np.zeros((2,len(epochs)),dtype=np.int64)
     	importanceSampling = False
     elif tShape[2] == 1:
     	t = times[:,:,0]
+    	tOffsets = coalOffsets[:,:,0]
     	importanceSampling = False
     else:
     	importanceSampling = True
@@ -271,24 +585,124 @@ def traj_wrapper(theta,timeBins,N,freqs,z_bins,z_logcdf,z_logsf,ancGLs,ancHapGLs
     	M = tShape[2]
     	loglrs = np.zeros(M)
     	postBySamples = np.zeros((F,T-1,M))
-    	for i in range(M):
-    		betaMat = backward_algorithm(sel,times[:,:,i],epochs,N,freqs,z_bins,z_logcdf,z_logsf,ancGLs,ancHapGLs,changePts,noCoals=noCoals,currFreq=currFreq,h=h)
-    		alphaMat = forward_algorithm(sel,times[:,:,i],epochs,N,freqs,z_bins,z_logcdf,z_logsf,ancGLs,ancHapGLs,changePts,noCoals=noCoals,h=h)
+    	def sample_post(i):
+    		betaMat = backward_algorithm(sel,times[:,:,i],coalOffsets[:,:,i],epochs,N,freqs,z_bins,z_logcdf,z_logsf,glEmissions,changePts,noCoals=noCoals,currFreq=currFreq,h=h,transMode=transMode,scaled=scaled,transMats=transMats,transIdx=transIdx,bandTol=bandTol)
+    		alphaMat = forward_algorithm(sel,times[:,:,i],coalOffsets[:,:,i],epochs,N,freqs,z_bins,z_logcdf,z_logsf,glEmissions,changePts,noCoals=noCoals,h=h,transMode=transMode,scaled=scaled,transMats=transMats,transIdx=transIdx,bandTol=bandTol)
     		logl = logsumexp(betaMat[-2,:])
-    		logl0 = proposal_density(times[:,:,i],epochs,N)
-    		loglrs[i] = logl-logl0
-    		postBySamples[:,:,i] = (alphaMat[1:,:] + betaMat[:-1,:]).transpose()
+    		logl0 = logl0s[i]
+    		return logl-logl0, (alphaMat[1:,:] + betaMat[:-1,:]).transpose()
+    	for i,(loglr,postSample) in enumerate(parallel_map(pool,sample_post,range(M))):
+    		loglrs[i] = loglr
+    		postBySamples[:,:,i] = postSample
     	post = logsumexp(loglrs + postBySamples,axis=2)
     	post -= logsumexp(post,axis=0)
 
     else:
     	post = np.zeros((F,T))
-    	betaMat = backward_algorithm(sel,t,epochs,N,freqs,z_bins,z_logcdf,z_logsf,ancGLs,ancHapGLs,changePts,noCoals=noCoals,currFreq=currFreq,h=h)
-    	alphaMat = forward_algorithm(sel,t,epochs,N,freqs,z_bins,z_logcdf,z_logsf,ancGLs,ancHapGLs,changePts,noCoals=noCoals,h=h)
+    	betaMat = backward_algorithm(sel,t,tOffsets,epochs,N,freqs,z_bins,z_logcdf,z_logsf,glEmissions,changePts,noCoals=noCoals,currFreq=currFreq,h=h,transMode=transMode,scaled=scaled,transMats=transMats,transIdx=transIdx,bandTol=bandTol)
+    	alphaMat = forward_algorithm(sel,t,tOffsets,epochs,N,freqs,z_bins,z_logcdf,z_logsf,glEmissions,changePts,noCoals=noCoals,h=h,transMode=transMode,scaled=scaled,transMats=transMats,transIdx=transIdx,bandTol=bandTol)
     	post = (alphaMat[1:,:] + betaMat[:-1,:]).transpose()
     	post -= logsumexp(post,axis=0)
     return post
 
+TRANS_MODES = {'power':TRANS_POWER,'stepwise':TRANS_STEPWISE,'banded':TRANS_BANDED}
+
+class ClueModel:
+	'''
+	Selection model of one locus. Built from the outputs of load_data; everything
+	that does not depend on the selection coefficients (emissions, bucketed
+	coalescence times and their proposal densities, the transition cache) is
+	computed once and reused by every call.
+
+	    model = ClueModel(*load_data(args))     # or ClueModel.from_args(args)
+	    S,logLR = model.fit()
+	    post = model.posterior()                # log P(freq bin), freqs x epochs, at the MLE
+	    model.loglik([0.01,0.0])                # one coefficient per time bin
+
+	N is the population size as returned by load_data (halved here, as for the
+	likelihood). set_times() swaps in another locus's coalescence times.
+	'''
+
+	def __init__(self,timeBins,times,epochs,N,freqs,z_bins,z_logcdf,z_logsf,ancientGLs,ancientHapGLs,noCoals,currFreq,h,changePts,
+			sMax=1.0,transMode=TRANS_POWER,scaled=False,bandTol=1e-12,transCache=None,maxCacheBytes=2**30,pool=None):
+		self.timeBins = timeBins
+		self.epochs = epochs
+		self.N = N/2
+		self.freqs = freqs
+		self.zTables = (z_bins,z_logcdf,z_logsf)
+		self.ancientGLs = ancientGLs
+		self.ancientHapGLs = ancientHapGLs
+		self.noCoals = int(noCoals)
+		self.h = h
+		self.changePts = changePts
+		self.sMax = sMax
+		self.transMode = transMode
+		self.scaled = int(scaled)
+		self.bandTol = bandTol
+		if transCache is None and maxCacheBytes > 0:
+			transCache = TransCache(z_bins,z_logcdf,z_logsf,maxBytes=maxCacheBytes)
+		self.transCache = transCache
+		self.pool = pool
+		self.glEmissions = genotype_likelihood_emissions(epochs,freqs,ancientGLs,ancientHapGLs)
+		self.set_times(times,currFreq)
+
+	@classmethod
+	def from_args(cls,args,transCache=None,pool=None,ancientGLs=None,ancientHapGLs=None):
+		# transCache/pool: shared ones (e.g. clues_server.py); otherwise from --transCacheMB/--threads
+		# ancientGLs/ancientHapGLs: in-memory GLs instead of --ancientSamps/--ancientHaps (see load_data)
+		if pool is None and args.threads > 1:
+			pool = ThreadPoolExecutor(max_workers=args.threads)
+		return cls(*load_data(args,ancientGLs,ancientHapGLs),sMax=args.sMax,transMode=TRANS_MODES[args.transMode],scaled=args.scaled,
+			bandTol=args.bandTol,transCache=transCache,maxCacheBytes=int(args.transCacheMB*2**20),pool=pool)
+
+	def set_times(self,times,currFreq):
+		# coalescence times (2 x n x M, as from locus_times) and present-day frequency of a locus
+		self.coals = bucket_coals(times,self.epochs,self.N)
+		self.currFreq = currFreq
+		self.mle = None
+
+	@property
+	def minargs(self):
+		# arguments of the likelihood wrappers after theta
+		return ModelArgs(self.timeBins,self.N,self.freqs,*self.zTables,self.glEmissions,self.epochs,self.noCoals,self.currFreq,self.h,self.sMax,
+			self.changePts,self.transMode,self.scaled,self.transCache,self.pool,self.bandTol,self.coals)
+
+	def loglik(self,S):
+		'''
+		Log-likelihood of S (one coefficient per time bin), or of every row of a
+		2-d S in one batched pass (likelihood_grid; stepwise if transMode is
+		banded). -inf outside [-sMax,sMax].
+		'''
+		S = np.asarray(S,dtype=float)
+		if S.ndim == 2:
+			return -likelihood_grid(S,*self.minargs)
+		return -likelihood_wrapper(S,*self.minargs)
+
+	def fit(self,optimizer='Nelder-Mead',x0=None,prevLogLR=None):
+		# returns the MLE and its log-likelihood ratio against s = 0
+		res,logL0 = optimize_selection(self.minargs,optimizer,x0,prevLogLR)
+		self.mle = res.x
+		self.logL0 = -logL0
+		self.logLR = -res.fun+logL0
+		return self.mle,self.logLR
+
+	def posterior(self,S=None):
+		# log posterior of the frequency bins (freqs x epochs) at S (default: the MLE)
+		if S is None:
+			if self.mle is None:
+				self.fit()
+			S = self.mle
+		return traj_wrapper(np.asarray(S,dtype=float),*self.minargs)
+
+	def surface(self,sGrid):
+		# logLR (vs. s = 0) on sGrid in every time bin, all combinations; s = 0 goes
+		# through the same batched engine as the grid
+		return likelihood_surface(sGrid,self.minargs,-self.loglik(np.zeros((1,len(self.timeBins)-1)))[0])
+
+	def close(self):
+		if self.pool is not None:
+			self.pool.shutdown()
+
 if __name__ == "__main__":
 	args = parse_args()
 	if args.times == None and args.ancientSamps == None and args.ancientHaps == None:
@@ -298,54 +712,28 @@ if __name__ == "__main__":
 	print('Loading data and initializing model...')
 
 	# load data and set up model
-	sMax = args.sMax
-	timeBins,times,epochs,Ne,freqs,z_bins,z_logcdf,z_logsf,ancientGLs,ancientHapGLs,noCoals,currFreq,h,changePts = load_data(args)
-
-	Ne *= 1/2
-	noCoals = int(noCoals)
+	model = ClueModel.from_args(args)
+	timeBins,epochs,freqs,transCache = model.timeBins,model.epochs,model.freqs,model.transCache
+	if args.bootstrap > 0 and not model.noCoals:
+		# simulating coalescence times needs mssel + Relate
+		print('--bootstrap only supports ancient samples (no --times)')
+		exit(1)
+	if args.batch != None:
+		if args.times == None:
+			print('--batch needs coalescence times (--times)')
+			exit(1)
+		batch_inference(args,model)
+		model.close()
+		if transCache is not None and not args.quiet:
+			print(transCache.stats())
+		exit(0)
 
 	# optimize over selection parameters
-	T = len(timeBins)
-	S0 = 0.0 * np.ones(T-1)
-	opts = {'xatol':1e-4}
-
-	if T == 2:
-		Simplex = np.reshape(np.array([-0.05,0.05]),(2,1))
-	elif T > 2:
-		Simplex = np.zeros((T,T-1))
-		for i in range(Simplex.shape[1]):
-			Simplex[i,:] = -0.01
-			Simplex[i,i] = 0.01
-		Simplex[-1,:] = 0.01
-	else:
-		raise ValueError
-
-	#bounds = tuple([(-0.05,0.05) for i in range(T-1)])
-	opts['initial_simplex']=Simplex
-
-	#for tup in product(*[[-1,1] for i in range(3)]):
-	logL0 = likelihood_wrapper(S0,timeBins,Ne,freqs,z_bins,z_logcdf,z_logsf,ancientGLs,ancientHapGLs,epochs,noCoals,currFreq,h,sMax,changePts)
-
-	print('Optimizing likelihood surface using Nelder-Mead...')
-	if times.shape[2] > 1:
-		print('\t(Importance sampling with M = %d Relate samples)'%(times.shape[2]))
-		print()
-	minargs = (timeBins,Ne,freqs,z_bins,z_logcdf,z_logsf,ancientGLs,ancientHapGLs,epochs,noCoals,currFreq,h,sMax,changePts)
-	res = minimize(likelihood_wrapper,
-	         S0,
-	         args=minargs,
-	         options=opts,
-	         #bounds=bounds,
-	        method='Nelder-Mead')
-
-	S = res.x
-	L = res.fun
-	#Hinv = np.linalg.inv(res.hess)
-	#se = np.sqrt(np.diag(Hinv))
+	S,logLR = model.fit(args.optimizer)
 
 	print('#'*10)
 	print()
-	print('logLR: %.4f'%(-res.fun+logL0))
+	print('logLR: %.4f'%(logLR))
 	print()
 	print('MLE:')
 	print('========')
@@ -355,13 +743,41 @@ if __name__ == "__main__":
 
 
 	# infer trajectory @ MLE of selection parameter
-	print(noCoals)
+	print(model.noCoals)
+
+	post = model.posterior(S)
+
+	if args.sGrid != None:
+		if model.transMode == TRANS_BANDED:
+			print('Warning: --sGrid does not support --transMode banded; the surface is computed with --transMode stepwise')
+		surface = model.surface(np.linspace(args.sGrid[0],args.sGrid[1],int(args.sGrid[2])))
+	else:
+		surface = None
+
+	if args.bootstrap > 0:
+		print()
+		print('Parametric bootstrap (B = %d):'%(args.bootstrap))
+		print('=============')
+		mles = bootstrap(args.bootstrap,args.bootstrapProcs,args.seed,S,post,model.ancientGLs,model.ancientHapGLs,model.minargs,
+			optimizer=args.optimizer,maxCacheBytes=int(args.transCacheMB*2**20),
+			outFile=None if args.out == None else args.out+'.bootstrap.tsv')
+		print_ci_table(S,mles,timeBins)
 
-	post = traj_wrapper(res.x,timeBins,Ne,freqs,z_bins,z_logcdf,z_logsf,ancientGLs,ancientHapGLs,epochs,noCoals,currFreq,h,sMax,changePts)
+	model.close()
+	if transCache is not None and not args.quiet:
+		print(transCache.stats())
 
 	if args.out != None:
-		out(args,epochs,freqs,post)
+		out(args,epochs,freqs,post,surface)
 	else:
+		if surface is not None:
+			sGrid,logls = surface
+			print()
+			print('Likelihood surface:')
+			print('=============')
+			print('\t'.join(['s_%d-%d'%(t,u) for t,u in zip(timeBins[:-1],timeBins[1:])]+['logLR']))
+			for idx in np.ndindex(logls.shape):
+				print('\t'.join(['%.5f'%(sGrid[i]) for i in idx]+['%.4f'%(logls[idx])]))
 		print()
 		print('Trajectory:')
 		print('=============')
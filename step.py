@@ -1,42 +1,22 @@
 import numpy as np
 import sys
-from matplotlib import pyplot as plt
 from pathlib import Path
 import argparse
 
+import traj_sim
+
 # Simulation Pipeline
-def simulate_selected_backwards(p0, s, N):
-    delta = 1/(4*N)
-    traj = [p0]
-    a = s*N*2
-    while traj[-1] != 1 and traj[-1] != 0:
-        curr = traj[-1]
-        nextFreq = np.random.normal(-a*curr*(1-curr)/np.tanh(a*curr)*delta + curr, np.sqrt(delta) * np.sqrt(curr*(1-curr)) )
-        if nextFreq > 1:
-            nextFreq = 1
-        if nextFreq < 0:
-            nextFreq = 0
-        traj.append(nextFreq)
-    return traj[1:]
-
-
-def simulate_selected_forwards(p0, s, tOn, tOff, N, eps=0.001):
-    delta = 1/(4*N)
-    traj = [p0]
-
-    for t in range(tOn,0,-1):
-        if t > tOff:
-            a = s*N*2
-        else:
-            a = 0.0
-
-        curr = traj[-1]
-        nextFreq = np.random.normal(a*curr*(1-curr)*delta + curr, np.sqrt(delta) * np.sqrt(curr*(1-curr)) )
-        if nextFreq > 1:
-            nextFreq = 1
-        if nextFreq < 0:
-            nextFreq = 0
-        traj.append(nextFreq)
+def simulate_selected_backwards(p0, s, N, rng=None):
+    bwd, offsets = traj_sim.simulate_backwards(p0, s, N, rng=rng)
+    return list(bwd)
+
+
+def simulate_selected_forwards(p0, s, tOn, tOff, N, eps=0.001, rng=None, condition=False, pNow=None, tol=0.01):
+    if condition:
+        # resample until the present-day MAF is at least eps (and the frequency is within tol of pNow)
+        fwd, accept = traj_sim.simulate_forwards_conditioned(p0, s, tOn, tOff, N, rng=rng, eps=eps, pNow=pNow, tol=tol)
+        return list(fwd[0])
+    traj = list(traj_sim.simulate_forwards(p0, s, tOn, tOff, N, rng=rng)[0])
 
     if np.min([traj[-1],1-traj[-1]]) < eps:
         print('Warning: MAF less than %.4f'%(eps))
@@ -45,9 +25,13 @@ def simulate_selected_forwards(p0, s, tOn, tOff, N, eps=0.001):
 
 
 
-def simulate_traj(p0, s, tOn, tOff, N):
-    bwd = simulate_selected_backwards(p0, 1e-8, N)
-    fwd = simulate_selected_forwards(p0, s, tOn, tOff, N)
+def simulate_traj(p0, s, tOn, tOff, N, rng=None, minMaf=None, pNow=None, tol=0.01):
+    bwd = simulate_selected_backwards(p0, 1e-8, N, rng)
+    if minMaf is None and pNow is None:
+        fwd = simulate_selected_forwards(p0, s, tOn, tOff, N, rng=rng)
+    else:
+        eps = 0.001 if minMaf is None else minMaf
+        fwd = simulate_selected_forwards(p0, s, tOn, tOff, N, eps=eps, rng=rng, condition=True, pNow=pNow, tol=tol)
     traj = fwd[::-1] + bwd
     print(traj[50:100:10])
     return traj
@@ -97,6 +81,10 @@ def main():
         help="Time before present that selection ends.",
     )
     argparser.add_argument("--output-file-path", type=str, default="mssel.traj")
+    argparser.add_argument("--seed", type=int, default=None, help="Random seed.")
+    argparser.add_argument("--min-maf", type=float, default=None, help="Resample the selected path until the present-day minor allele frequency is at least this (instead of only warning).")
+    argparser.add_argument("--p-now", type=float, default=None, help="Resample the selected path until the present-day frequency is within --p-now-tol of this.")
+    argparser.add_argument("--p-now-tol", type=float, default=0.01, help="Tolerance of --p-now.")
     args = argparser.parse_args()
 
     p0 = args.initial_allele_freq
@@ -108,7 +96,7 @@ def main():
     output_file_path = args.output_file_path
 
     save_mssel_input(
-        N, traj=simulate_traj(p0, s, tOn, tOff, N), output_file_path=output_file_path
+        N, traj=simulate_traj(p0, s, tOn, tOff, N, np.random.default_rng(args.seed), args.min_maf, args.p_now, args.p_now_tol), output_file_path=output_file_path
     )
 
 
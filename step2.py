@@ -1,56 +1,40 @@
 import argparse
 import numpy as np
 import sys
-from matplotlib import pyplot as plt
 from pathlib import Path
 
-#Generate traj
-def simulate_selected_forwards(p0,s,tOn,tOff,N=10000,eps=0.001):
-
-    delta = 1/(4*N)
-    traj = [p0]
+import traj_sim
 
-    for t in range(tOn,0,-1):
-        if t > tOff:
-            a = s*N*2
-        else:
-            a = 0.0
+#Generate traj
+def simulate_selected_forwards(p0,s,tOn,tOff,N=10000,eps=0.001,rng=None,condition=False,pNow=None,tol=0.01):
 
-        curr = traj[-1]
-        nextFreq = np.random.normal(a*curr*(1-curr)*delta + curr, np.sqrt(delta) * np.sqrt(curr*(1-curr)) )
-        if nextFreq > 1:
-            nextFreq = 1
-        if nextFreq < 0:
-            nextFreq = 0
-        traj.append(nextFreq)
+    if condition:
+        # resample until the present-day MAF is at least eps (and the frequency is within tol of pNow)
+        fwd,accept = traj_sim.simulate_forwards_conditioned(p0,s,tOn,tOff,N,rng=rng,eps=eps,pNow=pNow,tol=tol)
+        return list(fwd[0])
+    traj = list(traj_sim.simulate_forwards(p0,s,tOn,tOff,N,rng=rng)[0])
 
     if np.min([traj[-1],1-traj[-1]]) < eps:
         print('Warning: MAF less than %.4f'%(eps))
 
     return traj
 
-def simulate_selected_backwards(p0, s, N):
-    delta = 1/(4*N)
-    traj = [p0]
-    a = s*N*2
-    while traj[-1] != 1 and traj[-1] != 0:
-        curr = traj[-1]
-        nextFreq = np.random.normal(-a*curr*(1-curr)/np.tanh(a*curr)*delta + curr, np.sqrt(delta) * np.sqrt(curr*(1-curr)) )
-        if nextFreq > 1:
-            nextFreq = 1
-        if nextFreq < 0:
-            nextFreq = 0
-        traj.append(nextFreq)
-    return traj[1:]
-
-def simulate_traj(p0,s,tOn,tOff,N):
-    bwd = simulate_selected_backwards(p0,1e-8,N)
-    fwd = simulate_selected_forwards(p0,s,tOn,tOff,N)
+def simulate_selected_backwards(p0, s, N, rng=None):
+    bwd, offsets = traj_sim.simulate_backwards(p0, s, N, rng=rng)
+    return list(bwd)
+
+def simulate_traj(p0,s,tOn,tOff,N,rng=None,minMaf=None,pNow=None,tol=0.01):
+    bwd = simulate_selected_backwards(p0,1e-8,N,rng)
+    if minMaf is None and pNow is None:
+        fwd = simulate_selected_forwards(p0,s,tOn,tOff,N,rng=rng)
+    else:
+        eps = 0.001 if minMaf is None else minMaf
+        fwd = simulate_selected_forwards(p0,s,tOn,tOff,N,eps=eps,rng=rng,condition=True,pNow=pNow,tol=tol)
     traj = fwd[::-1]+bwd
     return traj
 
 #Simulating aDNA samples from trajectory
-def simulate_gls_from_traj(gens, nsamp, traj):
+def simulate_gls_from_traj(gens, nsamp, traj, rng=None, offsets=None, ploidy=2, depth=None, err=0.0):
     '''
     Simulate genotype likelihoods of ancient samples
 
@@ -58,31 +42,69 @@ def simulate_gls_from_traj(gens, nsamp, traj):
         gens: number of generations back the ancient samples go
             (assuming they are uniformly distributed between [0,gens])
         nsamp: number of ancient samples
+        traj: allele frequency trajectory (generations before present), or
+            R trajectories as returned by traj_sim (flat array + offsets)
+        ploidy: 2 for --ancientSamps, 1 for --ancientHaps
+        depth: mean read depth (Poisson); None gives perfect calls (GL 0.0 for
+            the true genotype, -inf for the others)
+        err: per-read error rate (a read shows the other allele)
 
     Output:
         ancGLs: matrix of ancient genotype likelihoods, *in log space*;
-                1st column is sampling time (in [0,gens]), columns 2-4 are
-                genotype likelihoods of the genotypes.
-        genos: vector of actual genotypes; each element is in {0,1,2}
+                1st column is sampling time (in [0,gens]), the other ploidy+1
+                columns are genotype likelihoods of the genotypes, normalized to
+                a maximum of 0 (all 0 for samples without reads). For R
+                trajectories, an R x nsamp x (ploidy+2) array.
+        genos: actual genotypes (number of derived copies), nsamp (or R x nsamp)
     '''
+    rng = np.random.default_rng() if rng is None else rng
+    traj = np.asarray(traj,dtype=float)
+    single = offsets is None
+    if single:
+        offsets = np.array([0,len(traj)])
+    R = len(offsets)-1
     epochs = np.linspace(0,gens,gens)
-    times = np.random.uniform(0,gens,size=nsamp)
-    ancGLs = np.zeros((len(times),4))
-    ancGLs[:,1:] = -np.inf
-    genos = []
-    for i,t in enumerate(np.sort(times)):
-        if t >= gens - 1:
-            ancGLs[i, 1]=0.0
-            ancGLs[i, 0]=t
-        else:
-            geno = np.random.binomial(2,traj[np.digitize(t,epochs)+1])
-            genos.append(geno)
-            ancGLs[i,geno+1] = 0.0
-            ancGLs[i,0] = t
-
+    times = np.sort(rng.uniform(0,gens,size=(R,nsamp)),axis=1)
+    # samples in the oldest generation are called homozygous ancestral
+    edge = times >= gens - 1
+    idx = np.minimum(np.digitize(times,epochs)+1,np.diff(offsets)[:,np.newaxis]-1)
+    freqs = np.where(edge,0.0,traj[offsets[:-1,np.newaxis]+idx])
+    genos = rng.binomial(ploidy,freqs)
+
+    ancGLs = np.zeros((R,nsamp,ploidy+2))
+    ancGLs[:,:,0] = times
+    if depth is None:
+        ancGLs[:,:,1:] = -np.inf
+        np.put_along_axis(ancGLs,genos[:,:,np.newaxis]+1,0.0,axis=2)
+    else:
+        # probability that a read shows the derived allele, per genotype
+        q = np.arange(ploidy+1)/ploidy*(1-err) + (1-np.arange(ploidy+1)/ploidy)*err
+        reads = rng.poisson(depth,size=(R,nsamp))
+        der = rng.binomial(reads,q[genos])
+        with np.errstate(divide='ignore',invalid='ignore'):
+            logL = der[:,:,np.newaxis]*np.log(q) + (reads-der)[:,:,np.newaxis]*np.log1p(-q)
+        # 0*log(0) (err = 0) is 0
+        logL = np.where(np.isnan(logL),0.0,logL)
+        ancGLs[:,:,1:] = logL - np.max(logL,axis=2,keepdims=True)
+
+    if single:
+        return ancGLs[0], genos[0]
     return ancGLs, genos
 
 
+def write_gls(path, ancGLs):
+    '''
+    Write GLs for inference.py --ancientSamps/--ancientHaps: binary (full
+    precision, fast to load) if path ends in .npy or .npz, text otherwise.
+    '''
+    ext = Path(path).suffix
+    if ext == '.npy':
+        np.save(path, ancGLs)
+    elif ext == '.npz':
+        np.savez(path, gls=ancGLs)
+    else:
+        np.savetxt(path, ancGLs)
+
 def main():
     argparser = argparse.ArgumentParser()
     argparser.add_argument(
@@ -118,9 +140,16 @@ def main():
         required=True,
         help="Time before present that selection ends.",
     )
-    argparser.add_argument("--output-file-path", type=str, default="ancientSamples.txt")
+    argparser.add_argument("--output-file-path", type=str, default="ancientSamples.txt", help="GL output; written as binary .npy/.npz if the name ends in .npy/.npz, as text otherwise.")
     argparser.add_argument("--ancient-samples-generation-gap", type=int, help="Number of generations back the ancient samples go", required=True)
     argparser.add_argument("--number-of-ancient-samples", type=int, help="Number of ancient samples", required=True)
+    argparser.add_argument("--min-maf", type=float, default=None, help="Resample the selected path until the present-day minor allele frequency is at least this (instead of only warning).")
+    argparser.add_argument("--p-now", type=float, default=None, help="Resample the selected path until the present-day frequency is within --p-now-tol of this.")
+    argparser.add_argument("--p-now-tol", type=float, default=0.01, help="Tolerance of --p-now.")
+    argparser.add_argument("--ploidy", type=int, default=2, choices=(1,2), help="2 writes diploid GLs (inference.py --ancientSamps), 1 haploid GLs (--ancientHaps).")
+    argparser.add_argument("--depth", type=float, default=None, help="Mean read depth per sample (Poisson). Without it, genotypes are called perfectly.")
+    argparser.add_argument("--error-rate", type=float, default=0.0, help="Per-read error rate, used with --depth.")
+    argparser.add_argument("--seed", type=int, default=None, help="Random seed.")
     args = argparser.parse_args()
 
     p0 = args.initial_allele_freq
@@ -132,8 +161,10 @@ def main():
     nsamp = args.number_of_ancient_samples
     output_file_path = args.output_file_path
 
-    ancGLs, genos= simulate_gls_from_traj(gens,nsamp,traj=simulate_traj(p0,s,tOn,tOff,N))
-    np.savetxt(args.output_file_path, ancGLs)
+    rng = np.random.default_rng(args.seed)
+    traj = simulate_traj(p0,s,tOn,tOff,N,rng=rng,minMaf=args.min_maf,pNow=args.p_now,tol=args.p_now_tol)
+    ancGLs, genos= simulate_gls_from_traj(gens,nsamp,traj,rng=rng,ploidy=args.ploidy,depth=args.depth,err=args.error_rate)
+    write_gls(args.output_file_path, ancGLs)
 
 if __name__ == '__main__':
     main()
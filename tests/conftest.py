@@ -0,0 +1,61 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,ROOT)
+
+import inference
+import step2
+from timeb_utils import _RECORD_HEADER
+
+
+def simulated_gls(nsamp=40,gens=200,seed=1,ploidy=2):
+    # ancient samples along a trajectory that rises towards the present (present first)
+    traj = np.linspace(0.6,0.05,gens+2)
+    return step2.simulate_gls_from_traj(gens,nsamp,traj,rng=np.random.default_rng(seed),
+        ploidy=ploidy,depth=4.0,err=0.01)[0]
+
+
+def write_timeb(path,loci,M=3,n=20,seed=1):
+    '''
+    Writes a .timeb file with one record per (bp, daf) in loci: M sampled trees of
+    random coalescence times (der times below 150 generations, anc times below 400).
+    '''
+    rng = np.random.default_rng(seed)
+    with open(path,'wb') as fp:
+        fp.write(np.array([len(loci),M],dtype='<i4').tobytes())
+        for bp,daf in loci:
+            nanc = n-daf-1 if daf < n-1 else 0
+            nder = daf-1 if daf > 1 else 0
+            header = np.zeros(1,dtype=_RECORD_HEADER)
+            header['bp'],header['anc'],header['der'],header['daf'],header['n'] = bp,b'A',b'G',daf,n
+            fp.write(header.tobytes())
+            fp.write(np.sort(rng.uniform(1,400,size=(M,nanc)),axis=1).astype('<f4').tobytes())
+            fp.write(np.sort(rng.uniform(1,150,size=(M,nder)),axis=1).astype('<f4').tobytes())
+    return path
+
+
+def write_bins(path,bins):
+    np.savetxt(path,bins)
+    return str(path)
+
+
+def clue_model(argv,ancientGLs=None,**kwargs):
+    args = inference.parse_args(argv)
+    return args,inference.ClueModel.from_args(args,ancientGLs=ancientGLs,**kwargs)
+
+
+@pytest.fixture(scope='session')
+def anc_gls():
+    return simulated_gls()
+
+
+@pytest.fixture
+def timeb(tmp_path):
+    # prefix of a 4-locus .timeb file (as for --times)
+    prefix = str(tmp_path/'loci')
+    write_timeb(prefix+'.timeb',[(1000,6),(1010,8),(1020,5),(1030,9)])
+    return prefix
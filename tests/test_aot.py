@@ -0,0 +1,49 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import hmm_utils
+from conftest import ROOT
+
+pytestmark = pytest.mark.skipif(hmm_utils._aot is None,reason='_hmm_kernels not built from this hmm_utils.py (build_kernels.py)')
+
+# likelihoods, gradient, grid and posterior of a small model with Relate samples
+SCRIPT = '''
+import sys
+sys.path[:0] = [%r,%r]
+import numpy as np
+import inference
+from conftest import clue_model, simulated_gls, write_bins, write_timeb
+out = sys.argv[1]
+write_timeb(out+'.timeb',[(1000,6)])
+argv = ['--times',out,'--tCutoff','200','--df','40','--timeBins',write_bins(out+'.bins',[0,50,120])]
+args,model = clue_model(argv,simulated_gls())
+S = np.array([0.02,-0.01])
+res = {}
+for mode in ('power','stepwise','banded'):
+    for scaled in (0,1):
+        minargs = model.minargs._replace(transMode=inference.TRANS_MODES[mode],scaled=scaled)
+        res['%%s_%%d'%%(mode,scaled)] = inference.likelihood_wrapper(S,*minargs)
+res['grad'] = inference.likelihood_grad_wrapper(S,*model.minargs)[1]
+res['grid'] = model.loglik(np.array([S,-S,2*S]))
+res['post'] = model.posterior(S)
+np.savez(out+'.npz',**res)
+'''%(ROOT,os.path.join(ROOT,'tests'))
+
+
+def run(tmp_path,name,jit):
+    env = dict(os.environ)
+    env['CLUES_JIT'] = '1' if jit else '0'
+    out = str(tmp_path/name)
+    subprocess.run([sys.executable,'-c',SCRIPT,out],env=env,check=True,capture_output=True)
+    return np.load(out+'.npz')
+
+
+def test_aot_bitwise_identical_to_jit(tmp_path):
+    aot = run(tmp_path,'aot',False)
+    jit = run(tmp_path,'jit',True)
+    for key in jit.files:
+        np.testing.assert_array_equal(aot[key],jit[key],err_msg=key)
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+import inference
+import timeb_utils
+from conftest import clue_model, write_bins, write_timeb
+
+
+def run_batch(argv,tmp_path):
+    out = str(tmp_path/'batch.tsv')
+    args,model = clue_model(argv+['--batch',out])
+    inference.batch_inference(args,model)
+    model.close()
+    return np.genfromtxt(out,names=True,dtype=None,encoding=None,delimiter='\t')
+
+
+@pytest.fixture
+def argv(timeb,tmp_path):
+    return ['--times',timeb,'--df','20','--tCutoff','200','--timeBins',write_bins(tmp_path/'bins.txt',[0,60,200])]
+
+
+def test_batch_matches_single_locus_fits(argv,tmp_path):
+    rows = run_batch(argv,tmp_path)
+    assert list(rows['bp']) == [1000,1010,1020,1030]
+    for row in rows[[0,2]]:
+        args,model = clue_model(argv+['--bp',str(row['bp'])])
+        S,logLR = model.fit(args.optimizer)
+        assert row['logLR'] == pytest.approx(logLR,abs=1e-4)
+
+
+def test_batch_parses_file_once(argv,tmp_path,monkeypatch):
+    parsed = []
+    record = timeb_utils.TimebReader._record
+    def counting_record(self,buf,offset):
+        parsed.append(offset)
+        return record(self,buf,offset)
+    monkeypatch.setattr(timeb_utils.TimebReader,'_record',counting_record)
+    run_batch(argv,tmp_path)
+    # one pass over the 4 records, plus the first record to set up the model
+    assert len(parsed) == 5
+
+
+def test_warm_start_is_cheaper_and_no_worse(tmp_path,monkeypatch):
+    prefix = str(tmp_path/'six')
+    write_timeb(prefix+'.timeb',[(2000,3),(2010,12),(2020,6),(2030,15),(2040,4),(2050,9)],seed=3)
+    argv = ['--times',prefix,'--df','30','--tCutoff','300','--timeBins',write_bins(tmp_path/'bins.txt',[0,100,300])]
+    evals = []
+    likelihood = inference.likelihood_wrapper
+    def counting_likelihood(theta,*args):
+        evals[-1] += 1
+        return likelihood(theta,*args)
+    monkeypatch.setattr(inference,'likelihood_wrapper',counting_likelihood)
+    fits = []
+    for extra in ([],['--warmStart']):
+        evals.append(0)
+        fits.append(run_batch(argv+extra,tmp_path))
+    cold,warm = fits
+    # the warm start runs instead of the cold one, not as well as it
+    assert evals[1] < 0.75*evals[0]
+    assert np.all(warm['logLR'] >= cold['logLR'] - 1e-6)
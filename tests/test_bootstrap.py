@@ -0,0 +1,24 @@
+import numpy as np
+
+import bootstrap
+from conftest import clue_model, write_bins
+
+
+def test_samples_use_epoch_index():
+    # with --tSkip 5 a sample at t = 7 is emitted at the end of epoch (5,10]
+    epochs = np.arange(0.0,30.0,5.0)
+    traj = np.array([0.0,0.0,1.0,0.0,0.0,0.0])
+    GLs = np.array([[7.0,0.0,-np.inf,-np.inf],[3.0,0.0,-np.inf,-np.inf]])
+    sim = bootstrap.simulate_gls(GLs,epochs,traj,np.random.default_rng(0))
+    np.testing.assert_array_equal(sim[:,1:],[[-np.inf,-np.inf,0.0],[0.0,-np.inf,-np.inf]])
+
+
+def test_bootstrap_procs_agree_and_stay_in_bounds(anc_gls,tmp_path):
+    argv = ['--df','30','--popFreq','0.3','--tSkip','5','--timeBins',write_bins(tmp_path/'bins.txt',[0,100,200])]
+    args,model = clue_model(argv,anc_gls)
+    S,logLR = model.fit()
+    post = model.posterior(S)
+    runs = [bootstrap.bootstrap(4,procs,7,S,post,model.ancientGLs,model.ancientHapGLs,model.minargs) for procs in (1,2)]
+    np.testing.assert_array_equal(runs[0],runs[1])
+    # replicates simulated from the fitted chain do not run into the bounds
+    assert np.all(np.abs(runs[0]) < model.sMax-1e-3)
@@ -0,0 +1,46 @@
+import argparse
+import os
+
+import numpy as np
+import pytest
+from scipy.special import log_ndtr
+
+import case3
+import inference
+from conftest import write_bins
+
+
+def test_fill_defaults_uses_rng():
+    traj = np.array([0.3,0.25,0.2])
+    nders = []
+    for i in range(2):
+        args = argparse.Namespace(nchroms=400)
+        case3.fill_defaults(args,traj,np.random.default_rng(11))
+        nders.append(args.nder)
+        assert args.nanc == 400-args.nder
+    assert nders[0] == nders[1]
+
+
+def test_infer_time_bins_inside_clues_dir(anc_gls,tmp_path,monkeypatch):
+    os.makedirs(tmp_path/'clues'/'example')
+    write_bins(tmp_path/'clues'/'example'/'timeBins.txt',[0,50,150])
+    monkeypatch.chdir(tmp_path)
+    logLR,epoch,s = case3.infer(None,anc_gls,str(tmp_path/'out'),'example/timeBins.txt',0.3)
+    assert epoch == '0-50'
+    assert np.isfinite(logLR)
+
+
+def test_infer_z_tables_inside_clues_dir(anc_gls,tmp_path,monkeypatch):
+    # the in-process fit can interpolate log Phi(z) like the cloned inference.py
+    os.makedirs(tmp_path/'clues'/'utils')
+    z = np.linspace(-40,40,8001)
+    for name,vals in (('z_bins',z),('z_logcdf',log_ndtr(z)),('z_logsf',log_ndtr(-z))):
+        np.savetxt(tmp_path/'clues'/'utils'/(name+'.txt'),vals)
+    monkeypatch.chdir(tmp_path)
+    loaded = []
+    load = inference.load_normal_tables
+    monkeypatch.setattr(inference,'load_normal_tables',lambda zTables=None: loaded.append(zTables) or load(zTables))
+    logLR,epoch,s = case3.infer(None,anc_gls,str(tmp_path/'out'),None,0.3,z_tables='utils')
+    computed = case3.infer(None,anc_gls,str(tmp_path/'out'),None,0.3)[0]
+    assert loaded == [os.path.join('clues','utils'),None]
+    assert logLR == pytest.approx(computed,abs=0.05)
@@ -0,0 +1,179 @@
+import numpy as np
+import pytest
+from scipy.special import logsumexp
+
+import hmm_utils
+import inference
+from conftest import clue_model, write_bins, write_timeb
+from trans_cache import TransCache
+
+MODES = {'power':hmm_utils.TRANS_POWER,'stepwise':hmm_utils.TRANS_STEPWISE,'banded':hmm_utils.TRANS_BANDED}
+
+
+def loglik(minargs,S,transMode,scaled,changePts=None):
+    minargs = minargs._replace(transMode=transMode,scaled=scaled,transCache=None)
+    if changePts is not None:
+        minargs = minargs._replace(changePts=changePts)
+    return inference.likelihood_wrapper(np.array(S),*minargs)
+
+
+@pytest.fixture(scope='module')
+def models(anc_gls,tmp_path_factory):
+    tmp = tmp_path_factory.mktemp('engines')
+    prefix = str(tmp/'loc')
+    write_timeb(prefix+'.timeb',[(1000,6)])
+    common = ['--df','40','--timeBins',write_bins(tmp/'bins.txt',[0,50]),'--popFreq','0.3']
+    return {
+        'anc':clue_model(common,anc_gls)[1],
+        'times':clue_model(common+['--times',prefix,'--tCutoff','200'],anc_gls)[1],
+    }
+
+
+@pytest.mark.parametrize('data',['anc','times'])
+@pytest.mark.parametrize('S',[[0.0],[0.02],[-0.03]])
+def test_engines_agree(models,data,S):
+    minargs = models[data].minargs
+    ref = loglik(minargs,S,MODES['stepwise'],0)
+    assert np.isfinite(ref)
+    for mode in MODES:
+        for scaled in (0,1):
+            assert loglik(minargs,S,MODES[mode],scaled) == pytest.approx(ref,abs=1e-8)
+
+
+@pytest.mark.parametrize('scaled',[0,1])
+def test_banded_changepoints(models,scaled):
+    # epochs at changepoints use the uniform matrix in every engine
+    minargs = models['times'].minargs
+    cp = np.array([20.0,90.0])
+    ref = loglik(minargs,[0.02],MODES['stepwise'],0,cp)
+    assert loglik(minargs,[0.02],MODES['banded'],scaled,cp) == pytest.approx(ref,abs=1e-8)
+
+
+def test_band_matches_dense_rows():
+    freqs = inference.betaincinv(0.5,0.5,np.linspace(1e-4,1-1e-4,60))
+    z = inference.load_normal_tables()
+    dense = hmm_utils._one_step_log_trans_prob(1e4,0.01,freqs,*z,0.5)
+    lo,band = hmm_utils._one_step_log_trans_band(1e4,0.01,freqs,*z,0.5,1e-15)
+    for i in range(len(freqs)):
+        row = dense[i,lo[i]:lo[i]+band.shape[1]]
+        keep = row > -30
+        # renormalizing the band only shifts each row by less than 2*tol
+        np.testing.assert_allclose(band[i,keep],row[keep],atol=1e-12)
+        assert np.sum(np.exp(np.delete(dense[i],np.arange(lo[i],lo[i]+band.shape[1])))) < 1e-12
+
+
+@pytest.mark.parametrize('mode',['power','stepwise'])
+@pytest.mark.parametrize('scaled',[0,1])
+def test_cached_transitions_identical(models,mode,scaled):
+    minargs = models['times'].minargs
+    z = inference.load_normal_tables()
+    ref = loglik(minargs,[0.02],MODES[mode],scaled)
+    cache = TransCache(*z)
+    minargs = minargs._replace(transMode=MODES[mode],scaled=scaled,transCache=cache)
+    S = np.array([0.02])
+    # misses, then hits
+    assert inference.likelihood_wrapper(S,*minargs) == ref
+    assert inference.likelihood_wrapper(S,*minargs) == ref
+    assert cache.hits > 0 and cache.misses > 0
+
+
+
+def test_cache_keys_grids_by_content_within_budget():
+    z = inference.load_normal_tables()
+    freqs = inference.betaincinv(0.5,0.5,np.linspace(1e-4,1-1e-4,40))
+    epochs = np.arange(0.0,20.0)
+    N = 5000.0*np.ones(len(epochs))
+    sel = np.where(epochs < 10,0.01,0.0)
+    mat = 40*40*8
+    cache = TransCache(*z,maxBytes=6*mat)
+    transMats,transIdx = cache.transitions(sel,epochs,N,freqs,0.5,MODES['stepwise'])
+    # an equal grid in another array: same matrices, and the same stack
+    again,_ = cache.transitions(sel,epochs,N,freqs.copy(),0.5,MODES['stepwise'])
+    assert again is transMats and cache.misses == 2
+    np.testing.assert_array_equal(transMats[transIdx],[cache.get(5000.0,s,1,0.5,freqs,MODES['stepwise']) for s in sel[:-1]])
+    for df in range(41,41+2*TransCache.maxGrids):
+        grid = inference.betaincinv(0.5,0.5,np.linspace(1e-4,1-1e-4,df))
+        cache.transitions(sel,epochs,N,grid,0.5,MODES['stepwise'])
+        assert cache.nbytes <= 6*mat
+        assert cache.nbytes == sum(a.nbytes for a in list(cache._mats.values())+list(cache._stacks.values()))
+    assert len(cache._grids) == TransCache.maxGrids
+
+
+def test_threads_identical(anc_gls,tmp_path):
+    # 3 Relate samples per locus: importance sampling over a thread pool
+    prefix = str(tmp_path/'loc')
+    write_timeb(prefix+'.timeb',[(1000,6)])
+    argv = ['--times',prefix,'--tCutoff','200','--df','40','--timeBins',write_bins(tmp_path/'bins.txt',[0,50,120])]
+    S = np.array([0.02,-0.01])
+    serial = clue_model(argv,anc_gls)[1]
+    threaded = clue_model(argv+['--threads','2'],anc_gls)[1]
+    assert threaded.pool is not None
+    assert threaded.loglik(S) == serial.loglik(S)
+    np.testing.assert_array_equal(threaded.posterior(S),serial.posterior(S))
+    np.testing.assert_array_equal(threaded.loglik(np.array([S,-S])),serial.loglik(np.array([S,-S])))
+    threaded.close()
+
+
+@pytest.mark.parametrize('times,n',[([],5),([12.5],5),([10.2,11.0,17.9],6),([14.0],1)])
+def test_coal_densities_match_per_bin(times,n):
+    times = np.array(times,dtype=float)
+    epoch = np.array([10.0,20.0])
+    xi = np.linspace(0.01,0.99,30)
+    m,W = hmm_utils._coal_epoch_stats(times,n,epoch)
+    dens = hmm_utils._log_coal_densities(m,W,n,xi,5000.0)
+    ref = [hmm_utils._log_coal_density(times,n,epoch,x,5000.0,5000.0,0) for x in xi]
+    np.testing.assert_allclose(dens,ref,rtol=1e-12,atol=1e-12)
+    # ancestral lineages see 1-xi
+    ref = [hmm_utils._log_coal_density(times,n,epoch,x,5000.0,5000.0,1) for x in xi]
+    np.testing.assert_allclose(hmm_utils._log_coal_densities(m,W,n,1.0-xi,5000.0),ref,rtol=1e-12,atol=1e-12)
+
+
+@pytest.mark.parametrize('data',['anc','times'])
+@pytest.mark.parametrize('mode',['power','stepwise','banded'])
+def test_grid_matches_looped(models,data,mode):
+    minargs = models[data].minargs._replace(transMode=MODES[mode])
+    sMax = minargs.sMax
+    thetas = np.array([[-0.05],[0.0],[0.01],[0.03],[sMax+0.1]])
+    grid = inference.likelihood_grid(thetas,*minargs)
+    looped = [inference.likelihood_wrapper(S,*minargs) for S in thetas]
+    # out of bounds: inf in both
+    np.testing.assert_allclose(grid,looped,rtol=0,atol=1e-10)
+
+
+def test_gl_emissions_match_per_sample_sum(anc_gls):
+    epochs = np.arange(0.0,201.0)
+    freqs = inference.betaincinv(0.5,0.5,np.linspace(1e-4,1-1e-4,40))
+    hap = anc_gls[::3,:3].copy()
+    hap[0,1:] = [0.0,-np.inf]
+    E = hmm_utils.genotype_likelihood_emissions(epochs,freqs,anc_gls,hap)
+    geno = np.array([(1-freqs)**2,2*freqs*(1-freqs),freqs**2])
+    ref = np.zeros(E.shape)
+    for GLs,probs in ((anc_gls,geno),(hap,np.array([1-freqs,freqs]))):
+        for row in GLs:
+            # epoch tb holds times in (epochs[tb],epochs[tb+1]]
+            tb = int(np.ceil(row[0]))-1
+            if 0 <= tb < len(ref):
+                ref[tb] += logsumexp(row[1:,np.newaxis]+np.log(probs),axis=0)
+    np.testing.assert_allclose(E,ref,rtol=1e-12,atol=1e-12)
+
+
+def test_coal_buckets_match_masking():
+    rng = np.random.default_rng(8)
+    times = np.full((2,12),-1.0)
+    times[0,:9] = rng.uniform(0,60,9)
+    times[1,:5] = rng.uniform(0,60,5)
+    times[1,5] = 20.0
+    epochs = np.arange(0.0,61.0,5.0)
+    sortedTimes,offsets = hmm_utils.coal_buckets(times,epochs)
+    for r in range(2):
+        for tb in range(len(epochs)-1):
+            inEpoch = np.sort(times[r][(times[r] > epochs[tb]) & (times[r] <= epochs[tb+1])])
+            np.testing.assert_array_equal(sortedTimes[r,offsets[r,tb]:offsets[r,tb+1]],inEpoch)
+
+
+def test_banded_surface_is_stepwise(anc_gls):
+    # the batched engine evaluates banded models with dense stepwise matrices
+    sGrid = np.array([-0.02,0.0,0.02])
+    surfaces = [clue_model(['--df','30','--popFreq','0.3','--transMode',mode],anc_gls)[1].surface(sGrid)[1] for mode in ('banded','stepwise')]
+    np.testing.assert_array_equal(surfaces[0],surfaces[1])
+    assert surfaces[0][1] == 0.0
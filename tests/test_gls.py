@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+import inference
+import step2
+from conftest import clue_model
+
+
+def legacy_freqs(times,gens,traj):
+    # frequency each sample was drawn from in step2.py's per-sample loop
+    epochs = np.linspace(0,gens,gens)
+    return np.array([0.0 if t >= gens-1 else traj[np.digitize(t,epochs)+1] for t in times])
+
+
+def test_perfect_calls_follow_the_trajectory():
+    # a 0/1 trajectory fixes every genotype given the sampling time
+    gens = 100
+    traj = (np.arange(gens+2) % 7 < 3).astype(float)
+    gls,genos = step2.simulate_gls_from_traj(gens,500,traj,rng=np.random.default_rng(2))
+    assert gls.shape == (500,4)
+    np.testing.assert_array_equal(genos,2*legacy_freqs(gls[:,0],gens,traj))
+    np.testing.assert_array_equal(np.argmax(gls[:,1:],axis=1),genos)
+    assert np.all(np.sum(gls[:,1:] == 0.0,axis=1) == 1)
+    assert np.all(np.isneginf(gls[:,1:]).sum(axis=1) == 2)
+
+
+def test_replicates_use_their_own_trajectory():
+    gens = 60
+    trajs = [np.zeros(gens+2),np.ones(gens+5),(np.arange(gens+2) % 2).astype(float)]
+    offsets = np.concatenate(([0],np.cumsum([len(t) for t in trajs])))
+    gls,genos = step2.simulate_gls_from_traj(gens,50,np.concatenate(trajs),rng=np.random.default_rng(3),offsets=offsets,ploidy=1)
+    assert gls.shape == (3,50,3)
+    for r in range(3):
+        np.testing.assert_array_equal(genos[r],legacy_freqs(gls[r,:,0],gens,trajs[r]))
+
+
+@pytest.mark.parametrize('ploidy',[1,2])
+def test_read_depth_likelihoods(ploidy):
+    gens = 100
+    traj = np.full(gens+2,0.4)
+    gls,genos = step2.simulate_gls_from_traj(gens,4000,traj,rng=np.random.default_rng(5),ploidy=ploidy,depth=3.0,err=0.0)
+    assert np.all(np.max(gls[:,1:],axis=1) == 0.0)
+    # without errors the true genotype is never ruled out
+    assert np.all(np.isfinite(gls[np.arange(4000),genos+1]))
+    # samples without reads carry no information
+    noReads = np.all(gls[:,1:] == 0.0,axis=1)
+    assert np.mean(noReads) == pytest.approx(np.exp(-3.0),abs=0.02)
+    assert np.mean(genos[gls[:,0] < gens-1]) == pytest.approx(ploidy*0.4,abs=0.05)
+
+
+def test_read_errors_soften_homozygous_calls():
+    traj = np.ones(102)
+    gls,genos = step2.simulate_gls_from_traj(100,2000,traj,rng=np.random.default_rng(6),depth=20.0,err=0.05)
+    called = genos == 2
+    # reads show the ancestral allele at rate err, so hom-ancestral stays finite but unlikely
+    assert np.all(np.isfinite(gls[called,1])) and np.all(gls[called,1] < 0)
+    assert np.mean(np.argmax(gls[called,1:],axis=1) == 2) > 0.99
+
+
+@pytest.mark.parametrize('ext',['.txt','.npy','.npz'])
+@pytest.mark.parametrize('mmap',[False,True])
+def test_binary_gls_load_like_text(anc_gls,tmp_path,ext,mmap):
+    path = str(tmp_path/('anc'+ext))
+    step2.write_gls(path,anc_gls)
+    gls = inference.load_gls(path,4,mmap)
+    assert gls.dtype == np.float64
+    np.testing.assert_array_equal(gls,anc_gls)
+    # copy-on-write: the kernels may write, the file stays as it is
+    gls[0,0] = -1.0
+    np.testing.assert_array_equal(inference.load_gls(path,4),anc_gls)
+
+
+def test_binary_gls_give_the_same_fit(anc_gls,tmp_path):
+    fits = []
+    for ext in ('.txt','.npy'):
+        path = str(tmp_path/('anc'+ext))
+        step2.write_gls(path,anc_gls)
+        args,model = clue_model(['--ancientSamps',path,'--df','30','--popFreq','0.3'])
+        fits.append(model.fit())
+    assert fits[0][1] == fits[1][1]
+    np.testing.assert_array_equal(fits[0][0],fits[1][0])
+
+
+def test_binary_gls_shape_is_checked(anc_gls,tmp_path,capsys):
+    path = str(tmp_path/'hap.npy')
+    np.save(path,anc_gls[:,:3])
+    with pytest.raises(SystemExit):
+        inference.load_gls(path,4)
+    assert 'must hold a (samples x 4) array' in capsys.readouterr().out
+    # float32 input is converted
+    np.save(path,anc_gls[:,:3].astype(np.float32))
+    assert inference.load_gls(path,3).dtype == np.float64
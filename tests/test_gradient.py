@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+import hmm_utils
+import inference
+from conftest import clue_model, simulated_gls, write_bins, write_timeb
+
+
+def test_trans_ds_matches_dense_and_finite_difference():
+    freqs = inference.betaincinv(0.5,0.5,np.linspace(1e-4,1-1e-4,50))
+    z = inference.load_normal_tables()
+    s,eps = 0.01,1e-6
+    P,dP = hmm_utils._one_step_log_trans_prob_ds(1e4,s,freqs,*z,0.5)
+    np.testing.assert_array_equal(P,hmm_utils._one_step_log_trans_prob(1e4,s,freqs,*z,0.5))
+    hi = hmm_utils._one_step_log_trans_prob(1e4,s+eps,freqs,*z,0.5)
+    lo = hmm_utils._one_step_log_trans_prob(1e4,s-eps,freqs,*z,0.5)
+    # entries with non-negligible mass
+    keep = P > -20
+    np.testing.assert_allclose(dP[keep],(hi[keep]-lo[keep])/(2*eps),rtol=1e-4,atol=1e-4)
+
+
+@pytest.fixture(scope='module')
+def minargs(anc_gls,tmp_path_factory):
+    tmp = tmp_path_factory.mktemp('grad')
+    prefix = str(tmp/'loc')
+    write_timeb(prefix+'.timeb',[(1000,6)])
+    argv = ['--df','40','--timeBins',write_bins(tmp/'bins.txt',[0,50,120]),'--popFreq','0.3',
+        '--times',prefix,'--tCutoff','200','--transMode','stepwise']
+    return clue_model(argv,anc_gls)[1].minargs
+
+
+@pytest.mark.parametrize('S',[[0.0,0.0],[0.02,-0.01],[-0.03,0.01]])
+def test_gradient_matches_finite_difference(minargs,S):
+    S = np.array(S)
+    logl,grad = inference.likelihood_grad_wrapper(S,*minargs)
+    assert logl == pytest.approx(inference.likelihood_wrapper(S,*minargs),abs=1e-8)
+    eps = 1e-6
+    for k in range(len(S)):
+        dS = np.zeros(len(S))
+        dS[k] = eps
+        fd = (inference.likelihood_wrapper(S+dS,*minargs) - inference.likelihood_wrapper(S-dS,*minargs))/(2*eps)
+        assert grad[k] == pytest.approx(fd,rel=1e-4,abs=1e-4)
+
+
+@pytest.fixture(scope='module')
+def strong_gls():
+    return simulated_gls(nsamp=80)
+
+
+@pytest.mark.parametrize('df',['30','150'])
+def test_lbfgsb_reaches_nelder_mead(strong_gls,tmp_path,monkeypatch,df):
+    # the coarse df 30 grid is flat around s = 0, where L-BFGS-B cannot move and
+    # falls back to Nelder-Mead
+    argv = ['--df',df,'--popFreq','0.05','--timeBins',write_bins(tmp_path/'bins.txt',[0,50,200])]
+    args,model = clue_model(argv,strong_gls)
+    evals = []
+    likelihood = inference.likelihood_wrapper
+    def counting_likelihood(theta,*args):
+        evals[-1] += 1
+        return likelihood(theta,*args)
+    monkeypatch.setattr(inference,'likelihood_wrapper',counting_likelihood)
+    evals.append(0)
+    S,nmLR = model.fit('Nelder-Mead')
+    evals.append(0)
+    S,lbLR = model.fit('L-BFGS-B')
+    assert nmLR > 5
+    assert lbLR >= nmLR - 1e-3
+    if df == '150':
+        assert evals[1] < evals[0]/4
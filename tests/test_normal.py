@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from scipy import special, stats
+
+import hmm_utils
+import inference
+
+
+def test_log_ndtr_matches_scipy():
+    z = np.concatenate((np.linspace(-60,40,2001),[-38.5,-30.0,-29.999,0.0]))
+    ours = np.array([hmm_utils._log_ndtr(x) for x in z])
+    ref = special.log_ndtr(z)
+    # above z = 5 the value is ~ -Phi(-z), tiny; both only round that differently
+    upper = z > 5
+    np.testing.assert_allclose(ours[~upper],ref[~upper],rtol=1e-13,atol=0)
+    np.testing.assert_allclose(ours[upper],ref[upper],rtol=1e-9,atol=1e-300)
+    np.testing.assert_array_equal(hmm_utils._log_cdf_vec(z,*inference.load_normal_tables()[:2]),ours)
+
+
+def test_log_sf_is_reflected_cdf():
+    z_bins,z_logcdf,z_logsf = inference.load_normal_tables()
+    for x in (-45.0,-3.2,0.7,12.0):
+        assert hmm_utils._log_sf(x,z_bins,z_logsf) == pytest.approx(special.log_ndtr(-x),rel=1e-13)
+
+
+def test_beta_quantiles_match_scipy_stats():
+    q = np.linspace(0.0,1.0,150)
+    np.testing.assert_array_equal(inference.betaincinv(0.5,0.5,q),stats.beta.ppf(q,0.5,0.5))
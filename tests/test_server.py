@@ -0,0 +1,44 @@
+import io
+import json
+import re
+
+import numpy as np
+import pytest
+
+import clues_server
+from conftest import clue_model, write_bins
+
+
+@pytest.fixture
+def request_opts(anc_gls,timeb,tmp_path):
+    anc = str(tmp_path/'anc.txt')
+    np.savetxt(anc,anc_gls)
+    return {'times':timeb,'bp':1010,'ancientSamps':anc,'tCutoff':200,'df':30,
+        'timeBins':write_bins(tmp_path/'bins.txt',[0,60,200])}
+
+
+def test_served_fit_matches_direct_fit(request_opts):
+    argv = sum([['--'+k,str(v)] for k,v in request_opts.items()],[])
+    args,model = clue_model(argv)
+    S,logLR = model.fit(args.optimizer)
+    post = np.exp(model.posterior(S))
+
+    server = clues_server.InferenceServer(threads=2)
+    lines = [json.dumps(dict(request_opts,id=i,posterior='full')) for i in (1,2)]
+    lines.insert(1,json.dumps({'id':'bad','times':request_opts['times'],'bp':999}))
+    lines += [json.dumps({'cmd':'stats','id':3}),json.dumps({'cmd':'shutdown'}),json.dumps({'id':4})]
+    out = io.StringIO()
+    server.serve(io.StringIO('\n'.join(lines)+'\n'),out)
+    server.close()
+    responses = [json.loads(line) for line in out.getvalue().splitlines()]
+
+    # the failed request does not stop the server, and nothing is read after shutdown
+    assert [r['id'] for r in responses] == [1,'bad',2,3,None]
+    assert 'error' in responses[1]
+    # the second request is served from the shared transition cache
+    assert int(re.search(r'(\d+) hits',responses[3]['transCaches']['None']).group(1)) > 0
+    for r in (responses[0],responses[2]):
+        assert r['logLR'] == pytest.approx(logLR,abs=1e-10)
+        np.testing.assert_allclose(r['mle'],S,atol=1e-10)
+        np.testing.assert_allclose(r['posterior'],post,atol=1e-10)
+        np.testing.assert_allclose(r['meanFreq'],np.dot(model.freqs,post),atol=1e-10)
@@ -0,0 +1,72 @@
+import gzip
+import json
+
+import numpy as np
+import pytest
+
+import clues_server
+import inference
+from conftest import clue_model, write_timeb
+from timeb_utils import TimebReader, index_path
+
+
+def test_index_is_written_and_reused(timeb):
+    filename = timeb+'.timeb'
+    records = list(TimebReader(filename))
+    reader = TimebReader(filename)
+    assert reader.index is not None
+    assert list(reader.index['bp']) == [1000,1010,1020,1030]
+    bp,anc,der,anctimes,dertimes = reader.get(1020)
+    np.testing.assert_array_equal(dertimes,records[2][4])
+    np.testing.assert_array_equal(anctimes,records[2][3])
+
+
+def test_stale_index_is_ignored(timeb):
+    filename = timeb+'.timeb'
+    list(TimebReader(filename))
+    write_timeb(filename,[(2000,4),(2010,7)],seed=2)
+    reader = TimebReader(filename)
+    assert reader.index is None
+    assert reader.get(2010)[0] == 2010
+
+
+def test_gzip_matches_plain(timeb,tmp_path):
+    import gzip
+    with open(timeb+'.timeb','rb') as fp, gzip.open(tmp_path/'gz.timeb','wb') as gz:
+        gz.write(fp.read())
+    plain = list(TimebReader(timeb+'.timeb'))
+    zipped = TimebReader(str(tmp_path/'gz.timeb'))
+    for a,b in zip(plain,zipped):
+        assert a[0] == b[0]
+        np.testing.assert_array_equal(a[4],b[4])
+    np.testing.assert_array_equal(zipped.get(1030)[3],plain[3][3])
+
+
+def test_missing_bp_exits_with_message(timeb,capsys):
+    with pytest.raises(SystemExit):
+        clue_model(['--times',timeb,'--bp','999','--df','20'])
+    assert 'bp 999 not found in %s.timeb'%(timeb) in capsys.readouterr().out
+
+
+
+@pytest.mark.parametrize('gzipped',[False,True])
+def test_empty_file_exits_with_message(tmp_path,capsys,gzipped):
+    prefix = str(tmp_path/'empty')
+    with (gzip.open if gzipped else open)(prefix+'.timeb','wb'):
+        pass
+    with pytest.raises(SystemExit):
+        clue_model(['--times',prefix,'--df','20'])
+    assert 'Unable to open %s.timeb'%(prefix) in capsys.readouterr().out
+    with pytest.raises(OSError,match='empty or truncated'):
+        TimebReader(prefix+'.timeb')
+
+def test_several_bp_need_batch(timeb,capsys):
+    with pytest.raises(SystemExit):
+        clue_model(['--times',timeb,'--bp','1000','1010','--df','20'])
+    assert 'use --batch' in capsys.readouterr().out
+
+
+def test_missing_bp_is_reported_by_the_server(timeb):
+    server = clues_server.InferenceServer(transCacheMB=0)
+    response = json.loads(server.handle(json.dumps({'id':1,'times':timeb,'bp':999,'df':20})))
+    assert response['error'] == 'Error: bp 999 not found in %s.timeb'%(timeb)
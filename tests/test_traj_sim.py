@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+import step
+import step2
+import traj_sim
+
+
+@pytest.mark.parametrize('module',[step,step2])
+def test_simulate_traj_conditions_on_p_now(module):
+    rng = np.random.default_rng(5)
+    for i in range(3):
+        traj = module.simulate_traj(0.2,0.0,100,0,1000,rng=rng,pNow=0.3,tol=0.02)
+        # present day first
+        assert abs(traj[0]-0.3) <= 0.02
+
+
+@pytest.mark.parametrize('module',[step,step2])
+def test_simulate_traj_conditions_on_min_maf(module):
+    rng = np.random.default_rng(5)
+    for i in range(3):
+        traj = module.simulate_traj(0.01,0.0,200,0,1000,rng=rng,minMaf=0.05)
+        assert min(traj[0],1-traj[0]) >= 0.05
+
+
+def test_flat_layout_joins_forward_and_backward():
+    traj,offsets = traj_sim.simulate_traj(0.2,0.01,50,10,1000,R=5,rng=np.random.default_rng(1))
+    fwd = traj_sim.simulate_forwards(0.2,0.01,50,10,1000,R=5,rng=np.random.default_rng(2))
+    bwd,bwdOffsets = traj_sim.simulate_backwards(0.2,1e-8,1000,R=5,rng=np.random.default_rng(3))
+    joined,joinedOffsets = traj_sim._join(fwd,bwd,bwdOffsets)
+    for r in range(5):
+        x = traj_sim.replicate(joined,joinedOffsets,r)
+        np.testing.assert_array_equal(x[:51],fwd[r,::-1])
+        np.testing.assert_array_equal(x[51:],traj_sim.replicate(bwd,bwdOffsets,r))
+        # p0 at tOn, then back in time until the allele is lost
+        y = traj_sim.replicate(traj,offsets,r)
+        assert y[50] == 0.2 and y[-1] == 0.0 and np.all(y[:-1] > 0.0)
+    np.testing.assert_array_equal(traj_sim.simulate_traj(0.2,0.01,50,10,1000,R=5,rng=np.random.default_rng(1))[0],traj)
+
+
+def test_forward_step_moments():
+    # one generation of the step.py diffusion: mean a*p*(1-p)/(4N), variance p*(1-p)/(4N)
+    p,s,N,R = 0.5,0.01,1000,200000
+    x = traj_sim.simulate_forwards(p,s,1,0,N,R=R,rng=np.random.default_rng(4))[:,1]
+    delta = 1/(4*N)
+    assert np.mean(x)-p == pytest.approx(2*s*N*p*(1-p)*delta,abs=5*np.sqrt(p*(1-p)*delta/R))
+    assert np.var(x) == pytest.approx(p*(1-p)*delta,rel=0.02)
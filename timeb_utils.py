@@ -0,0 +1,185 @@
+import gzip
+import mmap
+import os
+
+import numpy as np
+
+# per-mutation header: bp (int32), anc/der alleles (2 chars), daf, n (int32)
+_RECORD_HEADER = np.dtype([('bp','<i4'),('anc','S1'),('der','S1'),('daf','<i4'),('n','<i4')])
+# sidecar index entry: offset is the byte position of the record in the (uncompressed) file
+_INDEX_DTYPE = np.dtype([('bp','<i4'),('offset','<i8'),('daf','<i4'),('n','<i4')])
+
+
+def _is_gzip(filename):
+    with open(filename,'rb') as fp:
+        return fp.read(2) == b'\x1f\x8b'
+
+
+def _num_times(daf,n):
+    # number of (anc, der) coalescence times per sampled tree
+    nanc = n-daf-1 if daf < n-1 else 0
+    nder = daf-1 if daf > 1 else 0
+    return nanc,nder
+
+
+def _times_array(buf,offset,M,k):
+    if k == 0:
+        return np.empty((M,0))
+    return np.frombuffer(buf,dtype='<f4',count=M*k,offset=offset).reshape((M,k))
+
+
+def index_path(filename):
+    return filename + '.idx.npz'
+
+
+def load_index(filename):
+    '''
+    Sidecar index of a .timeb file, or None if it is missing or was written
+    for a different version of the file (size/mtime mismatch).
+    '''
+    try:
+        st = os.stat(filename)
+        with np.load(index_path(filename)) as f:
+            if int(f['size']) != st.st_size or int(f['mtime']) != st.st_mtime_ns:
+                return None
+            return f['index']
+    except (OSError,KeyError,ValueError):
+        return None
+
+
+def write_index(filename,index):
+    st = os.stat(filename)
+    try:
+        np.savez(index_path(filename),index=index,size=st.st_size,mtime=st.st_mtime_ns)
+    except OSError:
+        # read-only location; the index is rebuilt on the next run
+        pass
+
+
+class TimebReader:
+    '''
+    Reader for the .timeb files written by Relate's SampleBranchLengths.
+
+    Uncompressed files are memory-mapped and records are returned as read-only
+    views into the map. gzip files are streamed one record at a time.
+
+    The first full pass writes a sidecar index (<file>.idx.npz: bp, offset, daf, n),
+    which later runs reuse as long as the file's size and mtime are unchanged, so
+    get(bp) seeks straight to a record instead of scanning the file. (For gzip
+    files seeking still decompresses up to the record, but skips parsing.)
+
+    Records are tuples (bp, anc, der, anctimes, dertimes), where anctimes/dertimes
+    have shape (num_sampled_trees_per_mut, #coalescences).
+    '''
+
+    def __init__(self,filename):
+        self.filename = filename
+        self.gzipped = _is_gzip(filename)
+        self._mm = None
+        self._offsets = None
+        if self.gzipped:
+            with gzip.open(filename,'rb') as fp:
+                header = fp.read(8)
+        else:
+            with open(filename,'rb') as fp:
+                # mmap cannot map an empty file (ValueError)
+                if os.fstat(fp.fileno()).st_size >= 8:
+                    self._mm = mmap.mmap(fp.fileno(),0,access=mmap.ACCESS_READ)
+            header = self._mm[:8] if self._mm is not None else b''
+        if len(header) < 8:
+            raise OSError('%s is empty or truncated (no .timeb header)'%(filename))
+        self.num_muts, self.num_sampled_trees_per_mut = (int(x) for x in np.frombuffer(header,dtype='<i4'))
+        self.index = load_index(filename)
+
+    def __len__(self):
+        return self.num_muts
+
+    def __iter__(self):
+        if self.gzipped:
+            return self._iter_gzip()
+        return self._iter_mmap()
+
+    def _record_size(self,daf,n):
+        return _RECORD_HEADER.itemsize + 4*self.num_sampled_trees_per_mut*sum(_num_times(daf,n))
+
+    def _record(self,buf,offset):
+        # returns the record starting at offset and its header
+        M = self.num_sampled_trees_per_mut
+        h = np.frombuffer(buf,dtype=_RECORD_HEADER,count=1,offset=offset)[0]
+        nanc,nder = _num_times(int(h['daf']),int(h['n']))
+        start = offset + _RECORD_HEADER.itemsize
+        anctimes = _times_array(buf,start,M,nanc)
+        dertimes = _times_array(buf,start+4*M*nanc,M,nder)
+        return (int(h['bp']),h['anc'],h['der'],anctimes,dertimes),h
+
+    def _set_index(self,entries):
+        self.index = np.array(entries,dtype=_INDEX_DTYPE)
+        write_index(self.filename,self.index)
+
+    def _iter_mmap(self):
+        entries = []
+        offset = 8
+        for m in range(self.num_muts):
+            rec,h = self._record(self._mm,offset)
+            entries.append((h['bp'],offset,h['daf'],h['n']))
+            yield rec
+            offset += self._record_size(int(h['daf']),int(h['n']))
+        if self.index is None:
+            self._set_index(entries)
+
+    def _read_gzip_record(self,fp):
+        header = fp.read(_RECORD_HEADER.itemsize)
+        h = np.frombuffer(header,dtype=_RECORD_HEADER)[0]
+        data = fp.read(self._record_size(int(h['daf']),int(h['n'])) - len(header))
+        return self._record(header+data,0)
+
+    def _iter_gzip(self):
+        entries = []
+        offset = 8
+        with gzip.open(self.filename,'rb') as fp:
+            fp.seek(offset)
+            for m in range(self.num_muts):
+                rec,h = self._read_gzip_record(fp)
+                entries.append((h['bp'],offset,h['daf'],h['n']))
+                yield rec
+                offset += self._record_size(int(h['daf']),int(h['n']))
+        if self.index is None:
+            self._set_index(entries)
+
+    def build_index(self):
+        '''
+        Header-only pass over the file, unless a valid sidecar index was loaded.
+        '''
+        if self.index is None:
+            entries = []
+            offset = 8
+            if self.gzipped:
+                with gzip.open(self.filename,'rb') as fp:
+                    fp.seek(offset)
+                    for m in range(self.num_muts):
+                        h = np.frombuffer(fp.read(_RECORD_HEADER.itemsize),dtype=_RECORD_HEADER)[0]
+                        size = self._record_size(int(h['daf']),int(h['n']))
+                        entries.append((h['bp'],offset,h['daf'],h['n']))
+                        fp.seek(size - _RECORD_HEADER.itemsize,1)
+                        offset += size
+            else:
+                for m in range(self.num_muts):
+                    h = np.frombuffer(self._mm,dtype=_RECORD_HEADER,count=1,offset=offset)[0]
+                    entries.append((h['bp'],offset,h['daf'],h['n']))
+                    offset += self._record_size(int(h['daf']),int(h['n']))
+            self._set_index(entries)
+        # first record wins for repeated positions
+        self._offsets = dict(zip(self.index['bp'][::-1].tolist(),self.index['offset'][::-1].tolist()))
+
+    def get(self,bp):
+        '''
+        Record of the (first) mutation at bp; raises KeyError if there is none.
+        '''
+        if self._offsets is None:
+            self.build_index()
+        offset = self._offsets[bp]
+        if self.gzipped:
+            with gzip.open(self.filename,'rb') as fp:
+                fp.seek(offset)
+                return self._read_gzip_record(fp)[0]
+        return self._record(self._mm,offset)[0]
@@ -0,0 +1,180 @@
+import numpy as np
+from numba import njit
+
+# Diffusion approximation of step.py/step2.py, for R replicate trajectories at once.
+# Time steps are generations (delta = 1/(4N) in diffusion time); frequencies are
+# clipped to [0,1]. The random numbers come from a numpy Generator, so runs are
+# reproducible given its seed.
+#
+# Trajectories that run until absorption have very different lengths, so they are
+# returned as one flat array with offsets (as coal_buckets does for coalescence
+# times): replicate r is traj[offsets[r]:offsets[r+1]].
+
+@njit('int64[:](float64[:],float64,float64,float64[:,:],float64[:,:])',cache=True)
+def _backward_block(p,a,delta,z,out):
+	# advances replicate r (column r of z/out) from p[r] for up to B generations, or
+	# until it is absorbed at 0 or 1; out is padded with the absorbed value.
+	# p is updated in place; returns the number of steps taken by each replicate
+	B,R = z.shape
+	steps = np.zeros(R,dtype=np.int64)
+	for r in range(R):
+		x = p[r]
+		k = 0
+		while k < B and x != 0.0 and x != 1.0:
+			if a == 0.0:
+				drift = 1.0-x
+			else:
+				drift = a*x*(1.0-x)/np.tanh(a*x)
+			x = x - drift*delta + np.sqrt(delta*x*(1.0-x))*z[k,r]
+			x = min(max(x,0.0),1.0)
+			out[k,r] = x
+			k += 1
+		for j in range(k,B):
+			out[j,r] = x
+		p[r] = x
+		steps[r] = k
+	return steps
+
+@njit('void(float64[:],int64[:],int64[:],int64,float64[:,:],int64[:])',cache=True)
+def _scatter_block(traj,offsets,active,start,out,steps):
+	# copies the steps taken in one block (columns of out) to the flat array
+	for j in range(len(active)):
+		o = offsets[active[j]] + start
+		for k in range(steps[j]):
+			traj[o+k] = out[k,j]
+
+def _replicates(p0,R):
+	return np.array(np.broadcast_to(np.asarray(p0,dtype=float),(R,)))
+
+def replicate(traj,offsets,r):
+	return traj[offsets[r]:offsets[r+1]]
+
+def simulate_forwards(p0,s,tOn,tOff,N,R=1,rng=None):
+	'''
+	R trajectories from p0 at tOn generations before present to the present, with
+	selection s while t > tOff (simulate_selected_forwards in step.py). All
+	replicates are advanced together, one generation per step.
+
+	Returns an R x (tOn+1) array; column 0 is p0 (scalar or one per replicate).
+	'''
+	rng = np.random.default_rng() if rng is None else rng
+	delta = 1/(4*N)
+	traj = np.empty((R,tOn+1))
+	traj[:,0] = p = _replicates(p0,R)
+	for k,t in enumerate(range(tOn,0,-1)):
+		a = s*N*2 if t > tOff else 0.0
+		p = np.clip(a*p*(1-p)*delta + p + np.sqrt(delta*p*(1-p))*rng.standard_normal(R),0.0,1.0)
+		traj[:,k+1] = p
+	return traj
+
+def simulate_backwards(p0,s,N,R=1,rng=None,block=1024):
+	'''
+	R trajectories from p0 back in time until the allele is lost or fixed
+	(simulate_selected_backwards in step.py), excluding p0. Replicates are
+	advanced in blocks of generations by a numba kernel; absorbed ones drop out
+	of later blocks.
+
+	Returns (traj, offsets), see above.
+	'''
+	rng = np.random.default_rng() if rng is None else rng
+	a = s*N*2
+	delta = 1/(4*N)
+	p = _replicates(p0,R)
+	lengths = np.zeros(R,dtype=np.int64)
+	active = np.flatnonzero((p > 0.0) & (p < 1.0))
+	blocks = []
+	while len(active) > 0:
+		z = rng.standard_normal((block,len(active)))
+		out = np.empty((block,len(active)))
+		pa = p[active]
+		steps = _backward_block(pa,a,delta,z,out)
+		p[active] = pa
+		lengths[active] += steps
+		blocks.append((active,out,steps))
+		active = active[steps == block]
+
+	offsets = np.concatenate(([0],np.cumsum(lengths)))
+	traj = np.empty(offsets[-1])
+	for b,(active,out,steps) in enumerate(blocks):
+		_scatter_block(traj,offsets,active,b*block,out,steps)
+	return traj,offsets
+
+def simulate_traj(p0,s,tOn,tOff,N,R=1,rng=None):
+	'''
+	R trajectories as in step.py's simulate_traj, in generations before present:
+	the forward path (reversed, so the present comes first) followed by a
+	near-neutral (s = 1e-8) backward path from p0 until absorption.
+
+	Returns (traj, offsets), see above.
+	'''
+	rng = np.random.default_rng() if rng is None else rng
+	bwd,bwdOffsets = simulate_backwards(p0,1e-8,N,R,rng)
+	fwd = simulate_forwards(p0,s,tOn,tOff,N,R,rng)
+	return _join(fwd,bwd,bwdOffsets)
+
+def _join(fwd,bwd,bwdOffsets):
+	# reversed forward paths followed by the backward paths, as flat array + offsets
+	tOn = fwd.shape[1]-1
+	bwdLengths = np.diff(bwdOffsets)
+	offsets = np.concatenate(([0],np.cumsum(bwdLengths+tOn+1)))
+	traj = np.empty(offsets[-1])
+	traj[offsets[:-1,np.newaxis] + np.arange(tOn+1)] = fwd[:,::-1]
+	# bwd[i] of replicate r goes to offsets[r] + tOn+1 + (i - bwdOffsets[r])
+	traj[np.repeat(offsets[:-1] + tOn+1 - bwdOffsets[:-1],bwdLengths) + np.arange(len(bwd))] = bwd
+	return traj,offsets
+
+def simulate_forwards_conditioned(p0,s,tOn,tOff,N,R=1,rng=None,eps=0.001,pNow=None,tol=0.01,maxDraws=10**7,maxBatch=2**16):
+	'''
+	simulate_forwards conditioned on the present-day frequency: its minor allele
+	frequency is at least eps (the allele is neither lost nor fixed), and, if
+	pNow is given, it is within tol of pNow.
+
+	Batched rejection: every round draws k candidates for each replicate still
+	pending, with k set from the acceptance rate so far, and keeps the first
+	that meets the condition.
+
+	Returns (fwd, accept), where accept is the fraction of all candidates that
+	met the condition (an estimate of its probability). Raises RuntimeError after
+	maxDraws candidates.
+	'''
+	rng = np.random.default_rng() if rng is None else rng
+	p0 = _replicates(p0,R)
+	fwd = np.empty((R,tOn+1))
+	pending = np.arange(R)
+	draws = hits = 0
+	k = 1
+	while len(pending) > 0:
+		if draws >= maxDraws:
+			raise RuntimeError('%d of %d trajectories met the condition after %d draws'%(R-len(pending),R,draws))
+		rows = pending[:max(1,maxBatch//k)]
+		cand = simulate_forwards(np.repeat(p0[rows],k),s,tOn,tOff,N,len(rows)*k,rng)
+		now = cand[:,-1]
+		ok = np.minimum(now,1-now) >= eps
+		if pNow is not None:
+			ok &= np.abs(now-pNow) <= tol
+		ok = ok.reshape((len(rows),k))
+		draws += ok.size
+		hits += np.sum(ok)
+		done = np.any(ok,axis=1)
+		first = np.argmax(ok,axis=1)
+		fwd[rows[done]] = cand.reshape((len(rows),k,tOn+1))[done,first[done]]
+		pending = np.concatenate((pending[len(rows):],rows[~done]))
+		# enough candidates for each pending replicate to succeed with ~90% probability
+		rate = max(hits,1)/draws
+		k = int(min(max(np.ceil(np.log(0.1)/np.log1p(-min(rate,0.99))),1),maxBatch))
+	return fwd,hits/max(draws,1)
+
+def simulate_traj_conditioned(p0,s,tOn,tOff,N,R=1,rng=None,eps=0.001,pNow=None,tol=0.01,maxDraws=10**7):
+	'''
+	simulate_traj with the forward path conditioned as in
+	simulate_forwards_conditioned. The (expensive) backward paths are only
+	simulated for the R accepted trajectories, which are all usable: no
+	trajectory is wasted on a lost or out-of-range allele.
+
+	Returns (traj, offsets, accept).
+	'''
+	rng = np.random.default_rng() if rng is None else rng
+	fwd,accept = simulate_forwards_conditioned(p0,s,tOn,tOff,N,R,rng,eps,pNow,tol,maxDraws)
+	bwd,bwdOffsets = simulate_backwards(p0,1e-8,N,R,rng)
+	traj,offsets = _join(fwd,bwd,bwdOffsets)
+	return traj,offsets,accept
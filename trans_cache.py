@@ -0,0 +1,131 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from hmm_utils import _nstep_log_trans_prob
+from hmm_utils import _one_step_log_trans_prob
+from hmm_utils import TRANS_STEPWISE
+
+
+class TransCache:
+    '''
+    Bounded LRU cache of log transition matrices, keyed on (N, s, dt, h, freqs, transMode),
+    and of the K x df x df stacks of them passed to the kernels.
+
+    Lives across likelihood evaluations (Nelder-Mead iterations) and importance
+    samples, so matrices for epochs whose (Ne, s, dt) did not change are built once.
+    Matrices and stacks share the maxBytes budget.
+    '''
+
+    # frequency grids remembered (by content) at a time
+    maxGrids = 16
+
+    def __init__(self,z_bins,z_logcdf,z_logsf,maxBytes=2**30):
+        self.z_bins = z_bins
+        self.z_logcdf = z_logcdf
+        self.z_logsf = z_logsf
+        self.maxBytes = maxBytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._mats = OrderedDict()
+        self._stacks = OrderedDict()
+        self._grids = OrderedDict()
+        self._nextGrid = 0
+
+    def __len__(self):
+        return len(self._mats)
+
+    def _freqs_key(self,freqs):
+        # grids are matched by content (each request of clues_server.py builds its own
+        # array); ids are never reused, so matrices of a forgotten grid just age out
+        grid = freqs.tobytes()
+        k = self._grids.get(grid)
+        if k is None:
+            k = self._grids[grid] = self._nextGrid
+            self._nextGrid += 1
+            if len(self._grids) > self.maxGrids:
+                self._grids.popitem(last=False)
+        else:
+            self._grids.move_to_end(grid)
+        return k
+
+    def _store(self,cache,key,arr):
+        if arr.nbytes > self.maxBytes:
+            return
+        cache[key] = arr
+        self.nbytes += arr.nbytes
+        while self.nbytes > self.maxBytes:
+            # stacks are rebuilt from cached matrices, so they go first
+            _,old = (self._stacks or self._mats).popitem(last=False)
+            self.nbytes -= old.nbytes
+
+    def get(self,N,s,dt,h,freqs,transMode):
+        return self._get(N,s,dt,h,freqs,self._freqs_key(freqs),transMode)
+
+    def _get(self,N,s,dt,h,freqs,freqsKey,transMode):
+        if transMode == TRANS_STEPWISE:
+            # the 1-step matrix does not depend on dt
+            dt = 1
+        key = (float(N),float(s),int(dt),float(h),freqsKey,int(transMode))
+        mat = self._mats.get(key)
+        if mat is not None:
+            self.hits += 1
+            self._mats.move_to_end(key)
+            return mat
+
+        self.misses += 1
+        if transMode == TRANS_STEPWISE:
+            mat = _one_step_log_trans_prob(N,s,freqs,self.z_bins,self.z_logcdf,self.z_logsf,h)
+        else:
+            mat = _nstep_log_trans_prob(N,s,freqs,self.z_bins,self.z_logcdf,self.z_logsf,dt,h)
+
+        self._store(self._mats,key,mat)
+        return mat
+
+    def _stack(self,uniq,h,freqs,transMode):
+        # transition matrices for the (N,s,dt) columns of uniq, stacked as the kernels take them
+        freqsKey = self._freqs_key(freqs)
+        key = (uniq.tobytes(),float(h),freqsKey,int(transMode))
+        transMats = self._stacks.get(key)
+        if transMats is not None:
+            self.hits += len(transMats)
+            self._stacks.move_to_end(key)
+            return transMats
+        transMats = np.array([self._get(Nt,st,dt,h,freqs,freqsKey,transMode) for Nt,st,dt in uniq.T])
+        self._store(self._stacks,key,transMats)
+        return transMats
+
+    def transitions(self,sel,epochs,N,freqs,h,transMode):
+        '''
+        Matrices for every epoch of one forward/backward pass.
+
+        Returns transMats (K x df x df, one per distinct (N,s,dt)) and transIdx
+        (epoch -> row of transMats), to be passed to forward/backward_algorithm.
+        '''
+        T = len(epochs)-1
+        dts = np.diff(epochs)
+        if transMode == TRANS_STEPWISE:
+            dts = np.ones(T)
+        keys = np.array([N[:T],sel[:T],dts])
+        uniq,transIdx = np.unique(keys,axis=1,return_inverse=True)
+        return self._stack(uniq,h,freqs,transMode),transIdx.reshape(-1).astype(np.int64)
+
+    def transitions_grid(self,sels,epochs,N,freqs,h,transMode):
+        '''
+        transitions() for many selection vectors at once (sels: C x len(epochs)).
+
+        Returns transMats (K x df x df, one per distinct (N,s,dt) over all
+        candidates) and transIdx (C x epochs), for backward_likelihoods.
+        '''
+        C = sels.shape[0]
+        T = len(epochs)-1
+        dts = np.diff(epochs)
+        if transMode == TRANS_STEPWISE:
+            dts = np.ones(T)
+        keys = np.array([np.tile(N[:T],C),sels[:,:T].reshape(-1),np.tile(dts,C)])
+        uniq,transIdx = np.unique(keys,axis=1,return_inverse=True)
+        return self._stack(uniq,h,freqs,transMode),transIdx.reshape((C,T)).astype(np.int64)
+
+    def stats(self):
+        return 'Transition cache: %d hits, %d misses, %d matrices, %d stacks (%.1f MB)'%(self.hits,self.misses,len(self),len(self._stacks),self.nbytes/2**20)